@@ -0,0 +1,138 @@
+from collections import Counter
+from datetime import datetime, timedelta
+import logging
+import sys
+
+from sqlalchemy import func, insert, select, literal
+
+from app import app, db
+from models import (
+    TrainSchedule, FlightSchedule, Booking, Passenger, IdempotencyKey, WaitlistEntry, ETicket, RouteAvailability,
+    SeatMap, TrainStop,
+    TrainScheduleArchive, TrainStopArchive, FlightScheduleArchive, BookingArchive, PassengerArchive,
+    booking_schedule_options
+)
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_AFTER_DAYS = 90  # schedules that arrived longer ago than this move to the cold tier
+ARCHIVE_BATCH_SIZE = 100  # schedules per transaction
+
+ARCHIVE_MODELS = {
+    'train': (TrainSchedule, TrainScheduleArchive),
+    'flight': (FlightSchedule, FlightScheduleArchive),
+}
+
+
+def _copy_rows(source, target, condition, archived_at):
+    """INSERT ... SELECT the matching rows of ``source`` into ``target``"""
+    columns = [column.name for column in source.__table__.columns]
+    query = select(*source.__table__.columns, literal(archived_at).label('archived_at')).where(condition)
+    db.session.execute(insert(target).from_select(columns + ['archived_at'], query))
+
+
+def archive_batch(booking_type, cutoff, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move one batch of departed schedules with their stops, bookings and passengers.
+
+    The whole batch is copied and deleted in a single transaction, so an
+    interrupted run leaves every schedule in exactly one tier and simply
+    picks up with the remaining ones next time. Returns the counts moved.
+    """
+    model, archive_model = ARCHIVE_MODELS[booking_type]
+    schedule_ids = [row.id for row in db.session.query(model.id)
+                    .filter(model.arrival_time < cutoff)
+                    .order_by(model.id)
+                    .limit(batch_size)
+                    .with_for_update(skip_locked=True)]
+    if not schedule_ids:
+        return None
+
+    booking_ids = [row.id for row in db.session.query(Booking.id).filter(
+        Booking.booking_type == booking_type,
+        Booking.schedule_id.in_(schedule_ids)
+    )]
+    now = datetime.utcnow()
+    passengers = 0
+
+    _copy_rows(model, archive_model, model.id.in_(schedule_ids), now)
+    if booking_type == 'train':
+        # Archived sub-journey bookings name their stops by sequence number
+        _copy_rows(TrainStop, TrainStopArchive, TrainStop.schedule_id.in_(schedule_ids), now)
+    # Waitlist entries of a departed schedule are of no further use, nor are
+    # the idempotency keys that answer replays with them
+    entry_ids = select(WaitlistEntry.id).where(
+        WaitlistEntry.booking_type == booking_type,
+        WaitlistEntry.schedule_id.in_(schedule_ids)
+    )
+    IdempotencyKey.query.filter(IdempotencyKey.waitlist_entry_id.in_(entry_ids)).delete(synchronize_session=False)
+    WaitlistEntry.query.filter(WaitlistEntry.id.in_(entry_ids)).delete(synchronize_session=False)
+    if booking_ids:
+        _copy_rows(Booking, BookingArchive, Booking.id.in_(booking_ids), now)
+        _copy_rows(Passenger, PassengerArchive, Passenger.booking_id.in_(booking_ids), now)
+        for dependant in (IdempotencyKey, ETicket, WaitlistEntry):
+            dependant.query.filter(dependant.booking_id.in_(booking_ids)).delete(synchronize_session=False)
+        passengers = Passenger.query.filter(Passenger.booking_id.in_(booking_ids)).delete(synchronize_session=False)
+        Booking.query.filter(Booking.id.in_(booking_ids)).delete(synchronize_session=False)
+    schedule_fk = getattr(RouteAvailability, f'{booking_type}_schedule_id')
+    RouteAvailability.query.filter(schedule_fk.in_(schedule_ids)).delete(synchronize_session=False)
+    SeatMap.query.filter(
+        SeatMap.booking_type == booking_type,
+        SeatMap.schedule_id.in_(schedule_ids)
+    ).delete(synchronize_session=False)
+    if booking_type == 'train':
+        TrainStop.query.filter(TrainStop.schedule_id.in_(schedule_ids)).delete(synchronize_session=False)
+    model.query.filter(model.id.in_(schedule_ids)).delete(synchronize_session=False)
+    db.session.commit()
+
+    return {'schedules': len(schedule_ids), 'bookings': len(booking_ids), 'passengers': passengers}
+
+
+def archive_departed(days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move everything that arrived more than ``days`` ago to the cold tier"""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    totals = {'schedules': 0, 'bookings': 0, 'passengers': 0}
+    for booking_type in ARCHIVE_MODELS:
+        while True:
+            try:
+                moved = archive_batch(booking_type, cutoff, batch_size)
+            except Exception:
+                db.session.rollback()
+                logger.exception("Archiving %s schedules failed; rerun to resume", booking_type)
+                raise
+            if moved is None:
+                break
+            for key, value in moved.items():
+                totals[key] += value
+            logger.info("Archived %s %s schedules (%s bookings)", moved['schedules'], booking_type, moved['bookings'])
+    return totals
+
+
+# Reads spanning both tiers
+
+def user_bookings(user_id):
+    """A user's bookings from both tiers as (booking, schedule, archived), newest first"""
+    rows = []
+    for model, archived in ((Booking, False), (BookingArchive, True)):
+        bookings = model.query.options(*booking_schedule_options(model)).filter_by(user_id=user_id)
+        rows.extend((booking, booking.schedule, archived) for booking in bookings)
+    rows.sort(key=lambda row: row[0].booking_date or datetime.min, reverse=True)
+    return rows
+
+
+def booking_counts():
+    """Bookings per (booking_type, status, travel_class) across both tiers,
+    one grouped query per tier answered from its type/status/class index"""
+    counts = Counter()
+    for model in (Booking, BookingArchive):
+        columns = (model.booking_type, model.status, model.travel_class)
+        for *key, bookings in db.session.query(*columns, func.count()).group_by(*columns):
+            counts[tuple(key)] += bookings
+    return counts
+
+
+if __name__ == "__main__":
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else ARCHIVE_AFTER_DAYS
+    with app.app_context():
+        totals = archive_departed(days)
+        print(f"Archived {totals['schedules']} schedules, {totals['bookings']} bookings "
+              f"and {totals['passengers']} passengers")
@@ -0,0 +1,347 @@
+from collections import OrderedDict, namedtuple
+from datetime import datetime, time, timedelta
+import threading
+from time import monotonic
+
+from sqlalchemy import and_, event, func, or_, select
+from sqlalchemy.orm import Session, aliased
+
+from app import app, db
+from models import Train, Flight, Station, Airport, TrainSchedule, TrainStop, RouteAvailability
+from inventory import SCHEDULE_MODELS, TRAVEL_CLASSES, price_column
+from seating import leg_occupancy, free_on_legs
+from changefeed import consumer, affected_routes
+
+BOOKING_TYPES = {model: booking_type for booking_type, model in SCHEDULE_MODELS.items()}
+PLACE_MODELS = {
+    'train': Station,
+    'flight': Airport,
+}
+# Rows copy names and codes from these, so changing one refreshes its schedules
+RELATED_SCHEDULES = {
+    Train: ('schedules',),
+    Flight: ('schedules',),
+    Station: ('departures', 'arrivals'),
+    Airport: ('departures', 'arrivals'),
+}
+REBUILD_BATCH_SIZE = 500
+SEARCH_PER_DAY_LIMIT = 50  # results shown for one day
+FLEXIBLE_MAX_DAYS = 3
+SEARCH_CACHE_TTL = 120  # seconds; bounds staleness from changes the feed has not delivered yet
+SEARCH_CACHE_MAX_ENTRIES = 2048
+
+# A train ride between two intermediate stops, shaped like a RouteAvailability row
+SubJourney = namedtuple('SubJourney', [
+    'booking_type', 'schedule_id', 'board_stop', 'alight_stop', 'service_date', 'departure_time', 'arrival_time',
+    'duration_minutes', 'vehicle_name', 'vehicle_number', 'aircraft_type',
+    'origin_code', 'origin_city', 'destination_code', 'destination_city',
+    'economy_price', 'business_price', 'first_price',
+    'available_seats_economy', 'available_seats_business', 'available_seats_first'
+])
+
+_search_cache = OrderedDict()  # (type, origins, destinations, first, last, class, sort, per_day) -> (stored_at, rows)
+_search_cache_lock = threading.Lock()
+_search_invalidations = 0
+
+
+def sync_availability(session, schedule):
+    """Create or update the search row for a schedule in the current transaction.
+
+    Cancelled schedules are not offered, so their row is removed instead.
+    """
+    booking_type = BOOKING_TYPES[type(schedule)]
+    if schedule.cancelled_at is not None:
+        if schedule.availability is not None:
+            _record_change(session, schedule.availability)
+            schedule.availability = None  # delete-orphan
+        return None
+
+    # Pending schedules do not lazy-load, so resolve related rows by id
+    if booking_type == 'train':
+        vehicle = session.get(Train, schedule.train_id)
+        origin = session.get(Station, schedule.departure_station_id)
+        destination = session.get(Station, schedule.arrival_station_id)
+        vehicle_name, vehicle_number, aircraft_type = vehicle.name, vehicle.number, None
+    else:
+        vehicle = session.get(Flight, schedule.flight_id)
+        origin = session.get(Airport, schedule.departure_airport_id)
+        destination = session.get(Airport, schedule.arrival_airport_id)
+        vehicle_name, vehicle_number, aircraft_type = vehicle.airline, vehicle.flight_number, vehicle.aircraft_type
+
+    row = schedule.availability
+    if row is None:
+        row = RouteAvailability(booking_type=booking_type)
+        schedule.availability = row
+        session.add(row)
+    else:
+        _record_change(session, row)
+    row.origin_id = origin.id
+    row.destination_id = destination.id
+    row.service_date = schedule.departure_time.date()
+    row.departure_time = schedule.departure_time
+    row.arrival_time = schedule.arrival_time
+    row.duration_minutes = int((schedule.arrival_time - schedule.departure_time).total_seconds() // 60)
+    row.vehicle_name = vehicle_name
+    row.vehicle_number = vehicle_number
+    row.aircraft_type = aircraft_type
+    row.origin_code = origin.code
+    row.origin_city = origin.city
+    row.destination_code = destination.code
+    row.destination_city = destination.city
+    for travel_class in ('economy', 'business', 'first'):
+        setattr(row, f'{travel_class}_price', getattr(schedule, f'{travel_class}_price'))
+        setattr(row, f'available_seats_{travel_class}', getattr(schedule, f'available_seats_{travel_class}'))
+    _record_change(session, row)
+    return row
+
+
+def _record_change(session, row):
+    # Consumed after commit by caches derived from the read model (this
+    # module's search results, then fares.py)
+    session.info.setdefault('availability_changes', set()).add(
+        (row.booking_type, row.origin_id, row.destination_id, row.service_date)
+    )
+
+
+@event.listens_for(Session, 'before_flush')
+def _sync_changed_schedules(session, flush_context, instances):
+    # Runs inside every flush, so bookings, cancellations and admin edits
+    # update the read model in the same transaction as the schedule itself
+    changed = set()
+    for obj in list(session.new) + list(session.dirty):
+        if obj in session.deleted or (obj not in session.new and not session.is_modified(obj)):
+            continue
+        if type(obj) in BOOKING_TYPES:
+            changed.add(obj)
+        elif type(obj) in RELATED_SCHEDULES and obj not in session.new:
+            for name in RELATED_SCHEDULES[type(obj)]:
+                changed.update(getattr(obj, name))
+    for schedule in changed:
+        if schedule not in session.deleted:
+            sync_availability(session, schedule)
+    for obj in session.deleted:
+        if type(obj) in BOOKING_TYPES and obj.availability is not None:
+            _record_change(session, obj.availability)  # the row goes with the schedule
+
+
+def match_places(booking_type, text):
+    """Ids of the stations or airports whose name, code or city contains ``text``"""
+    model = PLACE_MODELS[booking_type]
+    return [row.id for row in db.session.query(model.id).filter(
+        or_(model.name.ilike(f'%{text}%'), model.code.ilike(f'%{text}%'), model.city.ilike(f'%{text}%'))
+    )]
+
+
+def _sort_order(travel_class, sort):
+    if sort == 'price':
+        first = getattr(RouteAvailability, price_column(travel_class))
+    elif sort == 'duration':
+        first = RouteAvailability.duration_minutes
+    else:
+        return [RouteAvailability.departure_time]
+    return [first, RouteAvailability.departure_time]
+
+
+def search_availability(booking_type, origin_ids, destination_ids, first_date, last_date=None,
+                        travel_class='economy', sort='departure', per_day=SEARCH_PER_DAY_LIMIT):
+    """Departures between two service dates, at most ``per_day`` for each day.
+
+    Rows come back grouped by day and ordered within it by ``sort``
+    ('departure', 'price' or 'duration'); all of it, including the per-day
+    limit, is done by the database on ix_route_availability_search. Train
+    searches also include rides between intermediate stops.
+    """
+    last_date = last_date or first_date
+    rows = _search_routes(booking_type, origin_ids, destination_ids, first_date, last_date, travel_class, sort, per_day)
+    if booking_type != 'train':
+        return rows
+    sub_journeys = search_sub_journeys(origin_ids, destination_ids, first_date, last_date, per_day)
+    if not sub_journeys:
+        return rows
+
+    def key(row):
+        if sort == 'price':
+            return row.service_date, getattr(row, price_column(travel_class)), row.departure_time
+        if sort == 'duration':
+            return row.service_date, row.duration_minutes, row.departure_time
+        return row.service_date, row.departure_time
+
+    merged, per_date = [], {}
+    for row in sorted(rows + sub_journeys, key=key):
+        per_date[row.service_date] = per_date.get(row.service_date, 0) + 1
+        if per_date[row.service_date] <= per_day:
+            merged.append(row)
+    return merged
+
+
+def _search_routes(booking_type, origin_ids, destination_ids, first_date, last_date, travel_class, sort, per_day):
+    filters = [
+        RouteAvailability.booking_type == booking_type,
+        RouteAvailability.origin_id.in_(origin_ids),
+        RouteAvailability.destination_id.in_(destination_ids),
+        RouteAvailability.service_date >= first_date,
+        RouteAvailability.service_date <= last_date
+    ]
+    order = _sort_order(travel_class, sort)
+    if first_date == last_date:
+        return RouteAvailability.query.filter(*filters).order_by(*order).limit(per_day).all()
+
+    ranked = select(
+        RouteAvailability.id,
+        func.row_number().over(partition_by=RouteAvailability.service_date, order_by=order).label('rank')
+    ).where(*filters).subquery()
+    return (RouteAvailability.query
+            .join(ranked, ranked.c.id == RouteAvailability.id)
+            .filter(ranked.c.rank <= per_day)
+            .order_by(RouteAvailability.service_date, ranked.c.rank)
+            .all())
+
+
+def _as_journey(row):
+    # Cached results must not hold ORM rows bound to a request's session
+    if isinstance(row, SubJourney):
+        return row
+    return SubJourney(*(getattr(row, field) for field in SubJourney._fields))
+
+
+def cached_search_availability(booking_type, origin_ids, destination_ids, first_date, last_date=None,
+                               travel_class='economy', sort='departure', per_day=SEARCH_PER_DAY_LIMIT):
+    """search_availability served from a per-process cache invalidated on change.
+
+    Rows come back as SubJourney tuples, whole-route rows included.
+    """
+    last_date = last_date or first_date
+    key = (booking_type, tuple(sorted(origin_ids)), tuple(sorted(destination_ids)), first_date, last_date,
+           travel_class, sort, per_day)
+    now = monotonic()
+    with _search_cache_lock:
+        cached = _search_cache.get(key)
+        if cached is not None and now - cached[0] < SEARCH_CACHE_TTL:
+            _search_cache.move_to_end(key)
+            return cached[1]
+        generation = _search_invalidations
+
+    rows = [_as_journey(row) for row in search_availability(
+        booking_type, origin_ids, destination_ids, first_date, last_date, travel_class, sort, per_day)]
+
+    with _search_cache_lock:
+        # Skip caching if a commit invalidated entries while we were querying
+        if generation == _search_invalidations:
+            _search_cache[key] = (now, rows)
+            _search_cache.move_to_end(key)
+            while len(_search_cache) > SEARCH_CACHE_MAX_ENTRIES:
+                _search_cache.popitem(last=False)
+    return rows
+
+
+def invalidate_search_results(changes):
+    """Drop cached searches covering any of the (type, origin, destination, date) changes.
+
+    A train change also reaches rides between its intermediate stops, whose
+    stations it does not name, so train searches only need to cover the date
+    (or the day before, for rides boarding after midnight).
+    """
+    global _search_invalidations
+    with _search_cache_lock:
+        _search_invalidations += 1
+        for key in list(_search_cache):
+            booking_type, origin_ids, destination_ids, first_date, last_date = key[:5]
+            for changed_type, origin_id, destination_id, service_date in changes:
+                if changed_type != booking_type:
+                    continue
+                if booking_type == 'train':
+                    hit = first_date - timedelta(days=1) <= service_date <= last_date
+                else:
+                    hit = (origin_id in origin_ids and destination_id in destination_ids
+                           and first_date <= service_date <= last_date)
+                if hit:
+                    del _search_cache[key]
+                    break
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_searches_after_commit(session):
+    # Registered before fares.py's listener, which pops the changes
+    changes = session.info.get('availability_changes')
+    if changes:
+        invalidate_search_results(changes)
+
+
+@consumer('search_results')
+def _invalidate_searches_from_feed(events):
+    # Picks up commits made by other processes
+    invalidate_search_results({route for inventory_event in events for route in affected_routes(inventory_event)})
+
+
+def search_sub_journeys(origin_ids, destination_ids, first_date, last_date=None, per_day=SEARCH_PER_DAY_LIMIT):
+    """Train rides boarding or alighting at an intermediate stop.
+
+    Found by pairing two TrainStop rows of the same schedule, so a service
+    with n stops needs n rows rather than one per origin/destination pair.
+    Seats free for the ride come from the seat maps of the legs it covers.
+    """
+    last_date = last_date or first_date
+    board, alight = aliased(TrainStop), aliased(TrainStop)
+    board_station, alight_station = aliased(Station), aliased(Station)
+    rows = (db.session.query(
+                RouteAvailability, board, alight,
+                board_station.code, board_station.city, alight_station.code, alight_station.city,
+                Train.total_seats_economy, Train.total_seats_business, Train.total_seats_first)
+            .join(board, board.schedule_id == RouteAvailability.train_schedule_id)
+            .join(alight, and_(alight.schedule_id == board.schedule_id, alight.sequence > board.sequence))
+            .join(board_station, board_station.id == board.station_id)
+            .join(alight_station, alight_station.id == alight.station_id)
+            .join(TrainSchedule, TrainSchedule.id == RouteAvailability.train_schedule_id)
+            .join(Train, Train.id == TrainSchedule.train_id)
+            .filter(
+                board.station_id.in_(origin_ids),
+                alight.station_id.in_(destination_ids),
+                board.departure_time >= datetime.combine(first_date, time.min),
+                board.departure_time < datetime.combine(last_date + timedelta(days=1), time.min),
+                # The whole route is already a RouteAvailability row
+                or_(board.sequence > 0, alight.station_id != RouteAvailability.destination_id)
+            )
+            .order_by(board.departure_time)
+            .limit(per_day * ((last_date - first_date).days + 1))
+            .all())
+    occupancy = leg_occupancy('train', {row[0].train_schedule_id for row in rows})
+
+    journeys = []
+    for route, board_stop, alight_stop, origin_code, origin_city, destination_code, destination_city, *totals in rows:
+        share = alight_stop.fare_fraction - board_stop.fare_fraction
+        legs = range(board_stop.sequence, alight_stop.sequence)
+        seats = {travel_class: free_on_legs(total, occupancy.get((route.train_schedule_id, travel_class), {}), legs)
+                 for travel_class, total in zip(TRAVEL_CLASSES, totals)}
+        journeys.append(SubJourney(
+            'train', route.train_schedule_id, board_stop.sequence, alight_stop.sequence,
+            board_stop.departure_time.date(), board_stop.departure_time, alight_stop.arrival_time,
+            int((alight_stop.arrival_time - board_stop.departure_time).total_seconds() // 60),
+            route.vehicle_name, route.vehicle_number, None,
+            origin_code, origin_city, destination_code, destination_city,
+            round(route.economy_price * share, 2), round(route.business_price * share, 2),
+            round(route.first_price * share, 2),
+            seats['economy'], seats['business'], seats['first']
+        ))
+    return journeys
+
+
+def rebuild_availability(batch_size=REBUILD_BATCH_SIZE):
+    """Recreate every search row, e.g. after bulk SQL changes to schedules"""
+    rebuilt = 0
+    for model in SCHEDULE_MODELS.values():
+        last_id = 0
+        while True:
+            schedules = model.query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not schedules:
+                break
+            for schedule in schedules:
+                sync_availability(db.session, schedule)
+            db.session.commit()
+            last_id = schedules[-1].id
+            rebuilt += len(schedules)
+    return rebuilt
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        print(f"Rebuilt availability for {rebuild_availability()} schedules")
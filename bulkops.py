@@ -0,0 +1,310 @@
+from collections import defaultdict, namedtuple
+from datetime import date, datetime, time, timedelta
+import math
+
+from sqlalchemy import Numeric, cast, delete, exists, func, or_, select, update
+
+from app import db
+from models import (
+    Train, Flight, Station, Airport, TrainSchedule, FlightSchedule, TrainStop, SeatMap, Booking, Passenger,
+    TrainScheduleArchive, FlightScheduleArchive
+)
+from inventory import TRAVEL_CLASSES, get_schedule_model, price_column, seat_column
+from seating import assign_seats, seat_index, total_seats
+from stops import journey_legs
+from eticket import enqueue_eticket_render
+from availability import sync_availability
+from changefeed import TRACKED_COLUMNS, PLACE_COLUMNS, append_event
+from timeline import SCHEDULE_COLUMNS, VEHICLE_MODELS, Interval, VehicleTimeline, load_timeline
+
+BULK_CHUNK_SIZE = 500  # schedules per transaction
+MAX_REPORTED_PROBLEMS = 20
+MAX_SHIFT_MINUTES = 366 * 24 * 60
+# Changed rows are reloaded afterwards, so the session is not synchronised
+SET_BASED = {'synchronize_session': False}
+
+# Columns referencing each kind of reference row; any one keeps the row in use
+REFERENCES = {
+    Train: (TrainSchedule.train_id, TrainScheduleArchive.train_id),
+    Flight: (FlightSchedule.flight_id, FlightScheduleArchive.flight_id),
+    Station: (TrainSchedule.departure_station_id, TrainSchedule.arrival_station_id, TrainStop.station_id,
+              TrainScheduleArchive.departure_station_id, TrainScheduleArchive.arrival_station_id),
+    Airport: (FlightSchedule.departure_airport_id, FlightSchedule.arrival_airport_id,
+              FlightScheduleArchive.departure_airport_id, FlightScheduleArchive.arrival_airport_id),
+}
+BULK_OPERATIONS = ('reprice', 'shift-times', 'change-vehicle', 'delete-unused')
+REFERENCE_MODELS = {
+    'trains': Train,
+    'flights': Flight,
+    'stations': Station,
+    'airports': Airport,
+}
+
+# Which schedules an operation applies to; None leaves a field unfiltered
+ScheduleFilter = namedtuple('ScheduleFilter', ['vehicle_id', 'origin_id', 'destination_id', 'first_date', 'last_date'],
+                            defaults=(None, None, None, None, None))
+
+
+class BulkError(ValueError):
+    """Raised for a bulk operation that cannot be run as asked"""
+    pass
+
+
+def in_use(model, row_id):
+    """Whether any schedule (live or archived) references a reference row,
+    answered with EXISTS rather than by loading the schedules"""
+    return db.session.scalar(select(or_(*[exists().where(column == row_id) for column in REFERENCES[model]])))
+
+
+def _conditions(booking_type, filters):
+    model = get_schedule_model(booking_type)
+    vehicle_column, origin_column, destination_column = SCHEDULE_COLUMNS[booking_type]
+    conditions = []
+    for column, value in ((vehicle_column, filters.vehicle_id), (origin_column, filters.origin_id),
+                          (destination_column, filters.destination_id)):
+        if value is not None:
+            conditions.append(getattr(model, column) == value)
+    if filters.first_date is not None:
+        conditions.append(model.departure_time >= datetime.combine(filters.first_date, time.min))
+    if filters.last_date is not None:
+        conditions.append(model.departure_time < datetime.combine(filters.last_date + timedelta(days=1), time.min))
+    return conditions
+
+
+def _matching(booking_type, filters):
+    """[(vehicle_id, Interval)] of the schedules selected by ``filters``, by id"""
+    model = get_schedule_model(booking_type)
+    vehicle_column, origin_column, destination_column = SCHEDULE_COLUMNS[booking_type]
+    rows = db.session.execute(
+        select(getattr(model, vehicle_column), model.departure_time, model.arrival_time,
+               getattr(model, origin_column), getattr(model, destination_column), model.id)
+        .where(*_conditions(booking_type, filters))
+        .order_by(model.id)
+    )
+    return [(row[0], Interval(*row[1:])) for row in rows]
+
+
+def _timeline_problems(booking_type, vehicle_ids, moved):
+    """Overlap and continuity problems on ``vehicle_ids`` once every schedule
+    in ``moved`` ({schedule_id: (vehicle_id, Interval)}) takes its new place.
+
+    Vehicle rows are locked (see timeline.load_timeline) until the caller
+    commits or rolls back.
+    """
+    arriving = defaultdict(list)
+    for vehicle_id, interval in moved.values():
+        arriving[vehicle_id].append(interval)
+    problems = []
+    for vehicle_id in sorted(vehicle_ids):
+        intervals = [interval for interval in load_timeline(booking_type, vehicle_id, lock=True).intervals
+                     if interval.schedule_id not in moved]
+        timeline = VehicleTimeline(booking_type)
+        for interval in sorted(intervals + arriving[vehicle_id]):
+            problems.extend(f'Schedule #{interval.schedule_id}: {problem}' for problem in timeline.conflicts(interval))
+            timeline.add(interval)
+    return problems
+
+
+def _plain(value):
+    return value.isoformat() if isinstance(value, (datetime, date)) else value
+
+
+def _apply_in_chunks(booking_type, schedule_ids, change, chunk_size):
+    """Run ``change(model, ids)`` (set-based statements) over ``schedule_ids``
+    one chunk per transaction, keeping the search rows and the change feed
+    in step since bulk statements bypass the session listeners.
+
+    A failure leaves the earlier chunks committed; returns the number of
+    schedules changed.
+    """
+    model = get_schedule_model(booking_type)
+    columns = TRACKED_COLUMNS + PLACE_COLUMNS[booking_type] + SCHEDULE_COLUMNS[booking_type][:1]
+    changed = 0
+    for start in range(0, len(schedule_ids), chunk_size):
+        chunk = schedule_ids[start:start + chunk_size]
+        before = {schedule.id: {column: getattr(schedule, column) for column in columns}
+                  for schedule in model.query.filter(model.id.in_(chunk)).with_for_update().populate_existing()}
+        if not before:
+            continue
+        change(model, list(before))
+        for schedule in model.query.filter(model.id.in_(list(before))).populate_existing():
+            changes = {column: [_plain(before[schedule.id][column]), _plain(getattr(schedule, column))]
+                       for column in columns if before[schedule.id][column] != getattr(schedule, column)}
+            if changes:
+                append_event(db.session, 'updated', schedule, changes)
+            sync_availability(db.session, schedule)
+        db.session.commit()
+        changed += len(before)
+    return changed
+
+
+def _result(matched, problems=()):
+    return {'matched': matched, 'problems': list(problems[:MAX_REPORTED_PROBLEMS]), 'problem_count': len(problems)}
+
+
+def count_schedules(booking_type, filters):
+    model = get_schedule_model(booking_type)
+    return db.session.scalar(select(func.count()).select_from(model).where(*_conditions(booking_type, filters)))
+
+
+def reprice(booking_type, filters, percent, travel_classes=TRAVEL_CLASSES, preview=False,
+            chunk_size=BULK_CHUNK_SIZE):
+    """Change the fares of every matching schedule by ``percent`` (-10 is a 10% cut)"""
+    if not math.isfinite(percent):
+        raise BulkError('percent must be a finite number')
+    if percent <= -100:
+        raise BulkError('Fares cannot drop by 100% or more')
+    columns = [price_column(travel_class) for travel_class in travel_classes]
+    if preview:
+        return _result(count_schedules(booking_type, filters))
+
+    schedule_ids = [interval.schedule_id for _, interval in _matching(booking_type, filters)]
+    factor = 1 + percent / 100
+
+    def change(model, ids):
+        db.session.execute(update(model).where(model.id.in_(ids)).values({
+            column: func.round(cast(getattr(model, column) * factor, Numeric), 2) for column in columns
+        }), execution_options=SET_BASED)
+
+    result = _result(len(schedule_ids))
+    result['updated'] = _apply_in_chunks(booking_type, schedule_ids, change, chunk_size)
+    return result
+
+
+def shift_times(booking_type, filters, minutes, preview=False, chunk_size=BULK_CHUNK_SIZE):
+    """Move every matching schedule (and its stops) by ``minutes``, if every
+    affected vehicle's timeline still holds together afterwards"""
+    if abs(minutes) > MAX_SHIFT_MINUTES:
+        raise BulkError(f'Schedules can move by at most {MAX_SHIFT_MINUTES} minutes')
+    delta = timedelta(minutes=minutes)
+    matched = _matching(booking_type, filters)
+    moved = {interval.schedule_id: (vehicle_id, interval._replace(departure_time=interval.departure_time + delta,
+                                                                  arrival_time=interval.arrival_time + delta))
+             for vehicle_id, interval in matched}
+    problems = _timeline_problems(booking_type, {vehicle_id for vehicle_id, _ in matched}, moved)
+    result = _result(len(matched), problems)
+    if preview or problems or not minutes:
+        db.session.rollback()  # releases the vehicle locks
+        return result
+
+    def change(model, ids):
+        db.session.execute(update(model).where(model.id.in_(ids)).values(
+            departure_time=model.departure_time + delta,
+            arrival_time=model.arrival_time + delta
+        ), execution_options=SET_BASED)
+        if booking_type == 'train':
+            db.session.execute(update(TrainStop).where(TrainStop.schedule_id.in_(ids)).values(
+                arrival_time=TrainStop.arrival_time + delta,
+                departure_time=TrainStop.departure_time + delta
+            ), execution_options=SET_BASED)
+
+    result['updated'] = _apply_in_chunks(booking_type, list(moved), change, chunk_size)
+    return result
+
+
+def _reseat_off_vehicle(booking_type, schedules):
+    """Give passengers whose seat does not exist on their schedule's (new)
+    vehicle another seat, or none if the map has no room left for them"""
+    schedules = {schedule.id: schedule for schedule in schedules}
+    seated = db.session.query(Passenger, Booking).join(Booking).filter(
+        Booking.booking_type == booking_type,
+        Booking.schedule_id.in_(list(schedules)),
+        Booking.status == 'confirmed',
+        Passenger.seat_number.isnot(None)
+    ).order_by(Booking.id, Passenger.id)
+    stranded = defaultdict(list)
+    for passenger, booking in seated:
+        index = seat_index(passenger.seat_number)
+        total = total_seats(schedules[booking.schedule_id], booking_type, booking.travel_class)
+        if index is None or index >= total:
+            stranded[booking].append(passenger)
+
+    for booking, passengers in stranded.items():
+        schedule = schedules[booking.schedule_id]
+        legs = journey_legs(schedule, booking_type, booking.board_stop, booking.alight_stop)
+        seats = assign_seats(schedule, booking_type, booking.travel_class, [None] * len(passengers), legs)
+        for passenger, seat in zip(passengers, seats):
+            passenger.seat_number = seat
+        enqueue_eticket_render(booking)
+    return sum(len(passengers) for passengers in stranded.values())
+
+
+def change_vehicle(booking_type, filters, vehicle_id, preview=False, chunk_size=BULK_CHUNK_SIZE):
+    """Run every matching schedule with another train or aircraft.
+
+    Free seat counts follow the new vehicle's capacity and passengers in
+    seats it does not have are seated again; schedules whose confirmed
+    passengers would not fit, and timeline conflicts on the old or new
+    vehicles, are reported instead of changed.
+    """
+    model = get_schedule_model(booking_type)
+    vehicle_model = VEHICLE_MODELS[booking_type]
+    vehicle = db.session.get(vehicle_model, vehicle_id)
+    if vehicle is None:
+        raise BulkError(f'Unknown {booking_type} {vehicle_id}')
+    vehicle_column = getattr(model, SCHEDULE_COLUMNS[booking_type][0])
+
+    matched = _matching(booking_type, filters)
+    moved = {interval.schedule_id: (vehicle_id, interval) for old, interval in matched if old != vehicle_id}
+    problems = _timeline_problems(booking_type, {old for old, _ in matched} | {vehicle_id}, moved)
+
+    def new_seats(travel_class):
+        # Seats free on the new vehicle: its capacity less those booked on the old one
+        old_total = select(getattr(vehicle_model, f'total_seats_{travel_class}')).where(
+            vehicle_model.id == vehicle_column).scalar_subquery()
+        return getattr(model, seat_column(travel_class)) + getattr(vehicle, f'total_seats_{travel_class}') - old_total
+
+    too_small = db.session.scalars(
+        select(model.id)
+        .where(*_conditions(booking_type, filters), vehicle_column != vehicle_id,
+               or_(*[new_seats(travel_class) < 0 for travel_class in TRAVEL_CLASSES]))
+        .order_by(model.id)
+        .limit(MAX_REPORTED_PROBLEMS)
+    ).all()
+    problems += [f'Schedule #{schedule_id}: has more passengers in some class than {booking_type} {vehicle_id} '
+                 f'has seats' for schedule_id in too_small]
+    result = _result(len(matched), problems)
+    if preview or problems:
+        db.session.rollback()
+        return result
+
+    def change(model, ids):
+        db.session.execute(update(model).where(model.id.in_(ids)).values({
+            vehicle_column.key: vehicle_id,
+            **{seat_column(travel_class): new_seats(travel_class) for travel_class in TRAVEL_CLASSES}
+        }), execution_options=SET_BASED)
+        # Seat maps are rebuilt from the passengers for the new seat layout,
+        # after seating those whose seat the new vehicle does not have
+        db.session.execute(delete(SeatMap).where(SeatMap.booking_type == booking_type, SeatMap.schedule_id.in_(ids)),
+                           execution_options=SET_BASED)
+        _reseat_off_vehicle(booking_type, model.query.filter(model.id.in_(ids)).populate_existing())
+
+    result['updated'] = _apply_in_chunks(booking_type, list(moved), change, chunk_size)
+    return result
+
+
+def delete_unused(kind, preview=False, chunk_size=BULK_CHUNK_SIZE):
+    """Delete the trains, flights, stations or airports no schedule refers to"""
+    if kind not in REFERENCE_MODELS:
+        raise BulkError(f'Unknown reference data: {kind}')
+    model = REFERENCE_MODELS[kind]
+    unused = ~or_(*[exists().where(column == model.id) for column in REFERENCES[model]])
+    if preview:
+        return _result(db.session.scalar(select(func.count()).select_from(model).where(unused)))
+
+    deleted = 0
+    last_id = 0
+    while True:
+        ids = db.session.scalars(
+            select(model.id).where(unused, model.id > last_id).order_by(model.id).limit(chunk_size)
+        ).all()
+        if not ids:
+            break
+        # The EXISTS check is repeated so rows referenced meanwhile survive
+        deleted += db.session.execute(delete(model).where(model.id.in_(ids), unused),
+                                      execution_options=SET_BASED).rowcount
+        db.session.commit()
+        last_id = ids[-1]
+    result = _result(deleted)
+    result['updated'] = deleted
+    return result
@@ -0,0 +1,285 @@
+from datetime import date, datetime, timedelta
+import logging
+import threading
+
+from sqlalchemy import event, func, insert, inspect
+from sqlalchemy.orm import Session
+
+from app import app, db
+from models import InventoryEvent, FeedCursor
+from inventory import SCHEDULE_MODELS, TRAVEL_CLASSES
+
+logger = logging.getLogger(__name__)
+
+TRACKED_COLUMNS = (
+    tuple(f'{travel_class}_price' for travel_class in TRAVEL_CLASSES)
+    + tuple(f'available_seats_{travel_class}' for travel_class in TRAVEL_CLASSES)
+    + ('departure_time', 'arrival_time', 'cancelled_at')
+)
+PLACE_COLUMNS = {
+    'train': ('departure_station_id', 'arrival_station_id'),
+    'flight': ('departure_airport_id', 'arrival_airport_id'),
+}
+BOOKING_TYPES = {model: booking_type for booking_type, model in SCHEDULE_MODELS.items()}
+READ_BATCH = 500
+# Seconds a gap in the sequence is waited on before it is taken for a rolled
+# back transaction; far longer than a commit takes after its events are written
+GAP_TIMEOUT = 30
+POLL_INTERVAL = 1.0  # seconds between polls when no commit wakes the dispatcher
+
+_consumers = {}
+_dispatcher = None
+
+
+def _json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def append_event(session, kind, schedule, changes=None):
+    """Queue an event for ``schedule`` on the session's current transaction.
+
+    Flushes of schedule rows do this automatically; code that changes
+    schedules with bulk SQL calls it itself.
+    """
+    booking_type = BOOKING_TYPES[type(schedule)]
+    origin_column, destination_column = PLACE_COLUMNS[booking_type]
+    session.info.setdefault('inventory_events', []).append({
+        'kind': kind,
+        'booking_type': booking_type,
+        'schedule_id': schedule.id,
+        'origin_id': getattr(schedule, origin_column),
+        'destination_id': getattr(schedule, destination_column),
+        'service_date': schedule.departure_time.date() if schedule.departure_time else None,
+        'changes': changes or {},
+    })
+
+
+def _changes(schedule, columns):
+    changes = {}
+    state = inspect(schedule)
+    for column in columns:
+        history = state.attrs[column].history
+        if not history.has_changes():
+            continue
+        old = history.deleted[0] if history.deleted else None
+        new = history.added[0] if history.added else None
+        if old != new:
+            changes[column] = [_json_value(old), _json_value(new)]
+    return changes
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_inventory_changes(session, flush_context):
+    for obj in session.new:
+        if type(obj) in BOOKING_TYPES:
+            columns = TRACKED_COLUMNS + PLACE_COLUMNS[BOOKING_TYPES[type(obj)]]
+            append_event(session, 'created', obj, {column: [None, _json_value(getattr(obj, column))]
+                                                   for column in columns})
+    for obj in session.dirty:
+        if type(obj) in BOOKING_TYPES:
+            changes = _changes(obj, TRACKED_COLUMNS + PLACE_COLUMNS[BOOKING_TYPES[type(obj)]])
+            if changes:
+                append_event(session, 'updated', obj, changes)
+    for obj in session.deleted:
+        if type(obj) in BOOKING_TYPES:
+            append_event(session, 'deleted', obj)
+
+
+@event.listens_for(Session, 'before_commit')
+def _write_inventory_events(session):
+    # Sequences come from a database sequence, so concurrent commits never
+    # wait on each other; they may become visible out of sequence order,
+    # which read_events() makes up for by holding back at gaps
+    session.flush()
+    events = session.info.pop('inventory_events', None)
+    if not events:
+        return
+    now = datetime.utcnow()
+    session.execute(insert(InventoryEvent), [dict(values, created_at=now) for values in events])
+    session.info['inventory_events_written'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_dispatcher_after_commit(session):
+    if session.info.pop('inventory_events_written', False) and _dispatcher is not None:
+        _dispatcher.wake()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_inventory_events(session):
+    session.info.pop('inventory_events', None)
+    session.info.pop('inventory_events_written', None)
+
+
+# Reading the feed
+
+def head_position():
+    """Sequence of the newest committed event"""
+    return db.session.query(func.max(InventoryEvent.sequence)).scalar() or 0
+
+
+def settled_position():
+    """Sequence of the newest event older than GAP_TIMEOUT: no transaction
+    still committing can add an event before it"""
+    cutoff = datetime.utcnow() - timedelta(seconds=GAP_TIMEOUT)
+    return db.session.query(func.max(InventoryEvent.sequence)).filter(
+        InventoryEvent.created_at < cutoff).scalar() or 0
+
+
+def read_events(after=0, limit=READ_BATCH):
+    """Committed events with a sequence above ``after``, oldest first.
+
+    A sequence is taken just before its transaction commits, so a gap may
+    be a transaction that is still committing: reading stops there until
+    the gap fills, or until the events behind it are GAP_TIMEOUT old, when
+    it can only be a rolled back transaction and is skipped.
+    """
+    events = (InventoryEvent.query
+              .filter(InventoryEvent.sequence > after)
+              .order_by(InventoryEvent.sequence)
+              .limit(limit)
+              .all())
+    cutoff = datetime.utcnow() - timedelta(seconds=GAP_TIMEOUT)
+    readable = []
+    expected = after + 1
+    for inventory_event in events:
+        if inventory_event.sequence != expected and inventory_event.created_at > cutoff:
+            break
+        readable.append(inventory_event)
+        expected = inventory_event.sequence + 1
+    return readable
+
+
+def event_to_dict(inventory_event):
+    return {
+        'sequence': inventory_event.sequence,
+        'created_at': inventory_event.created_at.isoformat(),
+        'kind': inventory_event.kind,
+        'booking_type': inventory_event.booking_type,
+        'schedule_id': inventory_event.schedule_id,
+        'origin_id': inventory_event.origin_id,
+        'destination_id': inventory_event.destination_id,
+        'service_date': _json_value(inventory_event.service_date),
+        'changes': inventory_event.changes,
+    }
+
+
+def affected_routes(inventory_event):
+    """(booking_type, origin_id, destination_id, service_date) before and after an event"""
+    origin_column, destination_column = PLACE_COLUMNS[inventory_event.booking_type]
+    routes = set()
+    if inventory_event.service_date is not None:
+        routes.add((inventory_event.booking_type, inventory_event.origin_id, inventory_event.destination_id,
+                    inventory_event.service_date))
+    changes = inventory_event.changes
+    if inventory_event.kind == 'updated' and (
+            origin_column in changes or destination_column in changes or 'departure_time' in changes):
+        departure = changes.get('departure_time', [None])[0]
+        routes.add((
+            inventory_event.booking_type,
+            changes[origin_column][0] if origin_column in changes else inventory_event.origin_id,
+            changes[destination_column][0] if destination_column in changes else inventory_event.destination_id,
+            datetime.fromisoformat(departure).date() if departure else inventory_event.service_date
+        ))
+    return routes
+
+
+def seat_increases(inventory_event):
+    """Travel classes whose free seats went up in an event"""
+    classes = []
+    for travel_class in TRAVEL_CLASSES:
+        old, new = inventory_event.changes.get(f'available_seats_{travel_class}', (None, None))
+        if old is not None and new is not None and new > old:
+            classes.append(travel_class)
+    return classes
+
+
+def consumer(name, durable=False):
+    """Register a function called with each batch of new events.
+
+    Durable consumers keep their position in the feed_cursor table and
+    resume where they stopped; their database writes commit together with
+    the new position, so handlers must not commit themselves. Other
+    consumers (in-memory caches) follow the feed from process start.
+    """
+    def decorator(func):
+        _consumers[name] = (func, durable)
+        return func
+    return decorator
+
+
+def _dispatch_durable(name, handler):
+    # The cursor row lock keeps one process at a time on a consumer
+    cursor = FeedCursor.query.filter_by(name=name).with_for_update(skip_locked=True).first()
+    if cursor is None:
+        if FeedCursor.query.filter_by(name=name).first() is not None:
+            db.session.rollback()
+            return 0  # another process holds it
+        cursor = FeedCursor(name=name, position=0)
+        db.session.add(cursor)
+    events = read_events(cursor.position)
+    if events:
+        handler(events)
+        cursor.position = events[-1].sequence
+    db.session.commit()
+    return len(events)
+
+
+class ChangeFeedDispatcher(threading.Thread):
+    """Hands new inventory events to the registered consumers"""
+
+    def __init__(self):
+        super().__init__(name='change-feed', daemon=True)
+        self._wakeup = threading.Event()
+        self.positions = {}  # in-memory consumers -> last sequence handled
+
+    def wake(self):
+        self._wakeup.set()
+
+    def run(self):
+        # Caches start empty, so events from before the start are merely
+        # handled again; starting from the settled position misses none
+        with app.app_context():
+            try:
+                start = settled_position()
+            finally:
+                db.session.remove()
+        self.positions = {name: start for name, (_, durable) in _consumers.items() if not durable}
+        while True:
+            self._wakeup.wait(POLL_INTERVAL)
+            self._wakeup.clear()
+            self.dispatch()
+
+    def dispatch(self):
+        for name, (handler, durable) in list(_consumers.items()):
+            with app.app_context():
+                try:
+                    while True:
+                        if durable:
+                            handled = _dispatch_durable(name, handler)
+                        else:
+                            if name not in self.positions:
+                                self.positions[name] = settled_position()
+                            events = read_events(self.positions[name])
+                            if events:
+                                handler(events)
+                                self.positions[name] = events[-1].sequence
+                            handled = len(events)
+                        if handled < READ_BATCH:
+                            break
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("Change feed consumer %s failed; retrying on the next poll", name)
+                finally:
+                    db.session.remove()
+
+
+def start_change_feed():
+    """Start the change feed dispatcher once per process"""
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = ChangeFeedDispatcher()
+        _dispatcher.start()
+    return _dispatcher
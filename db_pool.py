@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+# Connection pool sizing per deployment profile (APP_PROFILE). Size the pools
+# so that processes * (pool_size + max_overflow) stays under the database's
+# connection limit; DB_CONNECTION_BUDGET enforces that automatically.
+POOL_PROFILES = {
+    'development': {'pool_size': 5, 'max_overflow': 5, 'pool_timeout': 10, 'pre_ping': 'always'},
+    'production': {'pool_size': 10, 'max_overflow': 10, 'pool_timeout': 5, 'pre_ping': 'recent'},
+    'worker': {'pool_size': 4, 'max_overflow': 2, 'pool_timeout': 30, 'pre_ping': 'recent'},
+}
+PING_INTERVAL = 30  # seconds a connection counts as validated in 'recent' pre-ping mode
+SLOW_CHECKOUT = 0.1  # seconds; checkouts waiting longer than this are counted
+
+
+class PoolStats:
+    """Counters for one engine's connection pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.ping_failures = 0
+        self.timeouts = 0
+        self.slow_checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.peak_checked_out = 0
+
+    def record_checkout(self, wait, checked_out):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            if wait > SLOW_CHECKOUT:
+                self.slow_checkouts += 1
+            self.peak_checked_out = max(self.peak_checked_out, checked_out)
+
+    def increment(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def snapshot(self, pool):
+        with self._lock:
+            return {
+                'pool_size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'checked_in': pool.checkedin(),
+                'overflow': pool.overflow(),
+                'peak_checked_out': self.peak_checked_out,
+                'checkouts': self.checkouts,
+                'avg_wait_ms': round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0,
+                'max_wait_ms': round(self.wait_max * 1000, 3),
+                'slow_checkouts': self.slow_checkouts,
+                'timeouts': self.timeouts,
+                'connects': self.connects,
+                'invalidations': self.invalidations,
+                'ping_failures': self.ping_failures,
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records checkout waits and connection churn.
+
+    With ``ping_interval`` set, a connection is pinged on checkout if it has
+    not been used or validated within that many seconds (0 pings on every
+    checkout, like ``pool_pre_ping``); failed pings are counted either way.
+    """
+
+    ping_interval = None
+
+    def __init__(self, *args, **kwargs):
+        recreated = '_dispatch' in kwargs
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+        if not recreated:  # recreate() copies the listeners along with the dispatch
+            event.listen(self, 'connect', self._on_connect)
+            event.listen(self, 'checkin', self._on_checkin)
+            event.listen(self, 'invalidate', self._on_invalidate)
+            if self.ping_interval is not None:
+                event.listen(self, 'checkout', self._on_checkout)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            record = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.increment('timeouts')
+            raise
+        self.stats.record_checkout(time.perf_counter() - start, self.checkedout())
+        return record
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        self.stats.increment('connects')
+        connection_record.info['validated_at'] = time.monotonic()
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        if dbapi_connection is not None:
+            connection_record.info['validated_at'] = time.monotonic()
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        self.stats.increment('invalidations')
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        now = time.monotonic()
+        if now - connection_record.info.get('validated_at', 0) < self.ping_interval:
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        except Exception:
+            self.stats.increment('ping_failures')
+            # The pool discards this connection and retries with a fresh one
+            raise exc.DisconnectionError()
+        finally:
+            cursor.close()
+        connection_record.info['validated_at'] = now
+
+
+def engine_options(profile):
+    """SQLALCHEMY_ENGINE_OPTIONS for a deployment profile.
+
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT and DB_PRE_PING
+    ('always', 'recent' or 'off') override the profile. If
+    DB_CONNECTION_BUDGET is set, pools are shrunk so that WEB_CONCURRENCY
+    processes together stay within it.
+    """
+    settings = dict(POOL_PROFILES.get(profile, POOL_PROFILES['development']))
+    pool_size = int(os.environ.get('DB_POOL_SIZE', settings['pool_size']))
+    max_overflow = int(os.environ.get('DB_MAX_OVERFLOW', settings['max_overflow']))
+    pool_timeout = float(os.environ.get('DB_POOL_TIMEOUT', settings['pool_timeout']))
+    pre_ping = os.environ.get('DB_PRE_PING', settings['pre_ping'])
+
+    budget = os.environ.get('DB_CONNECTION_BUDGET')
+    if budget:
+        per_process = max(1, int(budget) // max(1, int(os.environ.get('WEB_CONCURRENCY', 1))))
+        pool_size = min(pool_size, per_process)
+        max_overflow = min(max_overflow, per_process - pool_size)
+
+    # The pool pings itself rather than through pool_pre_ping, so that
+    # failed pings are counted in both modes
+    poolclass = InstrumentedQueuePool
+    ping_interval = {'always': 0, 'recent': PING_INTERVAL}.get(pre_ping)
+    if ping_interval is not None:
+        poolclass = type('InstrumentedQueuePool', (InstrumentedQueuePool,), {'ping_interval': ping_interval})
+
+    return {
+        'poolclass': poolclass,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        'pool_recycle': 300,
+    }
+
+
+def pool_stats(engines):
+    """Per-bind pool statistics for the admin metrics endpoint"""
+    stats = {}
+    for key, engine in engines.items():
+        pool = engine.pool
+        if isinstance(pool, InstrumentedQueuePool):
+            stats[key or 'primary'] = pool.stats.snapshot(pool)
+    return stats
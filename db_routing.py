@@ -0,0 +1,103 @@
+from functools import wraps
+import logging
+import random
+import threading
+import time
+
+from flask import current_app, g, has_app_context, has_request_context, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+from sqlalchemy.sql import Select
+
+logger = logging.getLogger(__name__)
+
+REPLICA_BIND_PREFIX = 'replica_'
+LAG_CHECK_INTERVAL = 5  # seconds a replica health result is reused
+STICKY_SESSION_KEY = '_db_primary_until'
+
+# How far behind the primary a replica is, 0 when caught up (PostgreSQL)
+LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+_health = {}  # bind key -> (checked_at, healthy)
+_health_lock = threading.Lock()
+
+
+class RoutingSession(Session):
+    """Session that sends plain SELECTs to the replica chosen for the request.
+
+    Flushes, locking reads and raw SQL always go to the primary, and nothing
+    is routed outside a request marked with @read_only.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context():
+            replica = g.get('db_replica')
+            if replica is not None and isinstance(clause, Select) and clause._for_update_arg is None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _remember_write(session, flush_context):
+    if has_request_context():
+        g.db_wrote = True
+
+
+def _replica_lag(engine):
+    if engine.dialect.name != 'postgresql':
+        return 0
+    with engine.connect() as conn:
+        return conn.execute(LAG_QUERY).scalar() or 0
+
+
+def replica_is_healthy(key, engine):
+    """Whether a replica is reachable and within DB_MAX_REPLICA_LAG seconds"""
+    now = time.monotonic()
+    with _health_lock:
+        checked = _health.get(key)
+        if checked is not None and now - checked[0] < LAG_CHECK_INTERVAL:
+            return checked[1]
+    try:
+        healthy = _replica_lag(engine) <= current_app.config.get('DB_MAX_REPLICA_LAG', 5)
+    except Exception:
+        logger.warning("Replica %s is unavailable, reading from the primary", key, exc_info=True)
+        healthy = False
+    with _health_lock:
+        _health[key] = (now, healthy)
+    return healthy
+
+
+def choose_replica():
+    db = current_app.extensions['sqlalchemy']
+    candidates = [(key, engine) for key, engine in db.engines.items()
+                  if key and key.startswith(REPLICA_BIND_PREFIX)]
+    healthy = [engine for key, engine in candidates if replica_is_healthy(key, engine)]
+    return random.choice(healthy) if healthy else None
+
+
+def is_sticky():
+    """True while the user's own recent writes may not have replicated yet"""
+    return session.get(STICKY_SESSION_KEY, 0) > time.time()
+
+
+def read_only(view):
+    """Serve a view's reads from a replica when one is healthy and the user
+    has not written anything in the last DB_STICKY_SECONDS."""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not is_sticky():
+            g.db_replica = choose_replica()
+        return view(*args, **kwargs)
+    return wrapped
+
+
+def init_app(app):
+    @app.after_request
+    def stick_to_primary_after_write(response):
+        # Read-your-writes: pin this user's reads to the primary for a while
+        if g.get('db_wrote'):
+            session[STICKY_SESSION_KEY] = time.time() + app.config.get('DB_STICKY_SECONDS', 5)
+        return response
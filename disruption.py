@@ -0,0 +1,261 @@
+from collections import Counter
+from datetime import datetime, timedelta
+import logging
+import sys
+
+from sqlalchemy import case, update
+from sqlalchemy.orm import selectinload
+
+from app import app, db
+from models import Booking, Disruption, ETicket, WaitlistEntry
+from inventory import (
+    TRAVEL_CLASSES, InventoryError, get_available_seats, get_schedule_model, lock_schedule, lock_schedules,
+    reserve_seats
+)
+from jobs import job, enqueue_job
+from notifications import enqueue_booking_notification
+from eticket import enqueue_eticket_render
+from seating import assign_seats, load_seat_maps
+from timeline import SCHEDULE_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+REBOOK_BATCH_SIZE = 500  # bookings per transaction
+ALTERNATIVE_WINDOW = timedelta(hours=48)  # how long after the cancelled departure an alternative may leave
+MAX_ALTERNATIVES = 10  # per journey, earliest first
+# Classes a passenger may be moved into, best match first; never a downgrade
+CLASS_FALLBACKS = {
+    'economy': ('economy', 'business', 'first'),
+    'business': ('business', 'first'),
+    'first': ('first',),
+}
+# Served first: the higher class, then passengers with onward connections, then by booking order
+CLASS_PRIORITY = {travel_class: rank for rank, travel_class in enumerate(reversed(TRAVEL_CLASSES))}
+
+
+def cancel_schedule(booking_type, schedule_id, reason=None):
+    """Cancel a service and queue the rebooking of its passengers.
+
+    The schedule leaves search at once and takes no new bookings; its
+    waitlist is closed. Returns the Disruption, committed.
+    """
+    schedule = lock_schedule(booking_type, schedule_id)
+    if schedule.cancelled_at is not None:
+        raise InventoryError(f'{booking_type.capitalize()} schedule {schedule_id} is already cancelled')
+    schedule.cancelled_at = datetime.utcnow()
+    WaitlistEntry.query.filter_by(booking_type=booking_type, schedule_id=schedule.id, status='waiting') \
+        .update({'status': 'cancelled'}, synchronize_session=False)
+
+    disruption = Disruption(booking_type=booking_type, schedule_id=schedule.id, reason=reason,
+                            summary={'alternatives': {}, 'unaccommodated': []})
+    db.session.add(disruption)
+    db.session.flush()
+    enqueue_job('rebook_disruption', {'disruption_id': disruption.id})
+    db.session.commit()
+    return disruption
+
+
+def _journey(schedule, booking_type, booking):
+    """(origin_id, destination_id, departure_time) a booking actually travels"""
+    if booking.board_stop is not None:
+        board, alight = schedule.stops[booking.board_stop], schedule.stops[booking.alight_stop]
+        return board.station_id, alight.station_id, board.departure_time
+    _, origin_column, destination_column = SCHEDULE_COLUMNS[booking_type]
+    return getattr(schedule, origin_column), getattr(schedule, destination_column), schedule.departure_time
+
+
+def find_alternatives(booking_type, origin_id, destination_id, departure_time, exclude_id=None):
+    """Ids of running services on the same route leaving within
+    ALTERNATIVE_WINDOW of ``departure_time``, earliest first"""
+    model = get_schedule_model(booking_type)
+    _, origin_column, destination_column = SCHEDULE_COLUMNS[booking_type]
+    return [row.id for row in db.session.query(model.id).filter(
+        getattr(model, origin_column) == origin_id,
+        getattr(model, destination_column) == destination_id,
+        model.departure_time >= departure_time,
+        model.departure_time < departure_time + ALTERNATIVE_WINDOW,
+        model.cancelled_at.is_(None),
+        model.id != exclude_id
+    ).order_by(model.departure_time).limit(MAX_ALTERNATIVES)]
+
+
+def _connection_windows(bookings):
+    """{booking id: (not_before, not_after)} for bookings that are one segment
+    of an itinerary: a replacement must still fit between its neighbours"""
+    itinerary_ids = {booking.itinerary_id for booking in bookings if booking.itinerary_id is not None}
+    if not itinerary_ids:
+        return {}
+    segments = {}
+    for segment in Booking.query.filter(Booking.itinerary_id.in_(itinerary_ids), Booking.status == 'confirmed'):
+        schedule = segment.schedule
+        segments.setdefault(segment.itinerary_id, []).append((schedule.departure_time, schedule.arrival_time,
+                                                               segment.id))
+    windows = {}
+    for booking in bookings:
+        if booking.itinerary_id is None:
+            continue
+        others = [segment for segment in segments.get(booking.itinerary_id, []) if segment[2] != booking.id]
+        own_departure = booking.schedule.departure_time
+        earlier = [arrival for departure, arrival, _ in others if departure < own_departure]
+        later = [departure for departure, _, _ in others if departure >= own_departure]
+        windows[booking.id] = (max(earlier, default=None), min(later, default=None))
+    return windows
+
+
+def _fits(schedule, window):
+    if window is None:
+        return True
+    not_before, not_after = window
+    return ((not_before is None or schedule.departure_time >= not_before)
+            and (not_after is None or schedule.arrival_time <= not_after))
+
+
+def rebook_batch(disruption, batch_size=REBOOK_BATCH_SIZE):
+    """Move the next batch of the cancelled service's bookings, highest
+    priority first, in one transaction; returns the bookings handled.
+
+    Handled bookings leave the cancelled schedule (moved or cancelled), so
+    an interrupted run resumes with whatever is still on it.
+    """
+    booking_type = disruption.booking_type
+    cancelled = db.session.get(get_schedule_model(booking_type), disruption.schedule_id)
+    bookings = (Booking.query
+                .options(selectinload(Booking.passengers))
+                .filter_by(booking_type=booking_type, schedule_id=disruption.schedule_id, status='confirmed')
+                .order_by(case(CLASS_PRIORITY, value=Booking.travel_class, else_=len(CLASS_PRIORITY)),
+                          Booking.itinerary_id.is_(None), Booking.id)
+                .limit(batch_size)
+                .with_for_update(of=Booking)
+                .all())
+    if not bookings:
+        return 0
+
+    journeys = {booking.id: _journey(cancelled, booking_type, booking) for booking in bookings}
+    alternatives = {journey: find_alternatives(booking_type, *journey, exclude_id=cancelled.id)
+                    for journey in set(journeys.values())}
+    schedules = lock_schedules((booking_type, schedule_id)
+                               for schedule_ids in alternatives.values() for schedule_id in schedule_ids)
+    windows = _connection_windows(bookings)
+    seat_maps = {}
+    moved = Counter()
+    summary = dict(disruption.summary or {})
+    unaccommodated = list(summary.get('unaccommodated', []))
+    fk_column = f'{booking_type}_schedule_id'
+
+    for booking in bookings:
+        party = len(booking.passengers)
+        placement = None
+        for schedule_id in alternatives[journeys[booking.id]]:
+            schedule = schedules[(booking_type, schedule_id)]
+            if not _fits(schedule, windows.get(booking.id)):
+                continue
+            travel_class = next((travel_class for travel_class in CLASS_FALLBACKS[booking.travel_class]
+                                 if get_available_seats(schedule, travel_class) >= party), None)
+            if travel_class is not None:
+                placement = (schedule, travel_class)
+                break
+
+        if placement is None:
+            booking.status = 'cancelled'
+            unaccommodated.append(booking.id)
+            disruption.bookings_cancelled += 1
+            enqueue_booking_notification(booking, 'disrupted')
+            enqueue_eticket_render(booking)
+            continue
+
+        schedule, travel_class = placement
+        reserve_seats(schedule, travel_class, party)
+        key = (schedule.id, travel_class)
+        if key not in seat_maps:
+            seat_maps[key] = load_seat_maps(schedule, booking_type, travel_class)
+        seats = assign_seats(schedule, booking_type, travel_class, [None] * party, maps=seat_maps[key])
+        for passenger, seat in zip(booking.passengers, seats):
+            passenger.seat_number = seat
+        if travel_class != booking.travel_class:
+            disruption.bookings_upgraded += 1
+        booking.schedule_id = schedule.id
+        setattr(booking, fk_column, schedule.id)
+        booking.travel_class = travel_class
+        booking.board_stop = booking.alight_stop = None
+        moved[str(schedule.id)] += 1
+        disruption.bookings_rebooked += 1
+        disruption.passengers_rebooked += party
+        enqueue_booking_notification(booking, 'rebooked')
+        enqueue_eticket_render(booking)
+
+    # Tickets of moved bookings name the old service until they are re-rendered
+    db.session.execute(update(ETicket)
+                       .where(ETicket.booking_id.in_([booking.id for booking in bookings]))
+                       .values(booking_status='stale'),
+                       execution_options={'synchronize_session': False})
+    alternatives_used = Counter(summary.get('alternatives', {}))
+    alternatives_used.update(moved)
+    disruption.summary = dict(summary, alternatives=dict(alternatives_used), unaccommodated=unaccommodated)
+    db.session.commit()
+    return len(bookings)
+
+
+@job('rebook_disruption')
+def rebook_disruption(disruption_id, batch_size=REBOOK_BATCH_SIZE):
+    """Rebook batch after batch until the cancelled service is empty"""
+    while True:
+        disruption = db.session.get(Disruption, disruption_id)
+        if disruption is None or disruption.status == 'done':
+            return
+        try:
+            handled = rebook_batch(disruption, batch_size)
+        except Exception:
+            db.session.rollback()
+            raise
+        if handled < batch_size:
+            break
+    disruption = db.session.get(Disruption, disruption_id)
+    disruption.status = 'done'
+    disruption.finished_at = datetime.utcnow()
+    db.session.commit()
+    logger.info("Disruption #%s: %s bookings rebooked, %s cancelled", disruption.id,
+                disruption.bookings_rebooked, disruption.bookings_cancelled)
+
+
+def disruption_report(disruption):
+    summary = disruption.summary or {}
+    return {
+        'id': disruption.id,
+        'booking_type': disruption.booking_type,
+        'schedule_id': disruption.schedule_id,
+        'reason': disruption.reason,
+        'status': disruption.status,
+        'created_at': disruption.created_at.isoformat(),
+        'finished_at': disruption.finished_at.isoformat() if disruption.finished_at else None,
+        'bookings_rebooked': disruption.bookings_rebooked,
+        'passengers_rebooked': disruption.passengers_rebooked,
+        'bookings_upgraded': disruption.bookings_upgraded,
+        'bookings_cancelled': disruption.bookings_cancelled,
+        'bookings_remaining': Booking.query.filter_by(booking_type=disruption.booking_type,
+                                                      schedule_id=disruption.schedule_id,
+                                                      status='confirmed').count(),
+        'alternatives': summary.get('alternatives', {}),
+        'unaccommodated': summary.get('unaccommodated', []),
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in SCHEDULE_COLUMNS:
+        print("Usage: python disruption.py train|flight SCHEDULE_ID [REASON]")
+        sys.exit(1)
+    with app.app_context():
+        booking_type, schedule_id = sys.argv[1], int(sys.argv[2])
+        # Re-running for an already cancelled service resumes its rebooking
+        disruption = Disruption.query.filter_by(booking_type=booking_type, schedule_id=schedule_id) \
+            .order_by(Disruption.id.desc()).first()
+        if disruption is None:
+            try:
+                disruption = cancel_schedule(booking_type, schedule_id, ' '.join(sys.argv[3:]) or None)
+            except InventoryError as e:
+                db.session.rollback()
+                print(e)
+                sys.exit(1)
+        rebook_disruption(disruption.id)
+        report = disruption_report(db.session.get(Disruption, disruption.id))
+        print(f"{report['bookings_rebooked']} bookings ({report['passengers_rebooked']} passengers) rebooked, "
+              f"{report['bookings_upgraded']} of them upgraded; {report['bookings_cancelled']} cancelled")
@@ -0,0 +1,219 @@
+from datetime import datetime
+import hashlib
+import hmac
+import os
+import re
+import tempfile
+
+from flask import render_template, url_for, send_file
+
+from app import app, db
+from models import Booking, ETicket, booking_schedule_options
+from jobs import job, enqueue_job
+
+ARTIFACT_TYPES = {
+    'html': 'text/html',
+    'pdf': 'application/pdf',
+    'txt': 'text/plain',
+}
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+ARTIFACT_MAX_AGE = 365 * 24 * 3600  # content-addressed, so it never changes
+
+
+def artifact_path(digest, ext):
+    return os.path.join(app.config['TICKET_STORAGE_DIR'], digest[:2], f'{digest}.{ext}')
+
+
+def store_artifact(content, ext):
+    """Write ``content`` under its SHA-256 and return the digest"""
+    digest = hashlib.sha256(content).hexdigest()
+    path = artifact_path(digest, ext)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, path)  # readers never see a half-written file
+    return digest
+
+
+def remove_artifact(digest, ext):
+    try:
+        os.remove(artifact_path(digest, ext))
+    except FileNotFoundError:
+        pass
+
+
+def qr_payload(booking):
+    """Compact, signed string a gate scanner can verify offline"""
+    journey = f'{booking.booking_type[0].upper()}{booking.schedule_id}'
+    if booking.board_stop is not None:
+        journey += f':{booking.board_stop}-{booking.alight_stop}'
+    body = (f'GV1|{booking.id}|{journey}'
+            f'|{booking.travel_class[0].upper()}|{len(booking.passengers)}|{booking.status[0].upper()}')
+    signature = hmac.new(app.secret_key.encode(), body.encode(), hashlib.sha256).hexdigest()[:16]
+    return f'{body}|{signature}'
+
+
+def _pdf_text(value):
+    value = str(value).encode('latin-1', 'replace').decode('latin-1')
+    return value.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def render_pdf(lines):
+    """Build a single-page, text-only A4 PDF without third-party libraries"""
+    stream = ['BT', '/F1 12 Tf', '16 TL', '56 780 Td']
+    for i, line in enumerate(lines):
+        if i == 0:
+            stream.extend(['/F1 18 Tf', f'({_pdf_text(line)}) Tj', '/F1 12 Tf', 'T* T*'])
+        else:
+            stream.append(f'({_pdf_text(line)}) \'')
+    stream.append('ET')
+    content = '\n'.join(stream).encode('latin-1')
+
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+        b'/Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>',
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>',
+        b'<< /Length ' + str(len(content)).encode() + b' >>\nstream\n' + content + b'\nendstream',
+    ]
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f'{number} 0 obj\n'.encode() + body + b'\nendobj\n'
+    xref = len(out)
+    out += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    for offset in offsets:
+        out += f'{offset:010d} 00000 n \n'.encode()
+    out += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode()
+    return bytes(out)
+
+
+def ticket_lines(booking, schedule, payload):
+    departure_time, arrival_time = schedule.departure_time, schedule.arrival_time
+    if booking.booking_type == 'train':
+        carrier = f'{schedule.train.name} ({schedule.train.number})'
+        board, alight = schedule.departure_station, schedule.arrival_station
+        journey = booking.journey_stops
+        if journey:
+            board, alight = journey[0].station, journey[1].station
+            departure_time, arrival_time = journey[0].departure_time, journey[1].arrival_time
+        origin = f'{board.name} ({board.code})'
+        destination = f'{alight.name} ({alight.code})'
+    else:
+        carrier = f'{schedule.flight.airline} {schedule.flight.flight_number}'
+        origin = f'{schedule.departure_airport.name} ({schedule.departure_airport.code})'
+        destination = f'{schedule.arrival_airport.name} ({schedule.arrival_airport.code})'
+
+    lines = [
+        f'GoVoyage e-ticket - Booking #{booking.id}',
+        f'Status: {booking.status.capitalize()}',
+        f'{booking.booking_type.capitalize()}: {carrier}',
+        f'From: {origin}',
+        f'To: {destination}',
+        f'Departure: {departure_time.strftime("%B %d, %Y %H:%M")}',
+        f'Arrival: {arrival_time.strftime("%B %d, %Y %H:%M")}',
+        f'Class: {booking.travel_class.capitalize()}',
+        f'Total amount: ${booking.total_amount:.2f}',
+        '',
+        'Passengers:',
+    ]
+    for passenger in booking.passengers:
+        lines.append(f'  {passenger.first_name} {passenger.last_name}, {passenger.age}'
+                     f' - seat {passenger.seat_number or "unassigned"}')
+    lines.extend(['', f'Scan code: {payload}'])
+    return lines
+
+
+def enqueue_eticket_render(booking):
+    """Queue (re)generation of a booking's artifacts with the booking change"""
+    enqueue_job('render_eticket', {'booking_id': booking.id})
+
+
+@job('render_eticket')
+def render_eticket(booking_id):
+    booking = Booking.query.options(*booking_schedule_options()).filter_by(id=booking_id).first()
+    if booking is None:
+        return
+    schedule = booking.schedule
+    if schedule is None:
+        return
+
+    payload = qr_payload(booking)
+    pdf_digest = store_artifact(render_pdf(ticket_lines(booking, schedule, payload)), 'pdf')
+    qr_digest = store_artifact(payload.encode(), 'txt')
+    # Jobs run outside a request, so build links in a throwaway one
+    with app.test_request_context():
+        html = render_template(
+            'bookings/eticket.html',
+            booking=booking,
+            schedule=schedule,
+            qr_payload=payload,
+            pdf_url=url_for('eticket_artifact', booking_id=booking.id, digest=pdf_digest, ext='pdf'),
+            qr_url=url_for('eticket_artifact', booking_id=booking.id, digest=qr_digest, ext='txt')
+        )
+    html_digest = store_artifact(html.encode('utf-8'), 'html')
+
+    eticket = booking.eticket or ETicket(booking_id=booking.id)
+    stale = [(getattr(eticket, f'{kind}_digest'), ext)
+             for kind, ext in (('html', 'html'), ('pdf', 'pdf'), ('qr', 'txt'))]
+    eticket.booking_status = booking.status
+    eticket.html_digest = html_digest
+    eticket.pdf_digest = pdf_digest
+    eticket.qr_digest = qr_digest
+    eticket.qr_payload = payload
+    eticket.generated_at = datetime.utcnow()
+    db.session.add(eticket)
+    db.session.commit()
+
+    current = {html_digest, pdf_digest, qr_digest}
+    for digest, ext in stale:
+        if digest and digest not in current:
+            remove_artifact(digest, ext)
+
+
+def current_eticket(booking):
+    """The booking's artifacts if they reflect its current state"""
+    eticket = booking.eticket
+    if eticket is None or eticket.booking_status != booking.status:
+        return None
+    # The payload covers the journey too, so tickets rendered in an older
+    # format count as stale until they are re-rendered
+    if eticket.qr_payload != qr_payload(booking):
+        return None
+    return eticket
+
+
+def enqueue_stale_eticket_renders():
+    """Queue a re-render of every sub-journey e-ticket that is out of date"""
+    bookings = Booking.query.join(ETicket).options(*booking_schedule_options()) \
+        .filter(Booking.board_stop.isnot(None)).all()
+    stale = [booking for booking in bookings if current_eticket(booking) is None]
+    for booking in stale:
+        enqueue_eticket_render(booking)
+    db.session.commit()
+    return len(stale)
+
+
+def send_artifact(digest, ext):
+    """Serve a stored artifact; its URL is content-addressed, so it is
+    cached for a year and revalidated against the digest as ETag"""
+    response = send_file(
+        artifact_path(digest, ext),
+        mimetype=ARTIFACT_TYPES[ext],
+        etag=digest,
+        conditional=True,
+        max_age=ARTIFACT_MAX_AGE
+    )
+    response.cache_control.private = True
+    response.cache_control.public = False
+    response.cache_control.immutable = True
+    return response
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        print(f"Queued {enqueue_stale_eticket_renders()} e-ticket re-renders")
@@ -0,0 +1,137 @@
+from collections import OrderedDict
+from datetime import date, timedelta
+import calendar
+import threading
+import time
+
+from sqlalchemy import case, event, func
+from sqlalchemy.orm import Session
+
+from app import db
+from models import RouteAvailability
+from inventory import TRAVEL_CLASSES, price_column, seat_column
+from availability import PLACE_MODELS, match_places
+from changefeed import consumer, affected_routes
+
+CACHE_TTL = 300  # seconds; bounds staleness from writes committed by other processes
+CACHE_MAX_ENTRIES = 1024
+
+_cache = OrderedDict()  # (type, origins, destinations, class, year, month) -> (stored_at, days)
+_cache_lock = threading.Lock()
+_invalidations = 0
+
+
+def month_window(year, month):
+    """First day of the month and first day of the next one"""
+    start = date(year, month, 1)
+    return start, start + timedelta(days=calendar.monthrange(year, month)[1])
+
+
+def query_fare_calendar(booking_type, origin_ids, destination_ids, travel_class, start, end):
+    """Cheapest bookable fare, seats left and departures per day, in one grouped query"""
+    price = getattr(RouteAvailability, price_column(travel_class))
+    seats = getattr(RouteAvailability, seat_column(travel_class))
+    rows = db.session.query(
+        RouteAvailability.service_date,
+        func.min(case((seats > 0, price))).label('min_price'),
+        func.sum(seats).label('seats'),
+        func.count().label('departures')
+    ).filter(
+        RouteAvailability.booking_type == booking_type,
+        RouteAvailability.origin_id.in_(origin_ids),
+        RouteAvailability.destination_id.in_(destination_ids),
+        RouteAvailability.service_date >= start,
+        RouteAvailability.service_date < end
+    ).group_by(RouteAvailability.service_date)
+    return {
+        row.service_date: {'min_price': row.min_price, 'seats': int(row.seats or 0), 'departures': row.departures}
+        for row in rows
+    }
+
+
+def fare_calendar(booking_type, origin_ids, destination_ids, travel_class, year, month):
+    """Per-day fares for a route and month, served from a cache invalidated on change.
+
+    Returns a dict keyed by date; days without departures are left out.
+    """
+    key = (booking_type, tuple(sorted(origin_ids)), tuple(sorted(destination_ids)), travel_class, year, month)
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None and now - cached[0] < CACHE_TTL:
+            _cache.move_to_end(key)
+            return cached[1]
+        generation = _invalidations
+
+    days = query_fare_calendar(booking_type, origin_ids, destination_ids, travel_class, *month_window(year, month))
+
+    with _cache_lock:
+        # Skip caching if a commit invalidated entries while we were querying
+        if generation == _invalidations:
+            _cache[key] = (now, days)
+            _cache.move_to_end(key)
+            while len(_cache) > CACHE_MAX_ENTRIES:
+                _cache.popitem(last=False)
+    return days
+
+
+def route_fare_calendar(booking_type, source, destination, travel_class, month):
+    """Fare calendar for a searched route and a 'YYYY-MM' month.
+
+    Returns ``(first_day, days)`` where ``days`` lists every day of the month
+    with its cheapest fare (None when sold out or not served). Raises
+    ValueError for invalid input.
+    """
+    if booking_type not in PLACE_MODELS:
+        raise ValueError('Unknown travel type')
+    if travel_class not in TRAVEL_CLASSES:
+        raise ValueError('Unknown travel class')
+    if not source or not destination:
+        raise ValueError('Origin and destination are required')
+    try:
+        year, month = (int(part) for part in month.split('-'))
+        start, end = month_window(year, month)
+    except (AttributeError, ValueError):
+        raise ValueError('Month must be given as YYYY-MM')
+
+    fares = fare_calendar(booking_type, match_places(booking_type, source),
+                          match_places(booking_type, destination), travel_class, year, month)
+    days = []
+    day = start
+    while day < end:
+        fare = fares.get(day, {'min_price': None, 'seats': 0, 'departures': 0})
+        days.append(dict(fare, date=day))
+        day += timedelta(days=1)
+    return start, days
+
+
+def invalidate_fare_calendars(changes):
+    """Drop cached months covering any of the (type, origin, destination, date) changes"""
+    global _invalidations
+    with _cache_lock:
+        _invalidations += 1
+        for key in list(_cache):
+            booking_type, origin_ids, destination_ids, _, year, month = key
+            for changed_type, origin_id, destination_id, service_date in changes:
+                if (changed_type == booking_type and origin_id in origin_ids and destination_id in destination_ids
+                        and (service_date.year, service_date.month) == (year, month)):
+                    del _cache[key]
+                    break
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    changes = session.info.pop('availability_changes', None)
+    if changes:
+        invalidate_fare_calendars(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('availability_changes', None)
+
+
+@consumer('fare_calendars')
+def _invalidate_from_feed(events):
+    # Picks up commits made by other processes
+    invalidate_fare_calendars({route for inventory_event in events for route in affected_routes(inventory_event)})
@@ -1,6 +1,7 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField, SelectField, DateField, IntegerField, FloatField, RadioField, TextAreaField, HiddenField
 from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError, Optional
+from wtforms.widgets import HiddenInput
 from datetime import datetime
 from models import User
 from wtforms.fields import DateTimeField
@@ -42,6 +43,8 @@ class SearchForm(FlaskForm):
     departure_date = DateField('Departure Date', format='%Y-%m-%d', validators=[DataRequired()])
     travel_class = SelectField('Class', choices=[('economy', 'Economy'), ('business', 'Business'), ('first', 'First Class')], default='economy')
     passengers = IntegerField('Passengers', default=1, validators=[DataRequired()])
+    flexible_days = SelectField('Flexible Dates', choices=[(0, 'Exact date'), (1, '± 1 day'), (2, '± 2 days'), (3, '± 3 days')], default=0, coerce=int)
+    sort = SelectField('Sort By', choices=[('departure', 'Departure time'), ('price', 'Price'), ('duration', 'Duration')], default='departure')
     submit = SubmitField('Search')
 
 
@@ -66,6 +69,10 @@ class BookingForm(FlaskForm):
     booking_type = HiddenField('Booking Type', validators=[DataRequired()])
     travel_class = HiddenField('Travel Class', validators=[DataRequired()])
     passengers = HiddenField('Number of Passengers', validators=[DataRequired()])
+    idempotency_key = HiddenField('Idempotency Key', validators=[Optional(), Length(max=64)])
+    board_stop = IntegerField('Boarding Stop', widget=HiddenInput(), validators=[Optional()])  # sub-journeys only
+    alight_stop = IntegerField('Alighting Stop', widget=HiddenInput(), validators=[Optional()])
+    join_waitlist = BooleanField('Join the waitlist if there are not enough seats')
     submit = SubmitField('Confirm Booking')
 
 
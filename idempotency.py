@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+import uuid
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import IdempotencyKey, WaitlistEntry
+
+# How long a replayed /book POST is answered from the stored key
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+PURGE_BATCH_SIZE = 1000
+
+
+def new_idempotency_key():
+    """Generate a fresh key to embed in a booking form"""
+    return uuid.uuid4().hex
+
+
+def find_idempotency_key(user_id, key):
+    return IdempotencyKey.query.filter_by(user_id=user_id, key=key).first()
+
+
+def claim_idempotency_key(user_id, key):
+    """Insert the key inside the current transaction.
+
+    The row is flushed straight away so a concurrent replay blocks on the
+    unique constraint instead of doing the booking work a second time.
+    Returns the new row, or None if the key has already been claimed (the
+    session is rolled back in that case).
+    """
+    record = IdempotencyKey(
+        user_id=user_id,
+        key=key,
+        expires_at=datetime.utcnow() + IDEMPOTENCY_KEY_TTL
+    )
+    db.session.add(record)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    return record
+
+
+def _answers_nothing(record):
+    # A key whose waitlist entry has since been deleted has no outcome to replay
+    return (record.booking_id is None and record.waitlist_entry_id is not None
+            and db.session.get(WaitlistEntry, record.waitlist_entry_id) is None)
+
+
+def begin_idempotent_request(user_id, key):
+    """Resolve a client key at the start of a booking request.
+
+    Returns ``(existing, claimed)``: ``existing`` is the committed key of an
+    earlier request that already produced a booking, ``claimed`` is the new
+    key row to attach the booking to before committing. At most one of the
+    two is set; both are None when no key was sent.
+    """
+    if not key:
+        return None, None
+    existing = find_idempotency_key(user_id, key)
+    if existing is not None and _answers_nothing(existing):
+        # Treated like an expired key: the request is served afresh
+        db.session.delete(existing)
+        db.session.flush()
+        existing = None
+    if existing is not None:
+        return existing, None
+    claimed = claim_idempotency_key(user_id, key)
+    if claimed is None:  # a concurrent replay committed first
+        return find_idempotency_key(user_id, key), None
+    return None, claimed
+
+
+def purge_expired_idempotency_keys(batch_size=PURGE_BATCH_SIZE):
+    """Delete expired keys in short batches and return how many were removed"""
+    now = datetime.utcnow()
+    purged = 0
+    while True:
+        ids = [row.id for row in db.session.query(IdempotencyKey.id)
+               .filter(IdempotencyKey.expires_at < now)
+               .order_by(IdempotencyKey.id)
+               .limit(batch_size)]
+        if not ids:
+            break
+        IdempotencyKey.query.filter(IdempotencyKey.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        purged += len(ids)
+    return purged
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        print(f"Purged {purge_expired_idempotency_keys()} expired idempotency keys")
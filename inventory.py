@@ -0,0 +1,107 @@
+from models import TrainSchedule, FlightSchedule
+
+SCHEDULE_MODELS = {
+    'train': TrainSchedule,
+    'flight': FlightSchedule,
+}
+
+TRAVEL_CLASSES = ('economy', 'business', 'first')
+MAX_SCHEDULE_ID = 2 ** 63 - 1  # largest BIGINT; anything above cannot be a schedule
+
+
+class InventoryError(Exception):
+    """Raised when a schedule cannot supply the requested seats"""
+    pass
+
+
+class SoldOutError(InventoryError):
+    """Raised when a schedule exists but has too few seats left"""
+    pass
+
+
+def get_schedule_model(booking_type):
+    try:
+        return SCHEDULE_MODELS[booking_type]
+    except KeyError:
+        raise InventoryError(f'Unknown booking type: {booking_type}')
+
+
+def seat_column(travel_class):
+    if travel_class not in TRAVEL_CLASSES:
+        raise InventoryError(f'Unknown travel class: {travel_class}')
+    return f'available_seats_{travel_class}'
+
+
+def price_column(travel_class):
+    if travel_class not in TRAVEL_CLASSES:
+        raise InventoryError(f'Unknown travel class: {travel_class}')
+    return f'{travel_class}_price'
+
+
+def schedule_id_of(value):
+    """``value`` (an int or a string of digits, e.g. client input) as a
+    schedule id; raises InventoryError for anything that cannot be one"""
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise InventoryError(f'Invalid schedule id: {value!r}')
+    try:
+        schedule_id = int(value)
+    except ValueError:
+        raise InventoryError(f'Invalid schedule id: {value!r}')
+    if not 1 <= schedule_id <= MAX_SCHEDULE_ID:
+        raise InventoryError(f'Invalid schedule id: {value!r}')
+    return schedule_id
+
+
+def get_price(schedule, travel_class):
+    return getattr(schedule, price_column(travel_class))
+
+
+def get_available_seats(schedule, travel_class):
+    return getattr(schedule, seat_column(travel_class))
+
+
+def lock_schedules(segments):
+    """Load and row-lock every schedule referenced by ``segments``.
+
+    ``segments`` is an iterable of ``(booking_type, schedule_id)`` pairs.
+    Locks are always taken in (booking_type, schedule_id) order so two
+    transactions touching the same schedules can never deadlock. Returns a
+    dict keyed by the pair; raises InventoryError if a schedule is missing
+    or an id is not a valid schedule id.
+    """
+    schedules = {}
+    for booking_type, schedule_id in sorted({(t, schedule_id_of(i)) for t, i in segments}):
+        model = get_schedule_model(booking_type)
+        schedule = model.query.filter_by(id=schedule_id).with_for_update().first()
+        if schedule is None:
+            raise InventoryError(f'{booking_type.capitalize()} schedule {schedule_id} not found')
+        schedules[(booking_type, schedule_id)] = schedule
+    return schedules
+
+
+def lock_schedule(booking_type, schedule_id):
+    return lock_schedules([(booking_type, schedule_id)])[(booking_type, schedule_id_of(schedule_id))]
+
+
+def ensure_running(schedule):
+    """Raise InventoryError for a schedule the operator has cancelled"""
+    if schedule.cancelled_at is not None:
+        raise InventoryError('This service has been cancelled')
+
+
+def reserve_seats(schedule, travel_class, count):
+    """Take ``count`` seats from a schedule locked with lock_schedules()"""
+    ensure_running(schedule)
+    column = seat_column(travel_class)
+    available = getattr(schedule, column)
+    if count < 1:
+        raise InventoryError('At least one seat must be reserved')
+    if available < count:
+        raise SoldOutError(f'Not enough seats available. Only {available} seats left.')
+    setattr(schedule, column, available - count)
+
+
+def release_seats(schedule, travel_class, count):
+    """Return ``count`` seats to a schedule locked with lock_schedules()"""
+    column = seat_column(travel_class)
+    setattr(schedule, column, getattr(schedule, column) + count)
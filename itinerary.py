@@ -0,0 +1,161 @@
+from sqlalchemy import insert
+
+from app import db
+from models import Itinerary, Booking, Passenger
+from inventory import InventoryError, lock_schedules, schedule_id_of, get_price, reserve_seats, TRAVEL_CLASSES
+from seating import assign_seats
+
+MAX_SEGMENTS = 6
+MAX_PASSENGERS = 9
+GENDERS = ('male', 'female', 'other')
+MEAL_PREFERENCES = ('none', 'vegetarian', 'non-vegetarian', 'vegan', 'kosher', 'halal')  # as PassengerForm
+
+
+class ItineraryError(ValueError):
+    """Raised when an itinerary request is malformed"""
+    pass
+
+
+def _parse_segments(segments):
+    if not isinstance(segments, list):
+        raise ItineraryError('Segments must be a list')
+    if not segments:
+        raise ItineraryError('An itinerary needs at least one segment')
+    if len(segments) > MAX_SEGMENTS:
+        raise ItineraryError(f'An itinerary can have at most {MAX_SEGMENTS} segments')
+
+    parsed = []
+    for i, segment in enumerate(segments):
+        if not isinstance(segment, dict):
+            raise ItineraryError(f'Segment {i + 1} needs a booking_type and a schedule_id')
+        try:
+            booking_type = segment['booking_type']
+            schedule_id = schedule_id_of(segment['schedule_id'])
+        except (KeyError, TypeError, InventoryError):
+            raise ItineraryError(f'Segment {i + 1} needs a booking_type and a schedule_id')
+        travel_class = segment.get('travel_class', 'economy')
+        if booking_type not in ('train', 'flight'):
+            raise ItineraryError(f'Segment {i + 1} has an unknown booking_type')
+        if travel_class not in TRAVEL_CLASSES:
+            raise ItineraryError(f'Segment {i + 1} has an unknown travel_class')
+        seat_numbers = segment.get('seat_numbers') or []
+        if not isinstance(seat_numbers, list) or not all(
+                seat is None or isinstance(seat, str) and len(seat) <= 10 for seat in seat_numbers):
+            raise ItineraryError(f'Segment {i + 1} has invalid seat_numbers')
+        parsed.append({
+            'booking_type': booking_type,
+            'schedule_id': schedule_id,
+            'travel_class': travel_class,
+            'seat_numbers': seat_numbers,
+        })
+
+    keys = [(s['booking_type'], s['schedule_id']) for s in parsed]
+    if len(set(keys)) != len(keys):
+        raise ItineraryError('The same schedule appears twice in the itinerary')
+    return parsed
+
+
+def _parse_passengers(passengers):
+    if not isinstance(passengers, list):
+        raise ItineraryError('Passengers must be a list')
+    if not passengers:
+        raise ItineraryError('An itinerary needs at least one passenger')
+    if len(passengers) > MAX_PASSENGERS:
+        raise ItineraryError(f'An itinerary can have at most {MAX_PASSENGERS} passengers')
+
+    parsed = []
+    for i, passenger in enumerate(passengers):
+        try:
+            first_name = passenger['first_name'].strip()
+            last_name = passenger['last_name'].strip()
+            age = int(passenger['age'])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise ItineraryError(f'Passenger {i + 1} needs a first_name, last_name and age')
+        gender = passenger.get('gender')
+        meal_preference = passenger.get('meal_preference', 'none')
+        if not first_name or not last_name or not 0 <= age <= 120:
+            raise ItineraryError(f'Passenger {i + 1} has invalid details')
+        if gender is not None and gender not in GENDERS:
+            raise ItineraryError(f'Passenger {i + 1} has an unknown gender')
+        if meal_preference not in MEAL_PREFERENCES:
+            raise ItineraryError(f'Passenger {i + 1} has an unknown meal_preference')
+        parsed.append({
+            'first_name': first_name[:50],
+            'last_name': last_name[:50],
+            'age': age,
+            'gender': gender,
+            'meal_preference': meal_preference,
+        })
+    return parsed
+
+
+def book_itinerary(user_id, segments, passengers):
+    """Reserve every segment of an itinerary inside the current transaction.
+
+    Either all segments get their seats or an exception is raised and nothing
+    is reserved; the caller owns the commit/rollback. Schedules are locked in
+    a global order (see inventory.lock_schedules), passengers are written with
+    a single bulk insert covering every segment.
+    """
+    segments = _parse_segments(segments)
+    passengers = _parse_passengers(passengers)
+
+    schedules = lock_schedules((s['booking_type'], s['schedule_id']) for s in segments)
+
+    # Segments must follow each other in time
+    previous = None
+    for segment in segments:
+        schedule = schedules[(segment['booking_type'], segment['schedule_id'])]
+        if previous is not None and schedule.departure_time < previous.arrival_time:
+            raise ItineraryError('Itinerary segments overlap in time')
+        previous = schedule
+
+    itinerary = Itinerary(user_id=user_id, total_amount=0)
+    db.session.add(itinerary)
+
+    bookings = []
+    for segment in segments:
+        schedule = schedules[(segment['booking_type'], segment['schedule_id'])]
+        reserve_seats(schedule, segment['travel_class'], len(passengers))
+        seat_numbers = segment['seat_numbers']
+        segment['seat_numbers'] = assign_seats(schedule, segment['booking_type'], segment['travel_class'], [
+            seat_numbers[i] if i < len(seat_numbers) else None for i in range(len(passengers))
+        ])
+        amount = get_price(schedule, segment['travel_class']) * len(passengers)
+        itinerary.total_amount += amount
+        bookings.append(Booking(
+            user_id=user_id,
+            itinerary=itinerary,
+            booking_type=segment['booking_type'],
+            schedule_id=segment['schedule_id'],
+            travel_class=segment['travel_class'],
+            total_amount=amount,
+            status='confirmed'
+        ))
+
+    db.session.add_all(bookings)
+    db.session.flush()  # Flush to get the booking IDs
+
+    rows = []
+    for segment, booking in zip(segments, bookings):
+        for passenger, seat_number in zip(passengers, segment['seat_numbers']):
+            rows.append(dict(passenger, booking_id=booking.id, seat_number=seat_number))
+    db.session.execute(insert(Passenger), rows)
+
+    return itinerary
+
+
+def itinerary_to_dict(itinerary):
+    return {
+        'itinerary_id': itinerary.id,
+        'total_amount': itinerary.total_amount,
+        'bookings': [{
+            'booking_id': booking.id,
+            'booking_type': booking.booking_type,
+            'schedule_id': booking.schedule_id,
+            'travel_class': booking.travel_class,
+            'total_amount': booking.total_amount,
+            'status': booking.status,
+        } for booking in itinerary.bookings],
+    }
+
@@ -0,0 +1,199 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import logging
+import os
+import random
+import threading
+
+from sqlalchemy import or_, and_, event
+from sqlalchemy.orm import Session
+
+from app import app, db
+from models import Job
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+POLL_INTERVAL = 1.0  # seconds between polls when idle
+LEASE_TIME = timedelta(minutes=5)  # a running job whose runner died is retried after this
+BACKOFF_BASE = 5  # seconds; doubled on every failed attempt
+BACKOFF_MAX = 3600
+
+_handlers = {}
+_failure_handlers = {}
+_runner = None
+
+
+def job(name, on_failure=None):
+    """Register a function as the handler for jobs called ``name``.
+
+    The handler is called with the job payload as keyword arguments inside
+    an application context and must commit its own work. ``on_failure`` is
+    called the same way once a job has failed its last attempt.
+    """
+    def decorator(func):
+        _handlers[name] = func
+        if on_failure is not None:
+            _failure_handlers[name] = on_failure
+        return func
+    return decorator
+
+
+def enqueue_job(name, payload=None, delay=None, max_attempts=5):
+    """Add a job to the current transaction.
+
+    Nothing is visible to the runner until the caller commits, so follow-up
+    work is enqueued if and only if the booking change it belongs to is.
+    """
+    record = Job(
+        name=name,
+        payload=payload or {},
+        status='pending',
+        attempts=0,
+        max_attempts=max_attempts,
+        run_at=datetime.utcnow() + (delay or timedelta(0))
+    )
+    db.session.add(record)
+    db.session.info['jobs_enqueued'] = True
+    return record
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_runner_after_commit(session):
+    if session.info.pop('jobs_enqueued', False) and _runner is not None:
+        _runner.wake()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_enqueued_jobs(session):
+    session.info.pop('jobs_enqueued', None)
+
+
+def backoff_delay(attempts):
+    """Exponential backoff with jitter for the given number of failed attempts"""
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+def claim_jobs(limit):
+    """Lease up to ``limit`` due jobs and return their ids"""
+    now = datetime.utcnow()
+    try:
+        jobs = Job.query.filter(or_(
+            and_(Job.status == 'pending', Job.run_at <= now),
+            and_(Job.status == 'running', Job.locked_until < now)
+        )).order_by(Job.run_at).limit(limit).with_for_update(skip_locked=True).all()
+        job_ids = []
+        for record in jobs:
+            record.status = 'running'
+            record.attempts += 1
+            record.locked_until = now + LEASE_TIME
+            job_ids.append(record.id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return job_ids
+
+
+def run_job(job_id):
+    """Execute one leased job and record the outcome"""
+    with app.app_context():
+        try:
+            record = db.session.get(Job, job_id)
+            name, payload = record.name, dict(record.payload or {})
+            handler = _handlers.get(name)
+            error = None
+            try:
+                if handler is None:
+                    raise LookupError(f'No handler registered for job {name!r}')
+                handler(**payload)
+            except Exception as e:
+                db.session.rollback()
+                logger.exception("Job #%s (%s) failed", job_id, name)
+                error = f'{type(e).__name__}: {e}'
+
+            record = db.session.get(Job, job_id)
+            record.locked_until = None
+            if error is None:
+                record.status = 'done'
+                record.finished_at = datetime.utcnow()
+                record.last_error = None
+            elif record.attempts < record.max_attempts:
+                record.status = 'pending'
+                record.run_at = datetime.utcnow() + backoff_delay(record.attempts)
+                record.last_error = error
+            else:
+                record.status = 'failed'
+                record.finished_at = datetime.utcnow()
+                record.last_error = error
+            db.session.commit()
+            if record.status == 'failed' and name in _failure_handlers:
+                _failure_handlers[name](**payload)
+        except Exception:
+            db.session.rollback()
+            logger.exception("Could not record the result of job #%s", job_id)
+        finally:
+            db.session.remove()
+
+
+class JobRunner(threading.Thread):
+    """Polls the job table and executes due jobs on a thread pool"""
+
+    def __init__(self, workers=JOB_WORKERS):
+        super().__init__(name='job-runner', daemon=True)
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._wakeup = threading.Event()
+        self._in_flight = threading.Semaphore(workers)
+
+    def wake(self):
+        self._wakeup.set()
+
+    def run(self):
+        while True:
+            self._wakeup.wait(POLL_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Job polling failed")
+
+    def poll(self):
+        # Only lease as many jobs as there are idle workers
+        free = 0
+        while free < self.workers and self._in_flight.acquire(blocking=False):
+            free += 1
+        if not free:
+            return
+
+        with app.app_context():
+            try:
+                job_ids = claim_jobs(free)
+            finally:
+                db.session.remove()
+
+        for _ in range(free - len(job_ids)):
+            self._in_flight.release()
+        for job_id in job_ids:
+            future = self.executor.submit(run_job, job_id)
+            future.add_done_callback(lambda _: self._in_flight.release())
+
+
+def start_job_runner(workers=JOB_WORKERS):
+    """Start the background job runner once per process"""
+    global _runner
+    if _runner is None:
+        _runner = JobRunner(workers)
+        _runner.start()
+    return _runner
+
+
+def run_pending_jobs(limit=100):
+    """Synchronously run due jobs; handy from scripts and the shell (python run_jobs.py)"""
+    with app.app_context():
+        job_ids = claim_jobs(limit)
+    for job_id in job_ids:
+        run_job(job_id)
+    return len(job_ids)
+
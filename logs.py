@@ -0,0 +1,181 @@
+from datetime import datetime, timezone
+import atexit
+import copy
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+import random
+import re
+import time
+import uuid
+
+from flask import g, has_request_context, request, session
+
+# Logger levels per deployment profile (APP_PROFILE); '' is the root logger.
+# LOG_LEVELS (e.g. "sqlalchemy.engine=INFO,jobs=DEBUG") overrides single loggers.
+LOG_PROFILES = {
+    'development': {'': logging.DEBUG, 'sqlalchemy': logging.WARNING, 'db_pool': logging.INFO,
+                    'werkzeug': logging.INFO},
+    'production': {'': logging.INFO, 'sqlalchemy': logging.WARNING, 'db_pool': logging.WARNING,
+                   'werkzeug': logging.WARNING},
+    'worker': {'': logging.INFO, 'sqlalchemy': logging.WARNING, 'db_pool': logging.WARNING,
+               'werkzeug': logging.WARNING},
+}
+# Share of successful requests logged per endpoint; failures and slow requests are always logged
+REQUEST_SAMPLE_RATES = {
+    'search': 0.05,
+    'fare_calendar': 0.05,
+    'waiting_room_status': 0.01,
+    'static': 0.0,
+}
+SLOW_REQUEST_MS = 1000
+REQUEST_ID_HEADER = 'X-Request-ID'
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+# LogRecord attributes that are not extra fields
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'sample_rate'}
+
+request_logger = logging.getLogger('access')
+_listener = None
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamp records with the request they were logged in.
+
+    Runs in the thread that logs, possibly in the middle of a database
+    call, so it only reads what is already at hand: the user id comes from
+    the login session rather than from the (lazily loaded) user.
+    """
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.route = request.endpoint
+            record.user_id = session.get('_user_id')
+            started = g.get('request_started')
+            if started is not None:
+                record.elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a record logged with ``extra={'sample_rate': r}`` with probability r.
+
+    Warnings and errors are always kept.
+    """
+
+    def filter(self, record):
+        rate = getattr(record, 'sample_rate', None)
+        return rate is None or record.levelno >= logging.WARNING or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the message, its origin and any extra fields"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        record.request_tag = f' [{record.request_id}]' if getattr(record, 'request_id', None) else ''
+        return super().format(record)
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Only fix the message now, in case its arguments change once the
+        # call returns; formatting (tracebacks included) is the listener's job
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def _levels(profile):
+    levels = dict(LOG_PROFILES.get(profile, LOG_PROFILES['production']))
+    for item in os.environ.get('LOG_LEVELS', '').split(','):
+        name, _, level = item.partition('=')
+        if level.strip():
+            levels['' if name.strip() in ('', 'root') else name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(profile, log_format=None):
+    """Send every record through a queue to a background listener that
+    formats and writes it; returns the listener"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+    log_format = log_format or os.environ.get('LOG_FORMAT') or ('text' if profile == 'development' else 'json')
+
+    output = logging.StreamHandler()
+    if log_format == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(TextFormatter('%(asctime)s %(levelname)s %(name)s%(request_tag)s: %(message)s'))
+    records = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(SamplingFilter())
+    handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    for name, level in _levels(profile).items():
+        logging.getLogger(name or None).setLevel(level)
+
+    _listener = QueueListener(records, output)
+    _listener.start()
+    return _listener
+
+
+def _stop_listener():
+    # Writes out whatever is still queued
+    if _listener is not None:
+        _listener.stop()
+
+
+def init_app(app):
+    """Configure logging for the app's profile and log each request once
+    it has been answered (a sample of the successful ones)"""
+    configure_logging(app.config['APP_PROFILE'])
+    atexit.register(_stop_listener)
+
+    @app.before_request
+    def start_request_log():
+        supplied = request.headers.get(REQUEST_ID_HEADER, '')
+        g.request_id = supplied if REQUEST_ID_RE.match(supplied) else uuid.uuid4().hex
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def log_request(response):
+        started = g.get('request_started')
+        if started is None:
+            return response
+        duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        extra = {'method': request.method, 'path': request.path, 'status': response.status_code,
+                 'duration_ms': duration_ms}
+        if response.status_code < 400 and duration_ms < SLOW_REQUEST_MS:
+            extra['sample_rate'] = REQUEST_SAMPLE_RATES.get(request.endpoint, 1.0)
+        request_logger.log(logging.WARNING if response.status_code >= 500 else logging.INFO,
+                           "%s %s %s %.1fms", request.method, request.path, response.status_code, duration_ms,
+                           extra=extra)
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+        return response
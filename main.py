@@ -3,6 +3,23 @@
 
 # Import the app instance from app.py
 from app import app
+from jobs import start_job_runner
+from waitlist import start_waitlist_worker
+from changefeed import start_change_feed
+from templating import precompile_templates
+from searchlog import start_search_log
+
+# Run queued post-booking jobs, sweep waitlists, feed inventory changes
+# to their consumers and log searches (warming the popular routes) in the
+# background
+start_job_runner()
+start_waitlist_worker()
+start_change_feed()
+start_search_log()
+
+# Load every template from the shared bytecode cache now rather than on
+# each one's first request
+precompile_templates(app)
 
 # Run the app if this script is executed directly
 if __name__ == '__main__':
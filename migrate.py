@@ -0,0 +1,45 @@
+import os
+
+from sqlalchemy import text
+
+from app import app, db
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+
+def pending_migrations(applied):
+    return [name for name in sorted(os.listdir(MIGRATIONS_DIR))
+            if name.endswith('.sql') and name not in applied]
+
+
+def run_migrations():
+    """Apply the SQL files in migrations/ that have not been applied yet"""
+    with app.app_context():
+        try:
+            db.session.execute(text(
+                "CREATE TABLE IF NOT EXISTS schema_migration ("
+                "name VARCHAR(255) PRIMARY KEY, "
+                "applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+            ))
+            db.session.commit()
+            
+            applied = {row[0] for row in db.session.execute(text("SELECT name FROM schema_migration"))}
+            pending = pending_migrations(applied)
+            if not pending:
+                print("Database schema is up to date")
+                return
+            
+            for name in pending:
+                with open(os.path.join(MIGRATIONS_DIR, name)) as f:
+                    sql = f.read()
+                # Each file runs in its own transaction together with its bookkeeping row
+                db.session.connection().exec_driver_sql(sql)
+                db.session.execute(text("INSERT INTO schema_migration (name) VALUES (:name)"), {'name': name})
+                db.session.commit()
+                print(f"Applied {name}")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error applying migrations: {str(e)}")
+
+if __name__ == "__main__":
+    run_migrations()
@@ -0,0 +1,4 @@
+-- Group multi-segment bookings under an itinerary.
+-- The itinerary table itself is created by db.create_all().
+ALTER TABLE booking ADD COLUMN IF NOT EXISTS itinerary_id INTEGER REFERENCES itinerary (id);
+CREATE INDEX IF NOT EXISTS ix_booking_itinerary_id ON booking (itinerary_id);
@@ -0,0 +1,3 @@
+-- archive.py selects departed schedules by arrival time
+CREATE INDEX IF NOT EXISTS ix_train_schedule_arrival_time ON train_schedule (arrival_time);
+CREATE INDEX IF NOT EXISTS ix_flight_schedule_arrival_time ON flight_schedule (arrival_time);
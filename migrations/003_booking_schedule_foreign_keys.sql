@@ -0,0 +1,32 @@
+-- Give booking.schedule_id real foreign keys, one column per schedule table
+ALTER TABLE booking ADD COLUMN IF NOT EXISTS train_schedule_id INTEGER REFERENCES train_schedule (id);
+ALTER TABLE booking ADD COLUMN IF NOT EXISTS flight_schedule_id INTEGER REFERENCES flight_schedule (id);
+
+-- Bookings whose schedule no longer exists keep a NULL foreign key
+UPDATE booking SET train_schedule_id = schedule_id
+WHERE booking_type = 'train' AND train_schedule_id IS NULL
+  AND schedule_id IN (SELECT id FROM train_schedule);
+UPDATE booking SET flight_schedule_id = schedule_id
+WHERE booking_type = 'flight' AND flight_schedule_id IS NULL
+  AND schedule_id IN (SELECT id FROM flight_schedule);
+
+CREATE INDEX IF NOT EXISTS ix_booking_train_schedule_id ON booking (train_schedule_id);
+CREATE INDEX IF NOT EXISTS ix_booking_flight_schedule_id ON booking (flight_schedule_id);
+
+ALTER TABLE booking DROP CONSTRAINT IF EXISTS ck_booking_schedule;
+ALTER TABLE booking ADD CONSTRAINT ck_booking_schedule CHECK (
+    (booking_type = 'train' OR train_schedule_id IS NULL) AND
+    (booking_type = 'flight' OR flight_schedule_id IS NULL)
+);
+
+-- Archived bookings reference the archived copy of their schedule
+ALTER TABLE booking_archive ADD COLUMN IF NOT EXISTS train_schedule_id INTEGER REFERENCES train_schedule_archive (id);
+ALTER TABLE booking_archive ADD COLUMN IF NOT EXISTS flight_schedule_id INTEGER REFERENCES flight_schedule_archive (id);
+UPDATE booking_archive SET train_schedule_id = schedule_id
+WHERE booking_type = 'train' AND train_schedule_id IS NULL
+  AND schedule_id IN (SELECT id FROM train_schedule_archive);
+UPDATE booking_archive SET flight_schedule_id = schedule_id
+WHERE booking_type = 'flight' AND flight_schedule_id IS NULL
+  AND schedule_id IN (SELECT id FROM flight_schedule_archive);
+CREATE INDEX IF NOT EXISTS ix_booking_archive_train_schedule_id ON booking_archive (train_schedule_id);
+CREATE INDEX IF NOT EXISTS ix_booking_archive_flight_schedule_id ON booking_archive (flight_schedule_id);
@@ -0,0 +1,6 @@
+-- Journey time on the search read model, for sorting flexible-date results
+ALTER TABLE route_availability ADD COLUMN IF NOT EXISTS duration_minutes INTEGER;
+UPDATE route_availability
+SET duration_minutes = EXTRACT(EPOCH FROM arrival_time - departure_time)::INTEGER / 60
+WHERE duration_minutes IS NULL;
+ALTER TABLE route_availability ALTER COLUMN duration_minutes SET NOT NULL;
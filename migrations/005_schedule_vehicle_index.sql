@@ -0,0 +1,3 @@
+-- timeline.py loads one vehicle's schedules in departure order
+CREATE INDEX IF NOT EXISTS ix_train_schedule_vehicle_departure ON train_schedule (train_id, departure_time);
+CREATE INDEX IF NOT EXISTS ix_flight_schedule_vehicle_departure ON flight_schedule (flight_id, departure_time);
@@ -0,0 +1,11 @@
+-- Sub-journeys between intermediate stops of a train service (train_stop
+-- itself is created by db.create_all)
+ALTER TABLE booking ADD COLUMN IF NOT EXISTS board_stop INTEGER;
+ALTER TABLE booking ADD COLUMN IF NOT EXISTS alight_stop INTEGER;
+ALTER TABLE booking_archive ADD COLUMN IF NOT EXISTS board_stop INTEGER;
+ALTER TABLE booking_archive ADD COLUMN IF NOT EXISTS alight_stop INTEGER;
+
+-- Seat maps are kept per leg; existing maps cover the single leg 0
+ALTER TABLE seat_map ADD COLUMN IF NOT EXISTS leg INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE seat_map DROP CONSTRAINT IF EXISTS uq_seat_map_schedule_class;
+ALTER TABLE seat_map ADD CONSTRAINT uq_seat_map_schedule_class UNIQUE (booking_type, schedule_id, travel_class, leg);
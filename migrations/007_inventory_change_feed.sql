@@ -0,0 +1,5 @@
+-- Head of the inventory change feed; inventory_event and feed_cursor are
+-- created by db.create_all
+INSERT INTO feed_cursor (name, position, updated_at)
+VALUES ('_head', COALESCE((SELECT MAX(sequence) FROM inventory_event), 0), CURRENT_TIMESTAMP)
+ON CONFLICT (name) DO NOTHING;
@@ -0,0 +1,6 @@
+-- Operator cancellations of whole services (the disruption table itself is
+-- created by db.create_all)
+ALTER TABLE train_schedule ADD COLUMN IF NOT EXISTS cancelled_at TIMESTAMP;
+ALTER TABLE flight_schedule ADD COLUMN IF NOT EXISTS cancelled_at TIMESTAMP;
+ALTER TABLE train_schedule_archive ADD COLUMN IF NOT EXISTS cancelled_at TIMESTAMP;
+ALTER TABLE flight_schedule_archive ADD COLUMN IF NOT EXISTS cancelled_at TIMESTAMP;
@@ -0,0 +1,13 @@
+-- Composite and partial indexes for the hot queries (checked with
+-- python query_plans.py)
+CREATE INDEX IF NOT EXISTS ix_train_schedule_route_departure
+    ON train_schedule (departure_station_id, arrival_station_id, departure_time);
+CREATE INDEX IF NOT EXISTS ix_flight_schedule_route_departure
+    ON flight_schedule (departure_airport_id, arrival_airport_id, departure_time);
+CREATE INDEX IF NOT EXISTS ix_booking_user_date ON booking (user_id, booking_date);
+CREATE INDEX IF NOT EXISTS ix_booking_schedule_confirmed
+    ON booking (booking_type, schedule_id) WHERE status = 'confirmed';
+CREATE INDEX IF NOT EXISTS ix_booking_type_status_class ON booking (booking_type, status, travel_class);
+CREATE INDEX IF NOT EXISTS ix_booking_archive_type_status_class
+    ON booking_archive (booking_type, status, travel_class);
+CREATE INDEX IF NOT EXISTS ix_passenger_booking_id ON passenger (booking_id);
@@ -0,0 +1,3 @@
+-- A /book POST that ends on the waitlist keeps its idempotency key, so a
+-- replay is answered with the original entry
+ALTER TABLE idempotency_key ADD COLUMN IF NOT EXISTS waitlist_entry_id INTEGER REFERENCES waitlist_entry (id);
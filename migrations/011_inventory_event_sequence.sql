@@ -0,0 +1,8 @@
+-- Inventory events take their sequence from a database sequence instead of
+-- the '_head' feed cursor, which every inventory commit had to lock
+CREATE SEQUENCE IF NOT EXISTS inventory_event_sequence;
+SELECT setval('inventory_event_sequence', GREATEST(last, 1), last > 0)
+FROM (SELECT GREATEST(COALESCE((SELECT MAX(sequence) FROM inventory_event), 0),
+                      COALESCE((SELECT position FROM feed_cursor WHERE name = '_head'), 0)) AS last) AS feed;
+ALTER TABLE inventory_event ALTER COLUMN sequence SET DEFAULT nextval('inventory_event_sequence');
+DELETE FROM feed_cursor WHERE name = '_head';
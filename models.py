@@ -1,7 +1,8 @@
 from datetime import datetime
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import and_
+from sqlalchemy import and_, event
+from sqlalchemy.orm import joinedload
 from sqlalchemy.sql.expression import text
 
 # Import db from app to avoid circular imports
@@ -105,68 +106,163 @@ class TrainSchedule(db.Model):
     departure_station_id = db.Column(db.Integer, db.ForeignKey('station.id'), nullable=False)
     arrival_station_id = db.Column(db.Integer, db.ForeignKey('station.id'), nullable=False)
     departure_time = db.Column(db.DateTime, nullable=False)
-    arrival_time = db.Column(db.DateTime, nullable=False)
+    arrival_time = db.Column(db.DateTime, nullable=False, index=True)  # archival scans by arrival
     economy_price = db.Column(db.Float, nullable=False)
     business_price = db.Column(db.Float, nullable=False)
     first_price = db.Column(db.Float, nullable=False)
     available_seats_economy = db.Column(db.Integer, nullable=False)
     available_seats_business = db.Column(db.Integer, nullable=False)
     available_seats_first = db.Column(db.Integer, nullable=False)
+    cancelled_at = db.Column(db.DateTime)  # set when the operator cancels the service (see disruption.py)
+    
+    __table_args__ = (
+        db.Index('ix_train_schedule_vehicle_departure', 'train_id', 'departure_time'),  # per-vehicle timelines
+        # Departures on a route: rebooking alternatives, bulk operations
+        db.Index('ix_train_schedule_route_departure', 'departure_station_id', 'arrival_station_id', 'departure_time'),
+    )
     
     # Relationships
-    bookings = db.relationship('Booking', 
-                              primaryjoin="and_(Booking.schedule_id==TrainSchedule.id, Booking.booking_type=='train')",
-                              foreign_keys="[Booking.schedule_id]",
-                              backref='train_schedule', lazy=True)
+    bookings = db.relationship('Booking', backref='train_schedule', lazy=True)
+    stops = db.relationship('TrainStop', backref='schedule', order_by='TrainStop.sequence',
+                            cascade='all, delete-orphan', lazy=True)
     
     def __repr__(self):
         return f'<TrainSchedule {self.train.number} {self.departure_station.code} to {self.arrival_station.code}>'
 
 
+class TrainStop(db.Model):
+    """One call of a train service; consecutive stops bound a leg (see stops.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    schedule_id = db.Column(db.Integer, db.ForeignKey('train_schedule.id', ondelete='CASCADE'), nullable=False)
+    sequence = db.Column(db.Integer, nullable=False)  # 0 is the origin
+    station_id = db.Column(db.Integer, db.ForeignKey('station.id'), nullable=False)
+    arrival_time = db.Column(db.DateTime)  # None at the origin
+    departure_time = db.Column(db.DateTime)  # None at the terminus
+    fare_fraction = db.Column(db.Float, nullable=False)  # share of the full fare from the origin to here
+    
+    __table_args__ = (
+        db.UniqueConstraint('schedule_id', 'sequence', name='uq_train_stop_sequence'),
+        db.Index('ix_train_stop_station_departure', 'station_id', 'departure_time'),  # sub-journey search
+    )
+    
+    station = db.relationship('Station')
+    
+    def __repr__(self):
+        return f'<TrainStop {self.schedule_id} #{self.sequence}>'
+
+
 class FlightSchedule(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     flight_id = db.Column(db.Integer, db.ForeignKey('flight.id'), nullable=False)
     departure_airport_id = db.Column(db.Integer, db.ForeignKey('airport.id'), nullable=False)
     arrival_airport_id = db.Column(db.Integer, db.ForeignKey('airport.id'), nullable=False)
     departure_time = db.Column(db.DateTime, nullable=False)
-    arrival_time = db.Column(db.DateTime, nullable=False)
+    arrival_time = db.Column(db.DateTime, nullable=False, index=True)  # archival scans by arrival
     economy_price = db.Column(db.Float, nullable=False)
     business_price = db.Column(db.Float, nullable=False)
     first_price = db.Column(db.Float, nullable=False)
     available_seats_economy = db.Column(db.Integer, nullable=False)
     available_seats_business = db.Column(db.Integer, nullable=False)
     available_seats_first = db.Column(db.Integer, nullable=False)
+    cancelled_at = db.Column(db.DateTime)  # set when the operator cancels the service (see disruption.py)
+    
+    __table_args__ = (
+        db.Index('ix_flight_schedule_vehicle_departure', 'flight_id', 'departure_time'),  # per-vehicle timelines
+        # Departures on a route: rebooking alternatives, bulk operations
+        db.Index('ix_flight_schedule_route_departure', 'departure_airport_id', 'arrival_airport_id', 'departure_time'),
+    )
     
     # Relationships
-    bookings = db.relationship('Booking', 
-                              primaryjoin="and_(Booking.schedule_id==FlightSchedule.id, Booking.booking_type=='flight')",
-                              foreign_keys="[Booking.schedule_id]",
-                              backref='flight_schedule', lazy=True)
+    bookings = db.relationship('Booking', backref='flight_schedule', lazy=True)
     
     def __repr__(self):
         return f'<FlightSchedule {self.flight.flight_number} {self.departure_airport.code} to {self.arrival_airport.code}>'
 
 
+class Itinerary(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    total_amount = db.Column(db.Float, nullable=False)
+    
+    # Relationships
+    bookings = db.relationship('Booking', backref='itinerary', lazy=True, order_by='Booking.id')
+    
+    def __repr__(self):
+        return f'<Itinerary #{self.id} ({len(self.bookings)} segments)>'
+
+
 class Booking(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    itinerary_id = db.Column(db.Integer, db.ForeignKey('itinerary.id'))  # set for multi-segment bookings
     booking_type = db.Column(db.String(10), nullable=False)  # 'train' or 'flight'
     schedule_id = db.Column(db.Integer, nullable=False)
+    # Real foreign keys for schedule_id; exactly the one matching booking_type is set
+    train_schedule_id = db.Column(db.Integer, db.ForeignKey('train_schedule.id'), index=True)
+    flight_schedule_id = db.Column(db.Integer, db.ForeignKey('flight_schedule.id'), index=True)
     booking_date = db.Column(db.DateTime, default=datetime.utcnow)
     travel_class = db.Column(db.String(20), nullable=False)  # 'economy', 'business', 'first'
     total_amount = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(20), default='confirmed')  # 'confirmed', 'cancelled'
+    board_stop = db.Column(db.Integer)  # TrainStop.sequence of a sub-journey; None for the whole route
+    alight_stop = db.Column(db.Integer)
+    
+    __table_args__ = (
+        db.CheckConstraint(
+            "(booking_type = 'train' OR train_schedule_id IS NULL) AND "
+            "(booking_type = 'flight' OR flight_schedule_id IS NULL)",
+            name='ck_booking_schedule'
+        ),
+        db.Index('ix_booking_user_date', 'user_id', 'booking_date'),  # booking history
+        # Who is travelling on a schedule (rebooking, waitlist promotion, stop edits)
+        db.Index('ix_booking_schedule_confirmed', 'booking_type', 'schedule_id',
+                 postgresql_where=db.text("status = 'confirmed'"), sqlite_where=db.text("status = 'confirmed'")),
+        db.Index('ix_booking_type_status_class', 'booking_type', 'status', 'travel_class'),  # report counts
+    )
     
     # Relationships
     passengers = db.relationship('Passenger', backref='booking', lazy=True, cascade="all, delete-orphan")
     
+    @property
+    def schedule(self):
+        return self.train_schedule if self.booking_type == 'train' else self.flight_schedule
+    
+    @property
+    def journey_stops(self):
+        """(boarding, alighting) TrainStop of a sub-journey booking, else None"""
+        if self.board_stop is None:
+            return None
+        stops = self.schedule.stops
+        return stops[self.board_stop], stops[self.alight_stop]
+    
     def __repr__(self):
         return f'<Booking #{self.id} {self.booking_type} {self.status}>'
 
 
+@event.listens_for(Booking, 'before_insert')
+def _set_schedule_foreign_key(mapper, connection, booking):
+    # Callers only set booking_type and schedule_id
+    if booking.booking_type == 'train':
+        booking.train_schedule_id = booking.schedule_id
+    elif booking.booking_type == 'flight':
+        booking.flight_schedule_id = booking.schedule_id
+
+
+def booking_schedule_options(model=None):
+    """Loader options fetching a booking's schedule, vehicle and endpoints in the same query"""
+    options = []
+    for name, related in (('train_schedule', ('train', 'departure_station', 'arrival_station')),
+                          ('flight_schedule', ('flight', 'departure_airport', 'arrival_airport'))):
+        schedule = getattr(model or Booking, name)
+        schedule_model = schedule.property.mapper.class_
+        options.extend(joinedload(schedule).joinedload(getattr(schedule_model, attr)) for attr in related)
+    return options
+
+
 class Passenger(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    booking_id = db.Column(db.Integer, db.ForeignKey('booking.id'), nullable=False)
+    booking_id = db.Column(db.Integer, db.ForeignKey('booking.id'), nullable=False, index=True)
     first_name = db.Column(db.String(50), nullable=False)
     last_name = db.Column(db.String(50), nullable=False)
     age = db.Column(db.Integer, nullable=False)
@@ -176,3 +272,375 @@ class Passenger(db.Model):
     
     def __repr__(self):
         return f'<Passenger {self.first_name} {self.last_name}>'
+
+
+class IdempotencyKey(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    key = db.Column(db.String(64), nullable=False)
+    booking_id = db.Column(db.Integer, db.ForeignKey('booking.id'))  # set once the booking is committed
+    waitlist_entry_id = db.Column(db.Integer, db.ForeignKey('waitlist_entry.id'))  # set if it was waitlisted instead
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'key', name='uq_idempotency_key_user_key'),
+    )
+    
+    def __repr__(self):
+        return f'<IdempotencyKey {self.key} booking={self.booking_id}>'
+
+
+class WaitlistEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    booking_type = db.Column(db.String(10), nullable=False)  # 'train' or 'flight'
+    schedule_id = db.Column(db.Integer, nullable=False)
+    travel_class = db.Column(db.String(20), nullable=False)
+    passengers = db.Column(db.JSON, nullable=False)  # passenger details captured from the booking form
+    status = db.Column(db.String(20), default='waiting')  # 'waiting', 'promoted', 'cancelled'
+    booking_id = db.Column(db.Integer, db.ForeignKey('booking.id'))  # set on promotion
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    promoted_at = db.Column(db.DateTime)
+    
+    # FIFO scans per schedule/class
+    __table_args__ = (
+        db.Index('ix_waitlist_entry_queue', 'booking_type', 'schedule_id', 'travel_class', 'status', 'id'),
+    )
+    
+    # Relationships
+    user = db.relationship('User', backref=db.backref('waitlist_entries', lazy=True))
+    
+    @property
+    def passenger_count(self):
+        return len(self.passengers)
+    
+    def __repr__(self):
+        return f'<WaitlistEntry #{self.id} {self.booking_type} {self.schedule_id} {self.status}>'
+
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # 'pending', 'running', 'done', 'failed'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime)  # lease of the runner currently executing the job
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    
+    # Runners poll for due jobs by status and time
+    __table_args__ = (
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+    
+    def __repr__(self):
+        return f'<Job #{self.id} {self.name} {self.status}>'
+
+
+class WaitingRoom(db.Model):
+    """Queue in front of seat selection and checkout for one schedule (see waitingroom.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    booking_type = db.Column(db.String(10), nullable=False)
+    schedule_id = db.Column(db.Integer, nullable=False)
+    enabled = db.Column(db.Boolean, nullable=False, default=True)
+    opened_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    admit_per_minute = db.Column(db.Integer, nullable=False)
+    initial_admits = db.Column(db.Integer, nullable=False, default=0)  # let in at once when the room opens
+    next_position = db.Column(db.Integer, nullable=False, default=0)  # last queue position handed out
+    
+    __table_args__ = (
+        db.UniqueConstraint('booking_type', 'schedule_id', name='uq_waiting_room_schedule'),
+    )
+    
+    def __repr__(self):
+        return f'<WaitingRoom {self.booking_type} {self.schedule_id}>'
+
+
+class Disruption(db.Model):
+    """A cancelled schedule whose bookings are moved to alternatives (see disruption.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    booking_type = db.Column(db.String(10), nullable=False)
+    schedule_id = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(200))
+    status = db.Column(db.String(20), nullable=False, default='running')  # 'running', 'done'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    bookings_rebooked = db.Column(db.Integer, nullable=False, default=0)
+    passengers_rebooked = db.Column(db.Integer, nullable=False, default=0)
+    bookings_upgraded = db.Column(db.Integer, nullable=False, default=0)
+    bookings_cancelled = db.Column(db.Integer, nullable=False, default=0)  # no alternative had room
+    summary = db.Column(db.JSON, nullable=False, default=dict)  # bookings per alternative, unaccommodated ids
+    
+    def __repr__(self):
+        return f'<Disruption #{self.id} {self.booking_type} {self.schedule_id} {self.status}>'
+
+
+class UserImport(db.Model):
+    """A file of users provisioned in bulk (see provisioning.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255), nullable=False)
+    path = db.Column(db.String(500), nullable=False)  # the stored upload
+    requested_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    status = db.Column(db.String(20), nullable=False, default='running')  # 'running', 'done', 'failed'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    rows_done = db.Column(db.Integer, nullable=False, default=0)  # rows committed; a rerun resumes after them
+    users_created = db.Column(db.Integer, nullable=False, default=0)
+    rows_duplicate = db.Column(db.Integer, nullable=False, default=0)  # username or email already taken
+    rows_invalid = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.JSON, nullable=False, default=list)  # [line, message], the first few
+    
+    def __repr__(self):
+        return f'<UserImport #{self.id} {self.filename} {self.status}>'
+
+
+class InventoryEvent(db.Model):
+    """One committed change to a schedule's seats, prices or timing (see changefeed.py)"""
+    # Taken from inventory_event_sequence at commit; concurrent commits can
+    # leave gaps that fill in later (see changefeed.read_events)
+    sequence = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), db.Sequence('inventory_event_sequence'),
+                         primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    kind = db.Column(db.String(20), nullable=False)  # 'created', 'updated', 'deleted'
+    booking_type = db.Column(db.String(10), nullable=False)
+    schedule_id = db.Column(db.Integer, nullable=False)
+    origin_id = db.Column(db.Integer)
+    destination_id = db.Column(db.Integer)
+    service_date = db.Column(db.Date)
+    changes = db.Column(db.JSON, nullable=False, default=dict)  # column -> [old, new]
+    
+    def __repr__(self):
+        return f'<InventoryEvent #{self.sequence} {self.kind} {self.booking_type} {self.schedule_id}>'
+
+
+class SearchLog(db.Model):
+    """One search as run by the search page, written in batches (see searchlog.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    booking_type = db.Column(db.String(10), nullable=False)
+    origin_ids = db.Column(db.Text, nullable=False)  # matched station or airport ids, sorted, comma separated
+    destination_ids = db.Column(db.Text, nullable=False)
+    date_offset = db.Column(db.Integer, nullable=False)  # days from the search to the departure date
+    flexible_days = db.Column(db.Integer, nullable=False, default=0)
+    travel_class = db.Column(db.String(20), nullable=False)
+    sort = db.Column(db.String(10), nullable=False)
+    passengers = db.Column(db.Integer, nullable=False)
+    results = db.Column(db.Integer, nullable=False)
+    latency_ms = db.Column(db.Integer, nullable=False)
+    
+    def __repr__(self):
+        return f'<SearchLog #{self.id} {self.booking_type} {self.origin_ids}-{self.destination_ids}>'
+
+
+class FeedCursor(db.Model):
+    """How far a durable consumer has read the inventory change feed"""
+    name = db.Column(db.String(64), primary_key=True)
+    position = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<FeedCursor {self.name} at {self.position}>'
+
+
+class ETicket(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    booking_id = db.Column(db.Integer, db.ForeignKey('booking.id'), unique=True, nullable=False)
+    booking_status = db.Column(db.String(20), nullable=False)  # status the artifacts were rendered for
+    html_digest = db.Column(db.String(64), nullable=False)
+    pdf_digest = db.Column(db.String(64), nullable=False)
+    qr_digest = db.Column(db.String(64), nullable=False)
+    qr_payload = db.Column(db.String(255), nullable=False)
+    generated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    booking = db.relationship('Booking', backref=db.backref('eticket', uselist=False, lazy=True))
+    
+    def __repr__(self):
+        return f'<ETicket booking={self.booking_id} {self.booking_status}>'
+
+
+class SeatMap(db.Model):
+    """Occupied seats of one class on one leg of a schedule, one bit per seat (see seating.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    booking_type = db.Column(db.String(10), nullable=False)  # 'train' or 'flight'
+    schedule_id = db.Column(db.Integer, nullable=False)
+    travel_class = db.Column(db.String(20), nullable=False)
+    leg = db.Column(db.Integer, nullable=False, default=0)  # from stop ``leg`` to stop ``leg + 1``
+    occupied = db.Column(db.LargeBinary, nullable=False, default=b'')  # little-endian bitmap
+    
+    __table_args__ = (
+        db.UniqueConstraint('booking_type', 'schedule_id', 'travel_class', 'leg', name='uq_seat_map_schedule_class'),
+    )
+    
+    def __repr__(self):
+        return f'<SeatMap {self.booking_type} {self.schedule_id} {self.travel_class} leg {self.leg}>'
+
+
+class RouteAvailability(db.Model):
+    """Denormalized search row for one schedule, maintained by availability.py"""
+    id = db.Column(db.Integer, primary_key=True)
+    booking_type = db.Column(db.String(10), nullable=False)  # 'train' or 'flight'
+    train_schedule_id = db.Column(db.Integer, db.ForeignKey('train_schedule.id', ondelete='CASCADE'), unique=True)
+    flight_schedule_id = db.Column(db.Integer, db.ForeignKey('flight_schedule.id', ondelete='CASCADE'), unique=True)
+    origin_id = db.Column(db.Integer, nullable=False)  # station or airport id
+    destination_id = db.Column(db.Integer, nullable=False)
+    service_date = db.Column(db.Date, nullable=False)
+    departure_time = db.Column(db.DateTime, nullable=False)
+    arrival_time = db.Column(db.DateTime, nullable=False)
+    duration_minutes = db.Column(db.Integer, nullable=False)  # lets SQL sort by journey time
+    vehicle_name = db.Column(db.String(100), nullable=False)  # train name or airline
+    vehicle_number = db.Column(db.String(20), nullable=False)  # train or flight number
+    aircraft_type = db.Column(db.String(50))
+    origin_code = db.Column(db.String(10), nullable=False)
+    origin_city = db.Column(db.String(50), nullable=False)
+    destination_code = db.Column(db.String(10), nullable=False)
+    destination_city = db.Column(db.String(50), nullable=False)
+    economy_price = db.Column(db.Float, nullable=False)
+    business_price = db.Column(db.Float, nullable=False)
+    first_price = db.Column(db.Float, nullable=False)
+    available_seats_economy = db.Column(db.Integer, nullable=False)
+    available_seats_business = db.Column(db.Integer, nullable=False)
+    available_seats_first = db.Column(db.Integer, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_route_availability_search', 'booking_type', 'origin_id', 'destination_id',
+                 'service_date', 'departure_time'),
+    )
+    
+    # Relationships
+    train_schedule = db.relationship('TrainSchedule', backref=db.backref(
+        'availability', uselist=False, lazy=True, cascade='all, delete-orphan'))
+    flight_schedule = db.relationship('FlightSchedule', backref=db.backref(
+        'availability', uselist=False, lazy=True, cascade='all, delete-orphan'))
+    
+    @property
+    def schedule_id(self):
+        return self.train_schedule_id if self.booking_type == 'train' else self.flight_schedule_id
+    
+    @property
+    def duration(self):
+        return self.arrival_time - self.departure_time
+    
+    # Rows always cover the whole route; sub-journeys come from availability.search_sub_journeys
+    board_stop = None
+    alight_stop = None
+    
+    def __repr__(self):
+        return f'<RouteAvailability {self.booking_type} {self.schedule_id} {self.service_date}>'
+
+
+# Cold tier: schedules that departed long ago, with their bookings and
+# passengers, are moved here by archive.py. Ids are kept from the hot tables.
+class TrainScheduleArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    train_id = db.Column(db.Integer, db.ForeignKey('train.id'), nullable=False)
+    departure_station_id = db.Column(db.Integer, db.ForeignKey('station.id'), nullable=False)
+    arrival_station_id = db.Column(db.Integer, db.ForeignKey('station.id'), nullable=False)
+    departure_time = db.Column(db.DateTime, nullable=False)
+    arrival_time = db.Column(db.DateTime, nullable=False)
+    economy_price = db.Column(db.Float, nullable=False)
+    business_price = db.Column(db.Float, nullable=False)
+    first_price = db.Column(db.Float, nullable=False)
+    available_seats_economy = db.Column(db.Integer, nullable=False)
+    available_seats_business = db.Column(db.Integer, nullable=False)
+    available_seats_first = db.Column(db.Integer, nullable=False)
+    cancelled_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    train = db.relationship('Train')
+    departure_station = db.relationship('Station', foreign_keys=[departure_station_id])
+    arrival_station = db.relationship('Station', foreign_keys=[arrival_station_id])
+    stops = db.relationship('TrainStopArchive', order_by='TrainStopArchive.sequence', lazy=True)
+
+
+class TrainStopArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    schedule_id = db.Column(db.Integer, db.ForeignKey('train_schedule_archive.id'), nullable=False, index=True)
+    sequence = db.Column(db.Integer, nullable=False)
+    station_id = db.Column(db.Integer, db.ForeignKey('station.id'), nullable=False)
+    arrival_time = db.Column(db.DateTime)
+    departure_time = db.Column(db.DateTime)
+    fare_fraction = db.Column(db.Float, nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    station = db.relationship('Station')
+
+
+class FlightScheduleArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    flight_id = db.Column(db.Integer, db.ForeignKey('flight.id'), nullable=False)
+    departure_airport_id = db.Column(db.Integer, db.ForeignKey('airport.id'), nullable=False)
+    arrival_airport_id = db.Column(db.Integer, db.ForeignKey('airport.id'), nullable=False)
+    departure_time = db.Column(db.DateTime, nullable=False)
+    arrival_time = db.Column(db.DateTime, nullable=False)
+    economy_price = db.Column(db.Float, nullable=False)
+    business_price = db.Column(db.Float, nullable=False)
+    first_price = db.Column(db.Float, nullable=False)
+    available_seats_economy = db.Column(db.Integer, nullable=False)
+    available_seats_business = db.Column(db.Integer, nullable=False)
+    available_seats_first = db.Column(db.Integer, nullable=False)
+    cancelled_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    flight = db.relationship('Flight')
+    departure_airport = db.relationship('Airport', foreign_keys=[departure_airport_id])
+    arrival_airport = db.relationship('Airport', foreign_keys=[arrival_airport_id])
+
+
+class BookingArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    itinerary_id = db.Column(db.Integer, db.ForeignKey('itinerary.id'))
+    booking_type = db.Column(db.String(10), nullable=False)
+    schedule_id = db.Column(db.Integer, nullable=False)
+    train_schedule_id = db.Column(db.Integer, db.ForeignKey('train_schedule_archive.id'), index=True)
+    flight_schedule_id = db.Column(db.Integer, db.ForeignKey('flight_schedule_archive.id'), index=True)
+    booking_date = db.Column(db.DateTime)
+    travel_class = db.Column(db.String(20), nullable=False)
+    total_amount = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(20))
+    board_stop = db.Column(db.Integer)
+    alight_stop = db.Column(db.Integer)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_booking_archive_type_status_class', 'booking_type', 'status', 'travel_class'),  # report counts
+    )
+    
+    # Relationships
+    passengers = db.relationship('PassengerArchive', backref='booking', lazy=True)
+    train_schedule = db.relationship('TrainScheduleArchive')
+    flight_schedule = db.relationship('FlightScheduleArchive')
+    
+    @property
+    def schedule(self):
+        return self.train_schedule if self.booking_type == 'train' else self.flight_schedule
+    
+    @property
+    def journey_stops(self):
+        """(boarding, alighting) TrainStopArchive of a sub-journey booking, else None"""
+        if self.board_stop is None:
+            return None
+        stops = self.schedule.stops
+        return stops[self.board_stop], stops[self.alight_stop]
+    
+    def __repr__(self):
+        return f'<BookingArchive #{self.id} {self.booking_type} {self.status}>'
+
+
+class PassengerArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    booking_id = db.Column(db.Integer, db.ForeignKey('booking_archive.id'), nullable=False, index=True)
+    first_name = db.Column(db.String(50), nullable=False)
+    last_name = db.Column(db.String(50), nullable=False)
+    age = db.Column(db.Integer, nullable=False)
+    gender = db.Column(db.String(10))
+    seat_number = db.Column(db.String(10))
+    meal_preference = db.Column(db.String(20))
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
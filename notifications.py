@@ -0,0 +1,29 @@
+import logging
+
+from app import db
+from models import Booking
+from jobs import job, enqueue_job
+
+logger = logging.getLogger(__name__)
+
+MESSAGES = {
+    'confirmed': 'Your booking #{id} is confirmed.',
+    'cancelled': 'Your booking #{id} has been cancelled.',
+    'waitlist_promoted': 'Good news! Seats opened up and your waitlist request is now booking #{id}.',
+    'rebooked': 'Your service was cancelled, so booking #{id} has been moved to the next available departure.',
+    'disrupted': 'Your service was cancelled and no alternative had room; booking #{id} has been cancelled.',
+}
+
+
+def enqueue_booking_notification(booking, event):
+    """Queue a user notification in the same transaction as the booking change"""
+    enqueue_job('notify_booking', {'booking_id': booking.id, 'event': event})
+
+
+@job('notify_booking')
+def notify_booking(booking_id, event):
+    booking = db.session.get(Booking, booking_id)
+    if booking is None:
+        return
+    # There is no mail backend yet; notifications go to the log
+    logger.info("Notify %s: %s", booking.user.email, MESSAGES[event].format(id=booking.id))
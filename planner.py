@@ -0,0 +1,267 @@
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime, timedelta
+from itertools import chain
+import threading
+import time
+
+from sqlalchemy import event, or_
+from sqlalchemy.orm import Session
+
+from app import app, db
+from models import Station, Airport, RouteAvailability
+from inventory import price_column, seat_column
+from changefeed import consumer
+
+# Minutes needed before boarding at a node after arriving there, by mode
+BOARDING_MINUTES = {'train': 10, 'flight': 60}
+CITY_TRANSFER_MINUTES = 45  # moving between a station and an airport (or two stations) in one city
+MAX_LEGS = 4
+MAX_ITINERARIES = 5
+SEARCH_HORIZON = timedelta(days=2)  # how long after the start a journey may still arrive
+TIME_BUDGET = 0.25  # seconds of scanning per query
+FULL_REFRESH_SECONDS = 3600  # safety net; other processes' changes arrive through the change feed
+
+Connection = namedtuple('Connection', [
+    'departure_time', 'arrival_time', 'booking_type', 'schedule_id', 'origin', 'destination',
+    'vehicle_number', 'economy_price', 'business_price', 'first_price',
+    'available_seats_economy', 'available_seats_business', 'available_seats_first'
+])
+Node = namedtuple('Node', ['booking_type', 'id'])
+Place = namedtuple('Place', ['city', 'code', 'name'])
+
+
+def _connection(row):
+    return Connection(
+        row.departure_time, row.arrival_time, row.booking_type, row.schedule_id,
+        Node(row.booking_type, row.origin_id), Node(row.booking_type, row.destination_id),
+        row.vehicle_number, row.economy_price, row.business_price, row.first_price,
+        row.available_seats_economy, row.available_seats_business, row.available_seats_first
+    )
+
+
+def _city_key(city, country):
+    return (city or '').strip().lower(), (country or '').strip().lower()
+
+
+class ConnectionSet:
+    """Every future train and flight departure as one list sorted by departure time.
+
+    Commits mark the schedules they changed as dirty and the next query
+    patches just those connections in, so the set stays current without
+    reloading. Lists are replaced rather than mutated, so a scan in progress
+    keeps a consistent snapshot.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self.loaded_at = None
+        self.connections = []
+        self.departures = []
+        self.by_key = {}
+        self.places = {}  # Node -> Place
+        self.city_nodes = {}  # (city, country) -> [Node]
+
+    def mark_dirty(self, keys):
+        with self._lock:
+            self._dirty.update(keys)
+
+    def _load_places(self):
+        places, city_nodes = {}, {}
+        for booking_type, model in (('train', Station), ('flight', Airport)):
+            for place in db.session.query(model.id, model.name, model.code, model.city, model.country):
+                node = Node(booking_type, place.id)
+                key = _city_key(place.city, place.country)
+                places[node] = Place(key, place.code, place.name)
+                city_nodes.setdefault(key, []).append(node)
+        return places, city_nodes
+
+    def _full_refresh(self, now):
+        rows = RouteAvailability.query.filter(RouteAvailability.departure_time >= now).all()
+        connections = sorted(_connection(row) for row in rows)
+        self.places, self.city_nodes = self._load_places()
+        self.connections = connections
+        self.departures = [c.departure_time for c in connections]
+        self.by_key = {(c.booking_type, c.schedule_id): c for c in connections}
+        self.loaded_at = time.monotonic()
+
+    def _patch(self, keys):
+        filters = []
+        for booking_type in ('train', 'flight'):
+            ids = [schedule_id for kind, schedule_id in keys if kind == booking_type]
+            if ids:
+                filters.append(getattr(RouteAvailability, f'{booking_type}_schedule_id').in_(ids))
+        fresh = {(row.booking_type, row.schedule_id): _connection(row)
+                 for row in RouteAvailability.query.filter(or_(*filters))}
+
+        connections, departures, by_key = list(self.connections), list(self.departures), dict(self.by_key)
+        for key in keys:
+            old = by_key.pop(key, None)
+            if old is not None:
+                index = bisect_left(connections, old)
+                del connections[index]
+                del departures[index]
+            new = fresh.get(key)
+            if new is not None:
+                index = bisect_left(connections, new)
+                connections.insert(index, new)
+                departures.insert(index, new.departure_time)
+                by_key[key] = new
+                if new.origin not in self.places or new.destination not in self.places:
+                    self.places, self.city_nodes = self._load_places()
+        self.connections, self.departures, self.by_key = connections, departures, by_key
+
+    def refresh(self):
+        """Bring the set up to date; returns (connections, departures) to scan"""
+        with self._lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > FULL_REFRESH_SECONDS:
+                self._dirty.clear()
+                self._full_refresh(datetime.utcnow())
+            elif self._dirty:
+                keys, self._dirty = self._dirty, set()
+                self._patch(keys)
+            return self.connections, self.departures
+
+
+connection_set = ConnectionSet()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_connections(session, flush_context):
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, RouteAvailability):
+            session.info.setdefault('planner_changes', set()).add((obj.booking_type, obj.schedule_id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _mark_connections_dirty(session):
+    changes = session.info.pop('planner_changes', None)
+    if changes:
+        connection_set.mark_dirty(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_connection_changes(session):
+    session.info.pop('planner_changes', None)
+
+
+@consumer('planner')
+def _patch_from_feed(events):
+    connection_set.mark_dirty({(inventory_event.booking_type, inventory_event.schedule_id)
+                               for inventory_event in events})
+
+
+def _transfer_targets(node, places, city_nodes, boarding, city_transfer):
+    """Nodes reachable on foot from ``node`` with the minutes it takes to be ready to board"""
+    yield node, boarding[node.booking_type]
+    place = places.get(node)
+    if place is not None:
+        for other in city_nodes.get(place.city, ()):
+            if other != node:
+                yield other, city_transfer + boarding[other.booking_type]
+
+
+def _earliest_journey(connections, departures, places, city_nodes, origins, destinations,
+                      start, travel_class, passengers, deadline):
+    """Connection scan for the earliest arrival from ``origins`` at or after ``start``.
+
+    Returns (legs, timed_out); legs is None when no journey exists.
+    """
+    seats = seat_column(travel_class)
+    boarding = app.config.get('PLANNER_BOARDING_MINUTES', BOARDING_MINUTES)
+    city_transfer = app.config.get('PLANNER_CITY_TRANSFER_MINUTES', CITY_TRANSFER_MINUTES)
+    ready = {node: start for node in origins}  # earliest time a traveller can board at a node
+    legs_to = {node: 0 for node in origins}
+    via = {node: None for node in origins}  # connection that made the node ready
+    best = None
+    horizon = start + SEARCH_HORIZON
+
+    for index in range(bisect_left(departures, start), len(connections)):
+        if index % 256 == 0 and time.monotonic() > deadline:
+            return (_unwind(best, via) if best else None), True
+        c = connections[index]
+        if c.departure_time > horizon or (best is not None and c.departure_time >= best.arrival_time):
+            break
+        ready_at = ready.get(c.origin)
+        if ready_at is None or ready_at > c.departure_time or getattr(c, seats) < passengers:
+            continue
+        if c.destination in destinations:
+            if best is None or c.arrival_time < best.arrival_time:
+                best = c
+            continue
+        if legs_to[c.origin] + 1 >= MAX_LEGS:
+            continue
+        for node, minutes in _transfer_targets(c.destination, places, city_nodes, boarding, city_transfer):
+            at = c.arrival_time + timedelta(minutes=minutes)
+            if at < ready.get(node, datetime.max):
+                ready[node] = at
+                legs_to[node] = legs_to[c.origin] + 1
+                via[node] = c
+    return (_unwind(best, via) if best else None), False
+
+
+def _unwind(last, via):
+    legs = [last]
+    while via.get(legs[-1].origin) is not None:
+        legs.append(via[legs[-1].origin])
+    return legs[::-1]
+
+
+def plan_journeys(source_city, destination_city, departure_date, travel_class='economy', passengers=1,
+                  limit=MAX_ITINERARIES, budget=None):
+    """Best combined train/flight itineraries between two cities on a day.
+
+    Each further itinerary must leave later than the previous one, which
+    yields the departure/arrival trade-offs a traveller chooses between.
+    Scanning stops once ``budget`` seconds are used; returns
+    (itineraries, complete) where complete is False if the budget ran out.
+    """
+    connections, departures = connection_set.refresh()
+    places, city_nodes = connection_set.places, connection_set.city_nodes
+    deadline = time.monotonic() + (budget if budget is not None else app.config.get('PLANNER_TIME_BUDGET', TIME_BUDGET))
+
+    origins = _nodes_in_city(city_nodes, source_city)
+    destinations = set(_nodes_in_city(city_nodes, destination_city))
+    if not origins or not destinations or destinations.intersection(origins):
+        return [], True
+
+    itineraries = []
+    start = datetime.combine(departure_date, datetime.min.time())
+    end_of_day = start + timedelta(days=1)
+    while len(itineraries) < limit and start < end_of_day:
+        legs, timed_out = _earliest_journey(connections, departures, places, city_nodes, origins, destinations,
+                                            start, travel_class, passengers, deadline)
+        if legs is not None and legs[0].departure_time < end_of_day:
+            itineraries.append(_itinerary(legs, places, travel_class, passengers))
+            start = legs[0].departure_time + timedelta(seconds=1)
+        else:
+            legs = None
+        if timed_out or legs is None:
+            return itineraries, not timed_out
+    return itineraries, True
+
+
+def _nodes_in_city(city_nodes, text):
+    text = (text or '').strip().lower()
+    return [node for (city, _), nodes in city_nodes.items() if city == text for node in nodes]
+
+
+def _itinerary(legs, places, travel_class, passengers):
+    price = price_column(travel_class)
+    return {
+        'departure_time': legs[0].departure_time,
+        'arrival_time': legs[-1].arrival_time,
+        'duration': legs[-1].arrival_time - legs[0].departure_time,
+        'total_amount': sum(getattr(leg, price) for leg in legs) * passengers,
+        'legs': [{
+            'booking_type': leg.booking_type,
+            'schedule_id': leg.schedule_id,
+            'vehicle_number': leg.vehicle_number,
+            'origin': places[leg.origin].code if leg.origin in places else None,
+            'destination': places[leg.destination].code if leg.destination in places else None,
+            'departure_time': leg.departure_time,
+            'arrival_time': leg.arrival_time,
+            'price': getattr(leg, price),
+        } for leg in legs],
+    }
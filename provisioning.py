@@ -0,0 +1,271 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+import csv
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+
+from email_validator import EmailNotValidError, validate_email
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash
+from werkzeug.utils import secure_filename
+
+from app import app, db
+from models import User, UserImport
+from jobs import job, enqueue_job
+
+IMPORT_BATCH_SIZE = 500  # rows per transaction
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", 0)) or os.cpu_count()
+HASH_CHUNK_SIZE = 16  # passwords handed to a hashing process at a time
+JOB_TIME_BUDGET = 60  # seconds per job run, well inside the job lease; the rest goes to a follow-up job
+MAX_REPORTED_ERRORS = 100
+REQUIRED_COLUMNS = ('username', 'email', 'password')
+# Same limits as RegistrationForm
+FIELD_LENGTHS = {
+    'username': 64,
+    'email': 120,
+    'first_name': 50,
+    'last_name': 50,
+    'phone': 20,
+}
+MIN_USERNAME_LENGTH = 3
+MIN_PASSWORD_LENGTH = 8
+
+
+class ProvisioningError(ValueError):
+    """Raised for a user file that cannot be imported at all"""
+    pass
+
+
+def _open(path):
+    return open(path, newline='', encoding='utf-8-sig')
+
+
+def check_header(path):
+    """Raise ProvisioningError unless the file has the required columns"""
+    with _open(path) as users_file:
+        columns = csv.DictReader(users_file).fieldnames or []
+    missing = [column for column in REQUIRED_COLUMNS if column not in columns]
+    if missing:
+        raise ProvisioningError(f'Missing columns: {", ".join(missing)}')
+
+
+def _clean(row):
+    """(User columns, password) of a file row; raises ValueError saying what is wrong"""
+    values = {column: (row.get(column) or '').strip() for column in FIELD_LENGTHS}
+    password = row.get('password') or ''
+    if len(values['username']) < MIN_USERNAME_LENGTH:
+        raise ValueError(f'Username must be at least {MIN_USERNAME_LENGTH} characters')
+    for column, limit in FIELD_LENGTHS.items():
+        if len(values[column]) > limit:
+            raise ValueError(f'{column} is longer than {limit} characters')
+    try:
+        validate_email(values['email'], check_deliverability=False)
+    except EmailNotValidError:
+        raise ValueError(f'Invalid email address: {values["email"]}')
+    if len(password) < MIN_PASSWORD_LENGTH:
+        raise ValueError(f'Password must be at least {MIN_PASSWORD_LENGTH} characters')
+    for column in ('first_name', 'last_name', 'phone'):
+        values[column] = values[column] or None
+    return values, password
+
+
+def _taken(column, values):
+    """Which of ``values`` a unique User column already holds, in one query"""
+    if not values:
+        return set()
+    return set(db.session.scalars(select(column).where(column.in_(values))))
+
+
+def _hash_pool(workers=HASH_WORKERS):
+    # Forked rather than spawned: a spawned child re-imports the entry
+    # script, and main.py starts the background workers on import
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+
+def _reject(user_import, row_number, message):
+    if len(user_import.errors) < MAX_REPORTED_ERRORS:
+        user_import.errors = user_import.errors + [[row_number, message]]
+
+
+def _import_batch(user_import, rows, pool, seen_usernames, seen_emails, hashes):
+    """Create the users of one batch of (row number, row) in one transaction.
+
+    ``hashes`` ({row number: hash}) survives a retry, so a batch that lost a
+    uniqueness race is not hashed twice. Returns the usernames and emails
+    created.
+    """
+    candidates, usernames, emails = [], set(), set()
+    for row_number, row in rows:
+        try:
+            values, password = _clean(row)
+        except ValueError as e:
+            user_import.rows_invalid += 1
+            _reject(user_import, row_number, str(e))
+            continue
+        username, email = values['username'], values['email']
+        if username in seen_usernames or username in usernames or email in seen_emails or email in emails:
+            user_import.rows_duplicate += 1
+            _reject(user_import, row_number, f'{username} <{email}> appears earlier in the file')
+            continue
+        usernames.add(username)
+        emails.add(email)
+        candidates.append((row_number, values, password))
+
+    taken_usernames, taken_emails = _taken(User.username, usernames), _taken(User.email, emails)
+    fresh = []
+    for row_number, values, password in candidates:
+        if values['username'] in taken_usernames or values['email'] in taken_emails:
+            user_import.rows_duplicate += 1
+            _reject(user_import, row_number, f'{values["username"]} <{values["email"]}> is already registered')
+        else:
+            fresh.append((row_number, values, password))
+
+    # generate_password_hash is deliberately slow; spread it over every core
+    unhashed = [(row_number, password) for row_number, _, password in fresh if row_number not in hashes]
+    hashes.update(zip([row_number for row_number, _ in unhashed],
+                      pool.map(generate_password_hash, [password for _, password in unhashed],
+                               chunksize=HASH_CHUNK_SIZE)))
+    now = datetime.utcnow()
+    if fresh:
+        db.session.execute(insert(User), [
+            dict(values, password_hash=hashes[row_number], is_admin=False, created_at=now)
+            for row_number, values, _ in fresh
+        ])
+    user_import.users_created += len(fresh)
+    user_import.rows_done += len(rows)
+    db.session.commit()
+    return {values['username'] for _, values, _ in fresh}, {values['email'] for _, values, _ in fresh}
+
+
+def run_import(user_import, batch_size=IMPORT_BATCH_SIZE, workers=HASH_WORKERS, time_budget=None):
+    """Provision an import's users batch after batch, resuming after
+    ``rows_done``; returns whether the file is finished (False when
+    ``time_budget`` seconds ran out first)"""
+    started = time.monotonic()
+    seen_usernames, seen_emails = set(), set()
+    with _open(user_import.path) as users_file, _hash_pool(workers) as pool:
+        # Rows are numbered from 1, not counting the header
+        rows = islice(enumerate(csv.DictReader(users_file), start=1), user_import.rows_done, None)
+        while True:
+            if time_budget is not None and time.monotonic() - started > time_budget:
+                return False
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            hashes = {}
+            try:
+                created = _import_batch(user_import, batch, pool, seen_usernames, seen_emails, hashes)
+            except IntegrityError:
+                # Someone registered one of these meanwhile: check the batch again
+                db.session.rollback()
+                created = _import_batch(user_import, batch, pool, seen_usernames, seen_emails, hashes)
+            seen_usernames.update(created[0])
+            seen_emails.update(created[1])
+    user_import.status = 'done'
+    user_import.finished_at = datetime.utcnow()
+    db.session.commit()
+    return True
+
+
+def start_import(upload, requested_by=None):
+    """Store an uploaded user file and queue its provisioning; returns the
+    UserImport, committed. Raises ProvisioningError for an unusable file."""
+    directory = app.config['USER_IMPORT_DIR']
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{uuid.uuid4().hex}.csv')
+    upload.save(path)  # streamed to disk in chunks
+    try:
+        check_header(path)
+    except (ProvisioningError, UnicodeDecodeError) as e:
+        os.remove(path)
+        raise ProvisioningError(str(e) if isinstance(e, ProvisioningError) else 'The file must be UTF-8 CSV')
+
+    user_import = UserImport(filename=secure_filename(upload.filename or '') or 'users.csv', path=path,
+                             requested_by=requested_by, errors=[])
+    db.session.add(user_import)
+    db.session.flush()
+    enqueue_job('provision_users', {'user_import_id': user_import.id})
+    db.session.commit()
+    return user_import
+
+
+def _remove_upload(user_import):
+    # The file holds plaintext passwords; keep it no longer than needed
+    try:
+        os.remove(user_import.path)
+    except FileNotFoundError:
+        pass
+
+
+def _import_failed(user_import_id):
+    user_import = db.session.get(UserImport, user_import_id)
+    if user_import is None or user_import.status != 'running':
+        return
+    user_import.status = 'failed'
+    user_import.finished_at = datetime.utcnow()
+    db.session.commit()
+    _remove_upload(user_import)
+
+
+@job('provision_users', on_failure=_import_failed)
+def provision_users(user_import_id):
+    """Import for JOB_TIME_BUDGET seconds, then hand the rest to a new job.
+
+    The uploaded file is deleted once the import is done or has failed.
+    """
+    user_import = db.session.get(UserImport, user_import_id)
+    if user_import is None or user_import.status != 'running':
+        return
+    if not run_import(user_import, time_budget=JOB_TIME_BUDGET):
+        enqueue_job('provision_users', {'user_import_id': user_import_id})
+        db.session.commit()
+        return
+    _remove_upload(user_import)
+
+
+def import_report(user_import):
+    return {
+        'id': user_import.id,
+        'filename': user_import.filename,
+        'status': user_import.status,
+        'created_at': user_import.created_at.isoformat(),
+        'finished_at': user_import.finished_at.isoformat() if user_import.finished_at else None,
+        'rows_done': user_import.rows_done,
+        'users_created': user_import.users_created,
+        'rows_duplicate': user_import.rows_duplicate,
+        'rows_invalid': user_import.rows_invalid,
+        'errors': user_import.errors,
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python provisioning.py USERS.csv  (columns: username, email, password"
+              "[, first_name, last_name, phone])")
+        sys.exit(1)
+    with app.app_context():
+        path = os.path.abspath(sys.argv[1])
+        try:
+            check_header(path)
+        except ProvisioningError as e:
+            print(e)
+            sys.exit(1)
+        # Re-running an interrupted import of the same file resumes it
+        user_import = UserImport.query.filter_by(path=path, status='running').order_by(UserImport.id.desc()).first()
+        if user_import is None:
+            user_import = UserImport(filename=os.path.basename(path), path=path, errors=[])
+            db.session.add(user_import)
+            db.session.commit()
+        started = time.monotonic()
+        run_import(user_import)
+        report = import_report(user_import)
+        print(f"{report['users_created']} users created in {time.monotonic() - started:.1f}s; "
+              f"{report['rows_duplicate']} duplicates and {report['rows_invalid']} invalid rows skipped")
+        for row_number, message in report['errors']:
+            print(f"  row {row_number}: {message}")
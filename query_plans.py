@@ -0,0 +1,152 @@
+from datetime import datetime, timedelta
+import json
+import re
+import sys
+
+from sqlalchemy import func, select, text
+
+from app import app, db
+from models import Booking, Passenger, TrainSchedule, FlightSchedule, RouteAvailability
+
+# Added by migrations/009_hot_query_indexes.sql; dropped (inside a rolled
+# back transaction) to plan the "before" column
+NEW_INDEXES = (
+    'ix_train_schedule_route_departure',
+    'ix_flight_schedule_route_departure',
+    'ix_booking_user_date',
+    'ix_booking_schedule_confirmed',
+    'ix_booking_type_status_class',
+    'ix_passenger_booking_id',
+)
+ANALYZED_TABLES = ('booking', 'passenger', 'train_schedule', 'flight_schedule', 'route_availability')
+SQLITE_INDEX_RE = re.compile(r'USING (?:COVERING )?INDEX (\w+)')
+
+
+def _first(*columns):
+    return db.session.execute(select(*columns).limit(1)).first()
+
+
+def hot_queries():
+    """(name, statement, index it should use) for each hot query, with
+    parameters taken from the data so the planner sees realistic values"""
+    user_id = (_first(Booking.user_id) or (1,))[0]
+    booking_type, schedule_id = _first(Booking.booking_type, Booking.schedule_id) or ('train', 1)
+    booking_ids = [row.id for row in db.session.execute(select(Booking.id).order_by(Booking.id.desc()).limit(20))]
+    now = datetime.utcnow()
+    train = _first(TrainSchedule.departure_station_id, TrainSchedule.arrival_station_id,
+                   TrainSchedule.departure_time) or (1, 2, now)
+    flight = _first(FlightSchedule.departure_airport_id, FlightSchedule.arrival_airport_id,
+                    FlightSchedule.departure_time) or (1, 2, now)
+    route = _first(RouteAvailability.booking_type, RouteAvailability.origin_id, RouteAvailability.destination_id,
+                   RouteAvailability.service_date) or ('train', 1, 2, now.date())
+    return [
+        ('booking_history',
+         select(Booking).where(Booking.user_id == user_id).order_by(Booking.booking_date.desc()),
+         'ix_booking_user_date'),
+        ('schedule_passengers',
+         select(Booking).where(Booking.booking_type == booking_type, Booking.schedule_id == schedule_id,
+                               Booking.status == 'confirmed'),
+         'ix_booking_schedule_confirmed'),
+        ('booking_passengers',
+         select(Passenger).where(Passenger.booking_id.in_(booking_ids or [0])),
+         'ix_passenger_booking_id'),
+        ('report_counts',
+         select(Booking.booking_type, Booking.status, Booking.travel_class, func.count())
+         .group_by(Booking.booking_type, Booking.status, Booking.travel_class),
+         'ix_booking_type_status_class'),
+        ('train_route_departures',
+         select(TrainSchedule.id).where(TrainSchedule.departure_station_id == train[0],
+                                        TrainSchedule.arrival_station_id == train[1],
+                                        TrainSchedule.departure_time >= train[2],
+                                        TrainSchedule.departure_time < train[2] + timedelta(hours=48))
+         .order_by(TrainSchedule.departure_time),
+         'ix_train_schedule_route_departure'),
+        ('flight_route_departures',
+         select(FlightSchedule.id).where(FlightSchedule.departure_airport_id == flight[0],
+                                         FlightSchedule.arrival_airport_id == flight[1],
+                                         FlightSchedule.departure_time >= flight[2],
+                                         FlightSchedule.departure_time < flight[2] + timedelta(hours=48))
+         .order_by(FlightSchedule.departure_time),
+         'ix_flight_schedule_route_departure'),
+        ('route_search',
+         select(RouteAvailability).where(RouteAvailability.booking_type == route[0],
+                                         RouteAvailability.origin_id == route[1],
+                                         RouteAvailability.destination_id == route[2],
+                                         RouteAvailability.service_date == route[3])
+         .order_by(RouteAvailability.departure_time),
+         'ix_route_availability_search'),
+    ]
+
+
+def _plan_indexes(node):
+    names = {node['Index Name']} if 'Index Name' in node else set()
+    for child in node.get('Plans', ()):
+        names |= _plan_indexes(child)
+    return names
+
+
+def explain(statement):
+    """(indexes the plan uses, estimated total cost) for ``statement``; the
+    cost is None on SQLite, which does not estimate one"""
+    connection = db.session.connection()
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={'render_postcompile': True})
+    params = (tuple(compiled.params[name] for name in compiled.positiontup) if compiled.positional
+              else compiled.params)
+    if connection.dialect.name == 'postgresql':
+        plan = connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}', params).scalar()
+        root = (json.loads(plan) if isinstance(plan, str) else plan)[0]['Plan']
+        return _plan_indexes(root), root['Total Cost']
+    details = [row[-1] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', params)]
+    return {match.group(1) for detail in details for match in SQLITE_INDEX_RE.finditer(detail)}, None
+
+
+def analyze():
+    """Refresh the planner statistics of the tables the hot queries read"""
+    if db.engine.dialect.name == 'postgresql':
+        for table in ANALYZED_TABLES:
+            db.session.execute(text(f'ANALYZE {table}'))
+    else:
+        db.session.execute(text('ANALYZE'))
+    db.session.commit()
+
+
+def check_plans(without=()):
+    """{query name: (expected index, indexes used, cost)}, planned as if
+    the indexes in ``without`` did not exist.
+
+    Those are dropped inside a transaction that is rolled back, which needs
+    transactional DDL (PostgreSQL) and blocks writes to their tables until
+    the plans are done; run it against a seeded copy, not production.
+    """
+    if without and db.engine.dialect.name != 'postgresql':
+        raise RuntimeError('Planning without indexes needs PostgreSQL')
+    try:
+        for name in without:
+            db.session.execute(text(f'DROP INDEX IF EXISTS {name}'))
+        return {name: (expected, *explain(statement)) for name, statement, expected in hot_queries()}
+    finally:
+        db.session.rollback()
+
+
+def _describe(expected, used, cost):
+    verdict = 'index' if expected in used else ('other index' if used else 'scan')
+    return f"{verdict}{f' {cost:.1f}' if cost is not None else ''}"
+
+
+if __name__ == "__main__":
+    # python query_plans.py            plans of the hot queries as the schema stands
+    # python query_plans.py --compare  the same with and without NEW_INDEXES (PostgreSQL)
+    compare = '--compare' in sys.argv[1:]
+    with app.app_context():
+        analyze()
+        after = check_plans()
+        before = check_plans(NEW_INDEXES) if compare else None
+        print(f"{'query':<26}{'expected index':<36}{'before':<18}{'after':<18}indexes used")
+        for name, (expected, used, cost) in after.items():
+            was = _describe(*before[name]) if before else '-'
+            print(f"{name:<26}{expected:<36}{was:<18}{_describe(expected, used, cost):<18}"
+                  f"{', '.join(sorted(used)) or '-'}")
+        if not all(expected in used for expected, used, _ in after.values()):
+            # Small tables are often cheaper to scan; judge on a realistic data volume
+            print("Some hot queries do not use their index (see above)")
+            sys.exit(1)
@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from functools import wraps
+import math
+import threading
+import time
+
+from flask import request, session
+
+from app import app
+
+MAX_TRACKED_KEYS = 10000  # per bucket table; least recently seen keys are dropped first
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def take(self, now):
+        """Consume a token; return 0 on success or the seconds until one is available"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class BucketTable:
+    """Token buckets keyed by client (IP, user id, account) with bounded memory"""
+
+    def __init__(self, rate, capacity, max_keys=MAX_TRACKED_KEYS):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.capacity, now)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return bucket.take(now)
+
+
+class AdmissionGate:
+    """Process-wide cap on in-flight limited requests.
+
+    ``reserved`` slots can only be used by priority (checkout) requests, so a
+    flood of browsing traffic cannot take the last workers away from /book.
+    Priority requests may also wait briefly for a slot; others are shed.
+    """
+
+    def __init__(self, capacity, reserved):
+        self.capacity = capacity
+        self.reserved = reserved
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def enter(self, priority=False, timeout=0):
+        limit = self.capacity if priority else self.capacity - self.reserved
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.in_flight >= limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+
+class Policy:
+    def __init__(self, name, concurrency, per_ip=None, per_user=None, per_account=None,
+                 methods=('GET', 'POST'), priority=False, queue_timeout=0):
+        self.name = name
+        self.methods = methods
+        self.priority = priority
+        self.queue_timeout = queue_timeout
+        self.concurrency = concurrency
+        self.in_flight = threading.BoundedSemaphore(concurrency)
+        # (requests per second, burst)
+        self.per_ip = BucketTable(*per_ip) if per_ip else None
+        self.per_user = BucketTable(*per_user) if per_user else None
+        self.per_account = BucketTable(*per_account) if per_account else None
+        self.rate_limited = 0
+        self.shed = 0
+
+    def retry_after(self):
+        """Charge every applicable bucket; return the longest wait, 0 if allowed"""
+        waits = []
+        if self.per_ip:
+            waits.append(self.per_ip.take(request.remote_addr))
+        # Read the user id straight from the session to avoid loading the User
+        user_id = session.get('_user_id')
+        if self.per_user and user_id:
+            waits.append(self.per_user.take(user_id))
+        account = request.form.get('email', '').strip().lower()
+        if self.per_account and account:
+            waits.append(self.per_account.take(account))
+        return max(waits, default=0)
+
+
+gate = AdmissionGate(capacity=32, reserved=8)
+
+POLICIES = {
+    'search': Policy('search', concurrency=8, per_ip=(2, 20), per_user=(2, 20)),
+    'login': Policy('login', concurrency=4, per_ip=(0.2, 10), per_account=(5 / 60, 5), methods=('POST',)),
+    'book': Policy('book', concurrency=16, per_ip=(1, 20), per_user=(0.5, 5), methods=('POST',),
+                   priority=True, queue_timeout=2),
+}
+
+
+def too_many_requests(retry_after):
+    return ('Too many requests. Please slow down and try again shortly.', 429,
+            {'Retry-After': str(max(1, math.ceil(retry_after)))})
+
+
+def service_unavailable():
+    return ('We are experiencing high demand. Please try again in a moment.', 503,
+            {'Retry-After': '1'})
+
+
+def admission_control(name):
+    """Rate-limit and cap concurrency of a view before it touches the database.
+
+    Place it between ``@app.route`` and ``@login_required`` so rejected
+    requests never load the current user.
+    """
+    policy = POLICIES[name]
+
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if not app.config.get('RATELIMIT_ENABLED', True) or request.method not in policy.methods:
+                return view(*args, **kwargs)
+
+            retry_after = policy.retry_after()
+            if retry_after:
+                policy.rate_limited += 1
+                return too_many_requests(retry_after)
+
+            if not policy.in_flight.acquire(timeout=policy.queue_timeout):
+                policy.shed += 1
+                return service_unavailable()
+            try:
+                if not gate.enter(policy.priority, policy.queue_timeout):
+                    policy.shed += 1
+                    return service_unavailable()
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    gate.leave()
+            finally:
+                policy.in_flight.release()
+        return wrapped
+    return decorator
+
+
+def limiter_stats():
+    """Counters for the admin/metrics surface"""
+    return {
+        'in_flight': gate.in_flight,
+        'capacity': gate.capacity,
+        'reserved_for_checkout': gate.reserved,
+        'endpoints': {
+            name: {
+                'concurrency': policy.concurrency,
+                'rate_limited': policy.rate_limited,
+                'shed': policy.shed,
+            } for name, policy in POLICIES.items()
+        },
+    }
@@ -2,14 +2,42 @@ from flask import render_template, flash, redirect, url_for, request, jsonify, a
 from flask_login import login_user, logout_user, current_user, login_required
 from werkzeug.urls import urlsplit
 from datetime import datetime, timedelta
-from sqlalchemy import or_
+from itertools import groupby
+import time
 
 from app import app, db
-from models import User, Train, Flight, TrainSchedule, FlightSchedule, Booking, Passenger, Station, Airport
+from models import User, Train, Flight, TrainSchedule, FlightSchedule, Booking, Passenger, Station, Airport, WaitlistEntry, Job, FeedCursor, Disruption, UserImport, booking_schedule_options
 from forms import (
     LoginForm, RegistrationForm, SearchForm, BookingForm, PassengerForm,
     TrainScheduleForm, FlightScheduleForm, TrainForm, FlightForm, StationForm, AirportForm
 )
+from idempotency import new_idempotency_key, begin_idempotent_request
+from inventory import TRAVEL_CLASSES, InventoryError, SoldOutError, lock_schedule
+from itinerary import ItineraryError, book_itinerary, itinerary_to_dict
+from waitlist import join_waitlist, waitlist_position, enqueue_waitlist_promotion
+from notifications import enqueue_booking_notification
+from ratelimit import admission_control, limiter_stats
+from db_routing import read_only
+from db_pool import pool_stats
+from eticket import enqueue_eticket_render, current_eticket, send_artifact, ARTIFACT_TYPES, DIGEST_RE
+from archive import user_bookings, booking_counts
+from availability import FLEXIBLE_MAX_DAYS, match_places, cached_search_availability
+from fares import route_fare_calendar
+from planner import plan_journeys
+from timeline import SCHEDULE_COLUMNS, schedule_conflicts
+from seating import reserve_journey, release_journey, booked_seats, leg_occupancy, free_on_legs
+from stops import journey_legs, journey_price
+from changefeed import READ_BATCH, read_events, event_to_dict, head_position
+from disruption import cancel_schedule, disruption_report
+from bulkops import (
+    BULK_OPERATIONS, BulkError, ScheduleFilter, in_use, reprice, shift_times, change_vehicle, delete_unused
+)
+from searchlog import record_search, search_log_stats
+from provisioning import ProvisioningError, start_import, import_report
+from waitingroom import (
+    DEFAULT_ADMITS_PER_MINUTE, waiting_room, get_room, queue_state, session_token, admitted_through,
+    open_room, close_room
+)
 
 
 # Helper Functions
@@ -17,6 +45,21 @@ def is_admin():
     return current_user.is_authenticated and current_user.is_admin
 
 
+def has_schedule_conflicts(form, booking_type, schedule_id=None):
+    """Check a schedule form against the vehicle's other trips.
+
+    Overlaps and departures from somewhere other than where the vehicle last
+    arrived are added as errors on the vehicle field.
+    """
+    vehicle_field, origin_field, destination_field = (getattr(form, column) for column in SCHEDULE_COLUMNS[booking_type])
+    problems = schedule_conflicts(
+        booking_type, vehicle_field.data, origin_field.data, destination_field.data,
+        form.departure_time.data, form.arrival_time.data, schedule_id
+    )
+    vehicle_field.errors = list(vehicle_field.errors) + problems
+    return bool(problems)
+
+
 # Error Handlers
 @app.errorhandler(404)
 def not_found_error(error):
@@ -37,6 +80,7 @@ def index():
 
 
 @app.route('/login', methods=['GET', 'POST'])
+@admission_control('login')
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
@@ -96,6 +140,8 @@ def register():
 
 # Booking Routes
 @app.route('/search', methods=['GET', 'POST'])
+@admission_control('search')
+@read_only
 def search():
     form = SearchForm()
     
@@ -107,84 +153,169 @@ def search():
         departure_date = form.departure_date.data if form.validate_on_submit() else datetime.strptime(departure_date_str, '%Y-%m-%d').date() if departure_date_str else None
         travel_class = form.travel_class.data if form.validate_on_submit() else request.args.get('travel_class', 'economy')
         passengers = form.passengers.data if form.validate_on_submit() else int(request.args.get('passengers', 1))
+        flexible_days = form.flexible_days.data if form.validate_on_submit() else int(request.args.get('flexible_days', 0))
+        sort = form.sort.data if form.validate_on_submit() else request.args.get('sort', 'departure')
+        flexible_days = max(0, min(flexible_days, FLEXIBLE_MAX_DAYS))
+        if travel_class not in TRAVEL_CLASSES:
+            travel_class = 'economy'
+
+        # One range read on the route availability read model, covering
+        # departure_date +/- flexible_days and grouped by day; popular
+        # searches are usually already cached (see searchlog.prewarm)
+        booking_type = 'train' if booking_type == 'train' else 'flight'
+        started = time.perf_counter()
+        origin_ids = match_places(booking_type, source)
+        destination_ids = match_places(booking_type, destination)
+        schedules = cached_search_availability(
+            booking_type,
+            origin_ids,
+            destination_ids,
+            departure_date - timedelta(days=flexible_days),
+            departure_date + timedelta(days=flexible_days),
+            travel_class=travel_class,
+            sort=sort
+        )
+        record_search(booking_type, origin_ids, destination_ids, departure_date, travel_class, sort, flexible_days,
+                      passengers, len(schedules), time.perf_counter() - started)
+        schedule_days = [(day, list(rows)) for day, rows in groupby(schedules, key=lambda row: row.service_date)]
+        
+        return render_template(
+            f'bookings/{booking_type}_search.html',
+            title=f'{booking_type.capitalize()} Search Results',
+            schedules=schedules,
+            schedule_days=schedule_days,
+            form=form,
+            booking_type=booking_type,
+            source=source,
+            destination=destination,
+            departure_date=departure_date,
+            flexible_days=flexible_days,
+            sort=sort,
+            travel_class=travel_class,
+            passengers=passengers
+        )
+    
+    return render_template('bookings/search.html', title='Search', form=form)
 
-        if booking_type == 'train':
-            # Get source and destination stations
-            source_stations = Station.query.filter(
-                or_(Station.name.ilike(f'%{source}%'), Station.code.ilike(f'%{source}%'), Station.city.ilike(f'%{source}%'))
-            ).all()
-            
-            destination_stations = Station.query.filter(
-                or_(Station.name.ilike(f'%{destination}%'), Station.code.ilike(f'%{destination}%'), Station.city.ilike(f'%{destination}%'))
-            ).all()
-            
-            source_station_ids = [station.id for station in source_stations]
-            destination_station_ids = [station.id for station in destination_stations]
-            
-            # Get train schedules
-            schedules = TrainSchedule.query.filter(
-                TrainSchedule.departure_station_id.in_(source_station_ids),
-                TrainSchedule.arrival_station_id.in_(destination_station_ids),
-                TrainSchedule.departure_time >= departure_date,
-                TrainSchedule.departure_time < departure_date + timedelta(days=1)
-            ).all()
-            
-            return render_template(
-                'booking/train_search.html',
-                title='Train Search Results',
-                schedules=schedules,
-                form=form,
-                booking_type=booking_type,
-                source=source,
-                destination=destination,
-                departure_date=departure_date,
-                travel_class=travel_class,
-                passengers=passengers
-            )
-        else:  # Flight search
-            # Get source and destination airports
-            source_airports = Airport.query.filter(
-                or_(Airport.name.ilike(f'%{source}%'), Airport.code.ilike(f'%{source}%'), Airport.city.ilike(f'%{source}%'))
-            ).all()
-            
-            destination_airports = Airport.query.filter(
-                or_(Airport.name.ilike(f'%{destination}%'), Airport.code.ilike(f'%{destination}%'), Airport.city.ilike(f'%{destination}%'))
-            ).all()
-            
-            source_airport_ids = [airport.id for airport in source_airports]
-            destination_airport_ids = [airport.id for airport in destination_airports]
-            
-            # Get flight schedules
-            schedules = FlightSchedule.query.filter(
-                FlightSchedule.departure_airport_id.in_(source_airport_ids),
-                FlightSchedule.arrival_airport_id.in_(destination_airport_ids),
-                FlightSchedule.departure_time >= departure_date,
-                FlightSchedule.departure_time < departure_date + timedelta(days=1)
-            ).all()
-            
-            return render_template(
-                'booking/flight_search.html',
-                title='Flight Search Results',
-                schedules=schedules,
-                form=form,
-                booking_type=booking_type,
-                source=source,
-                destination=destination,
-                departure_date=departure_date,
-                travel_class=travel_class,
-                passengers=passengers
-            )
+
+@app.route('/fare-calendar')
+@admission_control('search')
+@read_only
+def fare_calendar():
+    booking_type = request.args.get('booking_type', 'train')
+    source = request.args.get('source', '')
+    destination = request.args.get('destination', '')
+    travel_class = request.args.get('travel_class', 'economy')
+    passengers = int(request.args.get('passengers', 1))
+    month = request.args.get('month') or datetime.utcnow().strftime('%Y-%m')
+    
+    try:
+        first_day, days = route_fare_calendar(booking_type, source, destination, travel_class, month)
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('search'))
+    
+    fares = [day['min_price'] for day in days if day['min_price'] is not None]
+    cells = [None] * first_day.weekday() + days  # weeks start on Monday
+    previous_month = (first_day - timedelta(days=1)).strftime('%Y-%m')
+    next_month = (first_day + timedelta(days=len(days))).strftime('%Y-%m')
     
-    return render_template('booking/search.html', title='Search', form=form)
+    return render_template(
+        'bookings/fare_calendar.html',
+        title='Fare Calendar',
+        weeks=[cells[i:i + 7] for i in range(0, len(cells), 7)],
+        first_day=first_day,
+        cheapest=min(fares) if fares else None,
+        previous_month=previous_month,
+        next_month=next_month,
+        booking_type=booking_type,
+        source=source,
+        destination=destination,
+        travel_class=travel_class,
+        passengers=passengers
+    )
+
+
+@app.route('/api/fare-calendar')
+@admission_control('search')
+@read_only
+def fare_calendar_api():
+    try:
+        first_day, days = route_fare_calendar(
+            request.args.get('booking_type', 'train'),
+            request.args.get('source', ''),
+            request.args.get('destination', ''),
+            request.args.get('travel_class', 'economy'),
+            request.args.get('month') or datetime.utcnow().strftime('%Y-%m')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'month': first_day.strftime('%Y-%m'),
+        'days': [dict(day, date=day['date'].isoformat()) for day in days]
+    })
+
+
+@app.route('/plan')
+@admission_control('search')
+@read_only
+def plan_journey():
+    """Combined train and flight itineraries between two cities"""
+    source = request.args.get('source', '').strip()
+    destination = request.args.get('destination', '').strip()
+    travel_class = request.args.get('travel_class', 'economy')
+    passengers = int(request.args.get('passengers', 1))
+    departure_date_str = request.args.get('departure_date')
+    if travel_class not in TRAVEL_CLASSES:
+        travel_class = 'economy'
+    
+    itineraries, complete = [], True
+    departure_date = None
+    if source and destination and departure_date_str:
+        try:
+            departure_date = datetime.strptime(departure_date_str, '%Y-%m-%d').date()
+        except ValueError:
+            flash('Please enter a valid departure date', 'danger')
+        else:
+            itineraries, complete = plan_journeys(source, destination, departure_date, travel_class, passengers)
+    
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'complete': complete,
+            'itineraries': [dict(
+                itinerary,
+                departure_time=itinerary['departure_time'].isoformat(),
+                arrival_time=itinerary['arrival_time'].isoformat(),
+                duration=int(itinerary['duration'].total_seconds() // 60),
+                legs=[dict(leg, departure_time=leg['departure_time'].isoformat(),
+                           arrival_time=leg['arrival_time'].isoformat()) for leg in itinerary['legs']]
+            ) for itinerary in itineraries]
+        })
+    
+    return render_template(
+        'bookings/plan.html',
+        title='Plan a Journey',
+        itineraries=itineraries,
+        complete=complete,
+        source=source,
+        destination=destination,
+        departure_date=departure_date,
+        travel_class=travel_class,
+        passengers=passengers
+    )
 
 
 @app.route('/select-seat', methods=['GET', 'POST'])
 @login_required
+@waiting_room
 def select_seat():
     schedule_id = request.args.get('schedule_id')
     booking_type = request.args.get('booking_type')
     travel_class = request.args.get('travel_class')
     passengers = int(request.args.get('passengers', 1))
+    board_stop = request.args.get('board_stop', type=int)
+    alight_stop = request.args.get('alight_stop', type=int)
     
     if not all([schedule_id, booking_type, travel_class]):
         flash('Missing required information for seat selection', 'danger')
@@ -196,6 +327,11 @@ def select_seat():
     booking_form.booking_type.data = booking_type
     booking_form.travel_class.data = travel_class
     booking_form.passengers.data = passengers
+    booking_form.board_stop.data = board_stop
+    booking_form.alight_stop.data = alight_stop
+    booking_form.idempotency_key.data = new_idempotency_key()
+    # Sold-out search results link here to queue for the service
+    booking_form.join_waitlist.data = request.args.get('join_waitlist') == '1' and board_stop is None
     
     # Create passenger forms
     passenger_forms = []
@@ -238,16 +374,31 @@ def select_seat():
             'first': schedule.first_price
         }
     
+    # A sub-journey of a train with stops is priced and seated on its own legs
+    try:
+        legs = journey_legs(schedule, booking_type, board_stop, alight_stop)
+    except InventoryError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('search'))
+    journey_stops = None
+    if board_stop is not None:
+        journey_stops = (schedule.stops[board_stop], schedule.stops[alight_stop])
+        price[travel_class] = journey_price(schedule, booking_type, travel_class, board_stop, alight_stop)
+        occupancy = leg_occupancy(booking_type, [schedule.id]).get((schedule.id, travel_class), {})
+        available_seats[travel_class] = free_on_legs(total_seats[travel_class], occupancy, legs)
+    
     total_price = price[travel_class] * passengers
     
     return render_template(
-        'booking/select_seat.html',
+        'bookings/select_seat.html',
         title='Select Seats',
         schedule=schedule,
         booking_type=booking_type,
         travel_class=travel_class,
         total_seats=total_seats[travel_class],
         available_seats=available_seats[travel_class],
+        booked_seats=booked_seats(schedule, booking_type, travel_class, board_stop, alight_stop),
+        journey_stops=journey_stops,
         passengers=passengers,
         passenger_forms=passenger_forms,
         booking_form=booking_form,
@@ -256,8 +407,26 @@ def select_seat():
     )
 
 
+def replayed_booking(existing):
+    """Answer a replayed /book POST with the outcome of the original one"""
+    booking_id = existing.booking_id
+    if booking_id is None and existing.waitlist_entry_id is not None:
+        entry = db.session.get(WaitlistEntry, existing.waitlist_entry_id)
+        booking_id = entry.booking_id if entry is not None else None  # set once the entry has been promoted
+        if booking_id is None:
+            flash('You are already on the waitlist for this booking.', 'info')
+            return redirect(url_for('booking_history'))
+    if booking_id is None:
+        flash('This booking request has already been handled.', 'info')
+        return redirect(url_for('booking_history'))
+    flash('This booking has already been confirmed.', 'info')
+    return redirect(url_for('booking_confirmation', booking_id=booking_id))
+
+
 @app.route('/book', methods=['POST'])
+@admission_control('book')
 @login_required
+@waiting_room
 def book():
     booking_form = BookingForm()
     
@@ -266,34 +435,61 @@ def book():
         booking_type = booking_form.booking_type.data
         travel_class = booking_form.travel_class.data
         passengers = int(booking_form.passengers.data)
+        idempotency_key = booking_form.idempotency_key.data
+        board_stop = booking_form.board_stop.data
+        alight_stop = booking_form.alight_stop.data
         
-        # Get price information
-        if booking_type == 'train':
-            schedule = TrainSchedule.query.get_or_404(schedule_id)
-            if travel_class == 'economy':
-                price = schedule.economy_price
-                available_seats = schedule.available_seats_economy
-            elif travel_class == 'business':
-                price = schedule.business_price
-                available_seats = schedule.available_seats_business
-            else:  # first class
-                price = schedule.first_price
-                available_seats = schedule.available_seats_first
-        else:  # Flight
-            schedule = FlightSchedule.query.get_or_404(schedule_id)
-            if travel_class == 'economy':
-                price = schedule.economy_price
-                available_seats = schedule.available_seats_economy
-            elif travel_class == 'business':
-                price = schedule.business_price
-                available_seats = schedule.available_seats_business
-            else:  # first class
-                price = schedule.first_price
-                available_seats = schedule.available_seats_first
+        # Replayed submissions get the original confirmation
+        existing, idempotency_record = begin_idempotent_request(current_user.id, idempotency_key)
+        if existing is not None:
+            return replayed_booking(existing)
         
-        # Check seat availability
-        if available_seats < passengers:
-            flash(f'Not enough seats available. Only {available_seats} seats left.', 'danger')
+        # Collect passenger details
+        passenger_details = []
+        for i in range(passengers):
+            passenger_form = PassengerForm(prefix=f'passenger_{i}')
+            if passenger_form.validate():
+                passenger_details.append({
+                    'first_name': passenger_form.first_name.data,
+                    'last_name': passenger_form.last_name.data,
+                    'age': passenger_form.age.data,
+                    'gender': passenger_form.gender.data,
+                    'seat_number': passenger_form.seat_number.data,
+                    'meal_preference': passenger_form.meal_preference.data
+                })
+        
+        # Lock the schedule row so concurrent checkouts cannot oversell it
+        try:
+            schedule = lock_schedule(booking_type, schedule_id)
+            price = journey_price(schedule, booking_type, travel_class, board_stop, alight_stop)
+            # Passengers who did not pick a seat are seated together; a
+            # sub-journey only takes its seats on the legs it travels
+            seats = reserve_journey(schedule, booking_type, travel_class,
+                                    [details['seat_number'] for details in passenger_details],
+                                    board_stop, alight_stop)
+            for details, seat in zip(passenger_details, seats):
+                details['seat_number'] = seat
+        except SoldOutError as e:
+            db.session.rollback()
+            if booking_form.join_waitlist.data and passenger_details and board_stop is None:
+                # The rollback released the idempotency key; claim it again
+                # so a replay finds this entry instead of queueing twice
+                existing, idempotency_record = begin_idempotent_request(current_user.id, idempotency_key)
+                if existing is not None:
+                    return replayed_booking(existing)
+                entry = join_waitlist(current_user.id, booking_type, schedule_id, travel_class, passenger_details)
+                if idempotency_record is not None:
+                    db.session.flush()
+                    idempotency_record.waitlist_entry_id = entry.id
+                db.session.commit()
+                flash(f'Not enough seats right now. You are number {waitlist_position(entry)} on the waitlist '
+                      'and will be booked automatically when seats free up.', 'info')
+                return redirect(url_for('booking_history'))
+            flash(str(e), 'danger')
+            return redirect(url_for('search'))
+        except InventoryError as e:
+            db.session.rollback()
+            flash(str(e), 'danger')
             return redirect(url_for('search'))
         
         # Create booking
@@ -304,42 +500,23 @@ def book():
             schedule_id=schedule_id,
             travel_class=travel_class,
             total_amount=total_amount,
-            status='confirmed'
+            status='confirmed',
+            board_stop=board_stop,
+            alight_stop=alight_stop
         )
         
         db.session.add(booking)
         db.session.flush()  # Flush to get the booking ID
         
         # Add passengers
-        for i in range(passengers):
-            passenger_form = PassengerForm(prefix=f'passenger_{i}')
-            if passenger_form.validate():
-                passenger = Passenger(
-                    booking_id=booking.id,
-                    first_name=passenger_form.first_name.data,
-                    last_name=passenger_form.last_name.data,
-                    age=passenger_form.age.data,
-                    gender=passenger_form.gender.data,
-                    seat_number=passenger_form.seat_number.data,
-                    meal_preference=passenger_form.meal_preference.data
-                )
-                db.session.add(passenger)
+        for details in passenger_details:
+            db.session.add(Passenger(booking_id=booking.id, **details))
         
-        # Update available seats
-        if booking_type == 'train':
-            if travel_class == 'economy':
-                schedule.available_seats_economy -= passengers
-            elif travel_class == 'business':
-                schedule.available_seats_business -= passengers
-            else:  # first class
-                schedule.available_seats_first -= passengers
-        else:  # Flight
-            if travel_class == 'economy':
-                schedule.available_seats_economy -= passengers
-            elif travel_class == 'business':
-                schedule.available_seats_business -= passengers
-            else:  # first class
-                schedule.available_seats_first -= passengers
+        if idempotency_record is not None:
+            idempotency_record.booking_id = booking.id
+        
+        enqueue_booking_notification(booking, 'confirmed')
+        enqueue_eticket_render(booking)
         
         db.session.commit()
         
@@ -350,63 +527,161 @@ def book():
     return redirect(url_for('search'))
 
 
+@app.route('/api/itineraries', methods=['POST'])
+@admission_control('book')
+@login_required
+def book_itinerary_api():
+    """Book several train/flight segments (e.g. a return trip) all or nothing"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    idempotency_key = str(data.get('idempotency_key') or '')[:64]
+    
+    existing, idempotency_record = begin_idempotent_request(current_user.id, idempotency_key)
+    if existing is not None:
+        # Keys are shared with /book, whose bookings have no itinerary
+        booking = db.session.get(Booking, existing.booking_id) if existing.booking_id else None
+        if booking is None or booking.itinerary is None:
+            return jsonify({'error': 'This idempotency key was already used for another request'}), 422
+        return jsonify(itinerary_to_dict(booking.itinerary)), 200
+    
+    try:
+        itinerary = book_itinerary(current_user.id, data.get('segments'), data.get('passengers'))
+    except ItineraryError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except InventoryError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 409
+    
+    if idempotency_record is not None:
+        idempotency_record.booking_id = itinerary.bookings[0].id
+    
+    for booking in itinerary.bookings:
+        enqueue_booking_notification(booking, 'confirmed')
+        enqueue_eticket_render(booking)
+    
+    db.session.commit()
+    
+    return jsonify(itinerary_to_dict(itinerary)), 201
+
+
+@app.route('/waiting-room/<booking_type>/<int:schedule_id>')
+def waiting_room_page(booking_type, schedule_id):
+    next_page = request.args.get('next')
+    if not next_page or urlsplit(next_page).netloc != '':
+        next_page = url_for('search')
+    
+    room = get_room(booking_type, schedule_id)
+    state, position, seconds = queue_state(room, session_token(booking_type, schedule_id)) if room else ('open', None, 0)
+    # Admitted visitors, and those without a ticket yet, go back through the decorator
+    if state != 'waiting':
+        return redirect(next_page)
+    
+    return render_template(
+        'bookings/waiting_room.html',
+        title='Waiting Room',
+        booking_type=booking_type,
+        schedule_id=schedule_id,
+        position=position,
+        ahead=max(0, position - admitted_through(room, datetime.utcnow())),
+        wait_seconds=int(seconds),
+        next_page=next_page
+    )
+
+
+@app.route('/api/waiting-room/status')
+def waiting_room_status():
+    """Queue position for the waiting page to poll; touches only the cached room, never the schedules"""
+    booking_type = request.args.get('booking_type')
+    schedule_id = request.args.get('schedule_id', type=int)
+    room = get_room(booking_type, schedule_id) if booking_type and schedule_id else None
+    
+    if room is None:
+        payload = {'state': 'open', 'retry_after': 0}
+    else:
+        token = request.args.get('token') or session_token(booking_type, schedule_id)
+        state, position, seconds = queue_state(room, token)
+        through = admitted_through(room, datetime.utcnow())
+        payload = {
+            'state': state,
+            'position': position,
+            'admitted_through': through,
+            'ahead': max(0, position - through) if position is not None else None,
+            'seconds': int(seconds),
+            # Poll about twice before the expected turn, but not more than every 2s
+            'retry_after': min(30, max(2, int(seconds / 2))) if state == 'waiting' else 0
+        }
+    
+    response = jsonify(payload)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
 @app.route('/booking/confirmation/<int:booking_id>')
 @login_required
+@read_only
 def booking_confirmation(booking_id):
-    booking = Booking.query.get_or_404(booking_id)
+    booking = Booking.query.options(*booking_schedule_options()).filter_by(id=booking_id).first_or_404()
     
     # Ensure user can only view their own bookings
     if booking.user_id != current_user.id and not current_user.is_admin:
         flash('You are not authorized to view this booking', 'danger')
         return redirect(url_for('index'))
     
-    if booking.booking_type == 'train':
-        schedule = TrainSchedule.query.get(booking.schedule_id)
-    else:  # Flight
-        schedule = FlightSchedule.query.get(booking.schedule_id)
-    
+    # Links to the pre-rendered e-ticket once the render job has caught up
     return render_template(
-        'booking/confirmation.html',
+        'bookings/confirmation.html',
         title='Booking Confirmation',
         booking=booking,
-        schedule=schedule
+        schedule=booking.schedule,
+        eticket=current_eticket(booking)
     )
 
 
+@app.route('/booking/<int:booking_id>/ticket/<digest>.<ext>')
+@login_required
+@read_only
+def eticket_artifact(booking_id, digest, ext):
+    booking = Booking.query.get_or_404(booking_id)
+    
+    if booking.user_id != current_user.id and not current_user.is_admin:
+        abort(404)
+    
+    # Only digests recorded for this booking are served
+    eticket = booking.eticket
+    if (eticket is None or ext not in ARTIFACT_TYPES or not DIGEST_RE.match(digest)
+            or digest not in (eticket.html_digest, eticket.pdf_digest, eticket.qr_digest)):
+        abort(404)
+    
+    return send_artifact(digest, ext)
+
+
 @app.route('/booking/cancel/<int:booking_id>', methods=['POST'])
 @login_required
 def cancel_booking(booking_id):
-    booking = Booking.query.get_or_404(booking_id)
+    booking = Booking.query.filter_by(id=booking_id).with_for_update().first_or_404()
     
     # Ensure user can only cancel their own bookings
     if booking.user_id != current_user.id and not current_user.is_admin:
         flash('You are not authorized to cancel this booking', 'danger')
         return redirect(url_for('index'))
     
+    if booking.status == 'cancelled':
+        flash('This booking has already been cancelled', 'info')
+        return redirect(url_for('booking_history'))
+    
     # Update booking status
     booking.status = 'cancelled'
     
     # Return seats to available pool
-    if booking.booking_type == 'train':
-        schedule = TrainSchedule.query.get(booking.schedule_id)
-        passengers_count = len(booking.passengers)
-        
-        if booking.travel_class == 'economy':
-            schedule.available_seats_economy += passengers_count
-        elif booking.travel_class == 'business':
-            schedule.available_seats_business += passengers_count
-        else:  # first class
-            schedule.available_seats_first += passengers_count
-    else:  # Flight
-        schedule = FlightSchedule.query.get(booking.schedule_id)
-        passengers_count = len(booking.passengers)
-        
-        if booking.travel_class == 'economy':
-            schedule.available_seats_economy += passengers_count
-        elif booking.travel_class == 'business':
-            schedule.available_seats_business += passengers_count
-        else:  # first class
-            schedule.available_seats_first += passengers_count
+    schedule = lock_schedule(booking.booking_type, booking.schedule_id)
+    release_journey(schedule, booking)
+    
+    # Follow-up work commits (or not) together with the cancellation; the
+    # freed seats reach the waitlist through the inventory change feed
+    enqueue_booking_notification(booking, 'cancelled')
+    enqueue_eticket_render(booking)
     
     db.session.commit()
     
@@ -423,27 +698,26 @@ def profile():
 
 @app.route('/booking/history')
 @login_required
+@read_only
 def booking_history():
-    bookings = Booking.query.filter_by(user_id=current_user.id).order_by(Booking.booking_date.desc()).all()
-    
-    # Get schedule details for each booking
+    # Recent bookings live in the hot tables, long-departed ones in the archive
     booking_details = []
-    for booking in bookings:
+    for booking, schedule, archived in user_bookings(current_user.id):
         if booking.booking_type == 'train':
-            schedule = TrainSchedule.query.get(booking.schedule_id)
             details = {
                 'booking': booking,
                 'schedule': schedule,
+                'archived': archived,
                 'source': schedule.departure_station.name if schedule else 'Unknown',
                 'destination': schedule.arrival_station.name if schedule else 'Unknown',
                 'departure_time': schedule.departure_time if schedule else 'Unknown',
                 'arrival_time': schedule.arrival_time if schedule else 'Unknown'
             }
         else:  # Flight
-            schedule = FlightSchedule.query.get(booking.schedule_id)
             details = {
                 'booking': booking,
                 'schedule': schedule,
+                'archived': archived,
                 'source': schedule.departure_airport.name if schedule else 'Unknown',
                 'destination': schedule.arrival_airport.name if schedule else 'Unknown',
                 'departure_time': schedule.departure_time if schedule else 'Unknown',
@@ -452,15 +726,41 @@ def booking_history():
         
         booking_details.append(details)
     
+    waitlist_entries = WaitlistEntry.query.filter_by(user_id=current_user.id).order_by(WaitlistEntry.created_at.desc()).all()
+    
     return render_template(
         'user/booking_history.html',
         title='Booking History',
-        booking_details=booking_details
+        booking_details=booking_details,
+        waitlist_entries=waitlist_entries
     )
 
 
+@app.route('/waitlist/cancel/<int:entry_id>', methods=['POST'])
+@login_required
+def cancel_waitlist_entry(entry_id):
+    entry = WaitlistEntry.query.filter_by(id=entry_id).with_for_update().first_or_404()
+    
+    if entry.user_id != current_user.id and not current_user.is_admin:
+        flash('You are not authorized to change this waitlist entry', 'danger')
+        return redirect(url_for('index'))
+    
+    if entry.status != 'waiting':
+        flash('This waitlist entry is no longer waiting', 'info')
+        return redirect(url_for('booking_history'))
+    
+    entry.status = 'cancelled'
+    # Whoever was queued behind may fit now
+    enqueue_waitlist_promotion(entry.booking_type, entry.schedule_id, entry.travel_class)
+    db.session.commit()
+    
+    flash('You have left the waitlist', 'success')
+    return redirect(url_for('booking_history'))
+
+
 @app.route('/admin')
 @login_required
+@read_only
 def admin_dashboard():
     if not is_admin():
         flash('You do not have permission to access the admin area', 'danger')
@@ -492,6 +792,7 @@ def admin_dashboard():
 
 @app.route('/admin/trains')
 @login_required
+@read_only
 def manage_trains():
     if not is_admin():
         flash('You do not have permission to access the admin area', 'danger')
@@ -563,7 +864,7 @@ def delete_train(train_id):
     train = Train.query.get_or_404(train_id)
     
     # Check if train has schedules
-    if train.schedules:
+    if in_use(Train, train.id):
         flash('Cannot delete train with active schedules', 'danger')
         return redirect(url_for('manage_trains'))
     
@@ -576,6 +877,7 @@ def delete_train(train_id):
 
 @app.route('/admin/flights')
 @login_required
+@read_only
 def manage_flights():
     if not is_admin():
         flash('You do not have permission to access the admin area', 'danger')
@@ -649,7 +951,7 @@ def delete_flight(flight_id):
     flight = Flight.query.get_or_404(flight_id)
     
     # Check if flight has schedules
-    if flight.schedules:
+    if in_use(Flight, flight.id):
         flash('Cannot delete flight with active schedules', 'danger')
         return redirect(url_for('manage_flights'))
     
@@ -662,6 +964,7 @@ def delete_flight(flight_id):
 
 @app.route('/admin/train-schedules')
 @login_required
+@read_only
 def manage_train_schedules():
     if not is_admin():
         flash('You do not have permission to access the admin area', 'danger')
@@ -685,7 +988,7 @@ def add_train_schedule():
     form.departure_station_id.choices = [(s.id, f"{s.name} ({s.code})") for s in Station.query.all()]
     form.arrival_station_id.choices = [(s.id, f"{s.name} ({s.code})") for s in Station.query.all()]
     
-    if form.validate_on_submit():
+    if form.validate_on_submit() and not has_schedule_conflicts(form, 'train'):
         train = Train.query.get(form.train_id.data)
         
         schedule = TrainSchedule(
@@ -725,7 +1028,7 @@ def edit_train_schedule(schedule_id):
     form.departure_station_id.choices = [(s.id, f"{s.name} ({s.code})") for s in Station.query.all()]
     form.arrival_station_id.choices = [(s.id, f"{s.name} ({s.code})") for s in Station.query.all()]
 
-    if form.validate_on_submit():
+    if form.validate_on_submit() and not has_schedule_conflicts(form, 'train', schedule.id):
         schedule.train_id = form.train_id.data
         schedule.departure_station_id = form.departure_station_id.data
         schedule.arrival_station_id = form.arrival_station_id.data
@@ -758,6 +1061,7 @@ def delete_train_schedule(schedule_id):
 
 @app.route('/admin/flight-schedules')
 @login_required
+@read_only
 def manage_flight_schedules():
     if not is_admin():
         flash('You do not have permission to access the admin area', 'danger')
@@ -781,7 +1085,7 @@ def add_flight_schedule():
     form.departure_airport_id.choices = [(a.id, f"{a.name} ({a.code})") for a in Airport.query.all()]
     form.arrival_airport_id.choices = [(a.id, f"{a.name} ({a.code})") for a in Airport.query.all()]
 
-    if form.validate_on_submit():
+    if form.validate_on_submit() and not has_schedule_conflicts(form, 'flight'):
         flight = Flight.query.get(form.flight_id.data)
 
         schedule = FlightSchedule(
@@ -810,6 +1114,7 @@ def add_flight_schedule():
 
 @app.route('/admin/stations')
 @login_required
+@read_only
 def manage_stations():
     if not is_admin():
         flash('You do not have permission to access the admin area', 'danger')
@@ -877,7 +1182,10 @@ def delete_station(station_id):
 
     station = Station.query.get_or_404(station_id)
 
-    # Optional: Add logic to prevent deleting stations linked to schedules
+    if in_use(Station, station.id):
+        flash('Cannot delete station with active schedules', 'danger')
+        return redirect(url_for('manage_stations'))
+
     db.session.delete(station)
     db.session.commit()
 
@@ -899,7 +1207,7 @@ def edit_flight_schedule(schedule_id):
     form.departure_airport_id.choices = [(a.id, f"{a.name} ({a.code})") for a in Airport.query.all()]
     form.arrival_airport_id.choices = [(a.id, f"{a.name} ({a.code})") for a in Airport.query.all()]
 
-    if form.validate_on_submit():
+    if form.validate_on_submit() and not has_schedule_conflicts(form, 'flight', schedule.id):
         flight = Flight.query.get(form.flight_id.data)
 
         schedule.flight_id = form.flight_id.data
@@ -936,6 +1244,7 @@ def delete_flight_schedule(schedule_id):
 
 @app.route('/admin/airports')
 @login_required
+@read_only
 def manage_airports():
     if not is_admin():
         flash('You do not have permission to access the admin area', 'danger')
@@ -1003,7 +1312,7 @@ def delete_airport(airport_id):
     airport = Airport.query.get_or_404(airport_id)
 
     # Optional safety check: prevent deletion if schedules exist
-    if airport.departures or airport.arrivals:
+    if in_use(Airport, airport.id):
         flash('Cannot delete airport with active schedules', 'danger')
         return redirect(url_for('manage_airports'))
 
@@ -1015,8 +1324,205 @@ def delete_airport(airport_id):
 
 
 
+@app.route('/admin/metrics')
+@login_required
+def admin_metrics():
+    if not is_admin():
+        abort(403)
+    
+    jobs_by_status = dict(db.session.query(Job.status, db.func.count(Job.id)).group_by(Job.status).all())
+    
+    return jsonify({
+        'profile': app.config['APP_PROFILE'],
+        'pools': pool_stats(db.engines),
+        'rate_limits': limiter_stats(),
+        'jobs': jobs_by_status,
+        'change_feed': {cursor.name: cursor.position for cursor in FeedCursor.query},
+        'search_log': search_log_stats()
+    })
+
+
+@app.route('/admin/inventory-events')
+@login_required
+def admin_inventory_events():
+    """Page through the inventory change feed: pass the returned ``next`` as ``after``"""
+    if not is_admin():
+        abort(403)
+    
+    after = request.args.get('after', 0, type=int)
+    limit = max(1, min(request.args.get('limit', 100, type=int), READ_BATCH))
+    events = read_events(after, limit)
+    
+    return jsonify({
+        'events': [event_to_dict(inventory_event) for inventory_event in events],
+        'next': events[-1].sequence if events else after,
+        'head': head_position()
+    })
+
+
+@app.route('/admin/disruptions', methods=['POST'])
+@login_required
+def admin_cancel_schedule():
+    """Cancel a service (booking_type, schedule_id, reason) and rebook its passengers in the background"""
+    if not is_admin():
+        abort(403)
+    
+    schedule_id = request.form.get('schedule_id', type=int)
+    if schedule_id is None:
+        return jsonify({'error': 'schedule_id is required'}), 400
+    try:
+        disruption = cancel_schedule(request.form.get('booking_type'), schedule_id, request.form.get('reason'))
+    except InventoryError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    
+    response = jsonify(disruption_report(disruption))
+    response.headers['Location'] = url_for('admin_disruption', disruption_id=disruption.id)
+    return response, 202
+
+
+@app.route('/admin/disruptions/<int:disruption_id>')
+@login_required
+def admin_disruption(disruption_id):
+    """Progress and summary of a cancellation's rebooking"""
+    if not is_admin():
+        abort(403)
+    
+    return jsonify(disruption_report(Disruption.query.get_or_404(disruption_id)))
+
+
+@app.route('/admin/users/import', methods=['POST'])
+@login_required
+def admin_import_users():
+    """Provision the users of an uploaded CSV file in the background"""
+    if not is_admin():
+        abort(403)
+    
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({'error': 'Upload a CSV file as "file"'}), 400
+    try:
+        user_import = start_import(upload, requested_by=current_user.id)
+    except ProvisioningError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    response = jsonify(import_report(user_import))
+    response.headers['Location'] = url_for('admin_user_import', import_id=user_import.id)
+    return response, 202
+
+
+@app.route('/admin/users/import/<int:import_id>')
+@login_required
+def admin_user_import(import_id):
+    """Progress of a bulk user import and the rows it skipped"""
+    if not is_admin():
+        abort(403)
+    
+    return jsonify(import_report(UserImport.query.get_or_404(import_id)))
+
+
+@app.route('/admin/bulk/<operation>', methods=['POST'])
+@login_required
+def admin_bulk_operation(operation):
+    """Change many schedules at once; with ``preview=1`` only report what would change.
+    
+    Schedules are selected by booking_type plus any of vehicle_id, origin_id,
+    destination_id, first_date and last_date. reprice takes percent (and
+    optionally travel_class), shift-times minutes, change-vehicle
+    to_vehicle_id; delete-unused takes kind (trains, flights, stations or
+    airports) instead of a selection. Running an operation on every schedule
+    of a booking_type takes ``all=1``.
+    """
+    if not is_admin():
+        abort(403)
+    if operation not in BULK_OPERATIONS:
+        abort(404)
+    
+    form = request.form
+    preview = form.get('preview') == '1'
+    
+    def field(name, parse):
+        # A malformed value must not quietly drop its filter, so only an
+        # absent or empty field counts as "not given"
+        raw = form.get(name, '').strip()
+        if not raw:
+            return None
+        try:
+            return parse(raw)
+        except ValueError:
+            raise BulkError(f'Invalid {name}: {raw}')
+    
+    def parse_date(raw):
+        return datetime.strptime(raw, '%Y-%m-%d').date()
+    
+    argument = {'reprice': ('percent', float), 'shift-times': ('minutes', int),
+                'change-vehicle': ('to_vehicle_id', int), 'delete-unused': ('kind', str)}[operation]
+    try:
+        value = field(*argument)
+        if value is None:
+            return jsonify({'error': f'{argument[0]} is required'}), 400
+        if operation == 'delete-unused':
+            result = delete_unused(value, preview=preview)
+        else:
+            booking_type = form.get('booking_type')
+            filters = ScheduleFilter(
+                vehicle_id=field('vehicle_id', int),
+                origin_id=field('origin_id', int),
+                destination_id=field('destination_id', int),
+                first_date=field('first_date', parse_date),
+                last_date=field('last_date', parse_date)
+            )
+            # Every schedule of a kind only changes when asked for explicitly
+            if not preview and filters == ScheduleFilter() and form.get('all') != '1':
+                raise BulkError('Select schedules with at least one filter, or pass all=1')
+            if operation == 'reprice':
+                classes = [form['travel_class']] if form.get('travel_class') else TRAVEL_CLASSES
+                result = reprice(booking_type, filters, value, classes, preview=preview)
+            elif operation == 'shift-times':
+                result = shift_times(booking_type, filters, value, preview=preview)
+            else:
+                result = change_vehicle(booking_type, filters, value, preview=preview)
+    except (BulkError, InventoryError) as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    
+    result['preview'] = preview
+    return jsonify(result), 409 if result['problems'] else 200
+
+
+@app.route('/admin/waiting-rooms/<booking_type>/<int:schedule_id>', methods=['POST'])
+@login_required
+def admin_waiting_room(booking_type, schedule_id):
+    """Open (``enabled=1``, optional ``admit_per_minute`` and ``initial_admits``) or close a schedule's waiting room"""
+    if not is_admin():
+        abort(403)
+    
+    if request.form.get('enabled', '1') == '1':
+        try:
+            room = open_room(
+                booking_type, schedule_id,
+                request.form.get('admit_per_minute', DEFAULT_ADMITS_PER_MINUTE, type=int),
+                request.form.get('initial_admits', 0, type=int)
+            )
+        except (InventoryError, ValueError) as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 400
+        db.session.commit()
+        return jsonify({
+            'enabled': True,
+            'opened_at': room.opened_at.isoformat(),
+            'admit_per_minute': room.admit_per_minute,
+            'initial_admits': room.initial_admits
+        })
+    
+    close_room(booking_type, schedule_id)
+    db.session.commit()
+    return jsonify({'enabled': False})
+
+
 @app.route('/admin/reports')
 @login_required
+@read_only
 def admin_reports():
     if not is_admin():
         flash('You do not have permission to access the admin area', 'danger')
@@ -1024,20 +1530,26 @@ def admin_reports():
     
     # Basic reporting
     total_users = User.query.count()
-    total_bookings = Booking.query.count()
+    # Booking counts include the archived tier; every breakdown comes from
+    # one grouped count per tier
+    counts = booking_counts()
+    total_bookings = sum(counts.values())
+    
+    def bookings_with(position, value):
+        return sum(bookings for key, bookings in counts.items() if key[position] == value)
     
     # Bookings by type
-    train_bookings = Booking.query.filter_by(booking_type='train').count()
-    flight_bookings = Booking.query.filter_by(booking_type='flight').count()
+    train_bookings = bookings_with(0, 'train')
+    flight_bookings = bookings_with(0, 'flight')
     
     # Bookings by status
-    confirmed_bookings = Booking.query.filter_by(status='confirmed').count()
-    cancelled_bookings = Booking.query.filter_by(status='cancelled').count()
+    confirmed_bookings = bookings_with(1, 'confirmed')
+    cancelled_bookings = bookings_with(1, 'cancelled')
     
     # Bookings by class
-    economy_bookings = Booking.query.filter_by(travel_class='economy').count()
-    business_bookings = Booking.query.filter_by(travel_class='business').count()
-    first_class_bookings = Booking.query.filter_by(travel_class='first').count()
+    economy_bookings = bookings_with(2, 'economy')
+    business_bookings = bookings_with(2, 'business')
+    first_class_bookings = bookings_with(2, 'first')
     
     return render_template(
         'admin/reports.html',
@@ -0,0 +1,15 @@
+# Runs the background jobs that are due once, e.g. from cron or a release
+# script; web workers run them continuously (see main.py). Not jobs.py
+# itself: run as a script it would be a second copy of the module with an
+# empty handler registry.
+from app import app  # noqa: F401  (first: jobs and the handler modules import it)
+from jobs import run_pending_jobs
+# Each of these registers its @job handlers on import
+import notifications  # noqa: F401
+import eticket  # noqa: F401
+import waitlist  # noqa: F401
+import disruption  # noqa: F401
+import provisioning  # noqa: F401
+
+if __name__ == "__main__":
+    print(f"Ran {run_pending_jobs()} jobs")
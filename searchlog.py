@@ -0,0 +1,269 @@
+from collections import Counter
+from datetime import datetime, timedelta
+import atexit
+import logging
+import sys
+import threading
+import time
+
+from sqlalchemy import func, insert
+
+from app import app, db
+from models import SearchLog
+from availability import cached_search_availability
+from fares import fare_calendar
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SIZE = 200  # searches per insert; a full buffer is written without waiting for the interval
+FLUSH_INTERVAL = 5.0  # seconds
+MAX_BUFFERED = 20000  # searches are dropped (and counted) beyond this, e.g. while the database is down
+SKETCH_CAPACITY = 500  # routes tracked by the popular-route sketch
+HALF_LIFE = 3600  # seconds for a route's search count to halve, so the sketch follows current demand
+MAX_WARM_OFFSET = 60  # departure dates further out than this many days are never pre-warmed
+PREWARM_ROUTES = 20
+PREWARM_DATES = 3  # most searched departure dates (as days from today) warmed for each route
+PREWARM_INTERVAL = 60  # seconds; below the search and fare calendar cache lifetimes
+SEED_HOURS = 24  # logged searches replayed into the sketch at startup
+
+
+class SpaceSaving:
+    """Approximate search counts of the most searched routes in bounded memory.
+
+    Space-saving (Metwally et al.): a new route evicts the least counted one
+    and inherits its count as the error, so any route with more than
+    total / capacity searches is always tracked and no count is low.
+    """
+
+    def __init__(self, capacity=SKETCH_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, weight=1):
+        with self._lock:
+            if key in self.counts:
+                self.counts[key] += weight
+            elif len(self.counts) < self.capacity:
+                self.counts[key] = weight
+                self.errors[key] = 0
+            else:
+                evicted = min(self.counts, key=self.counts.get)
+                floor = self.counts.pop(evicted)
+                del self.errors[evicted]
+                self.counts[key] = floor + weight
+                self.errors[key] = floor
+
+    def decay(self, factor):
+        with self._lock:
+            for key in self.counts:
+                self.counts[key] *= factor
+                self.errors[key] *= factor
+
+    def top(self, n):
+        """[(key, count, error)] of the ``n`` most counted keys"""
+        with self._lock:
+            ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:n]
+            return [(key, count, self.errors[key]) for key, count in ranked]
+
+
+# Route key: (booking_type, origin_ids, destination_ids, travel_class, flexible_days, sort), the
+# shape of a search apart from its date, so warmed entries are the ones searches look up
+popular_routes = SpaceSaving()
+_offsets = Counter()  # days from the search to the departure date -> searches
+_buffer = []
+_buffer_lock = threading.Lock()
+_flush_due = threading.Event()
+_dropped = 0
+_worker = None
+
+
+def _ids(ids):
+    return ','.join(str(place_id) for place_id in ids)
+
+
+def record_search(booking_type, origin_ids, destination_ids, departure_date, travel_class, sort, flexible_days,
+                  passengers, results, latency):
+    """Note a search (``latency`` in seconds) for the log and the sketch; never touches the database"""
+    global _dropped
+    origins, destinations = tuple(sorted(origin_ids)), tuple(sorted(destination_ids))
+    offset = (departure_date - datetime.utcnow().date()).days
+    if origins and destinations:
+        popular_routes.add((booking_type, origins, destinations, travel_class, flexible_days, sort))
+    with _buffer_lock:
+        if 0 <= offset <= MAX_WARM_OFFSET:
+            _offsets[offset] += 1
+        if len(_buffer) >= MAX_BUFFERED:
+            _dropped += 1
+            return
+        _buffer.append({
+            'created_at': datetime.utcnow(),
+            'booking_type': booking_type,
+            'origin_ids': _ids(origins),
+            'destination_ids': _ids(destinations),
+            'date_offset': offset,
+            'flexible_days': flexible_days,
+            'travel_class': travel_class,
+            'sort': sort,
+            'passengers': passengers,
+            'results': results,
+            'latency_ms': int(latency * 1000),
+        })
+        full = len(_buffer) >= FLUSH_SIZE
+    if full:
+        _flush_due.set()
+
+
+def flush():
+    """Write the buffered searches with one multi-row insert; returns the number written"""
+    global _dropped
+    with _buffer_lock:
+        rows = _buffer[:]
+        _buffer.clear()
+    if not rows:
+        return 0
+    try:
+        db.session.execute(insert(SearchLog), rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        with _buffer_lock:
+            _dropped += len(rows)
+        raise
+    return len(rows)
+
+
+def seed_popular_routes(hours=SEED_HOURS):
+    """Replay recently logged searches into the sketch, e.g. after a restart"""
+    since = datetime.utcnow() - timedelta(hours=hours)
+    columns = (SearchLog.booking_type, SearchLog.origin_ids, SearchLog.destination_ids, SearchLog.travel_class,
+               SearchLog.flexible_days, SearchLog.sort)
+    seeded = 0
+    for *route, searches in db.session.query(*columns, func.count()).filter(
+            SearchLog.created_at >= since, SearchLog.origin_ids != '', SearchLog.destination_ids != ''
+    ).group_by(*columns):
+        booking_type, origin_ids, destination_ids, travel_class, flexible_days, sort = route
+        popular_routes.add((booking_type, tuple(int(place_id) for place_id in origin_ids.split(',')),
+                            tuple(int(place_id) for place_id in destination_ids.split(',')),
+                            travel_class, flexible_days, sort), searches)
+        seeded += 1
+    offsets = db.session.query(SearchLog.date_offset, func.count()).filter(
+        SearchLog.created_at >= since, SearchLog.date_offset.between(0, MAX_WARM_OFFSET)
+    ).group_by(SearchLog.date_offset)
+    with _buffer_lock:
+        _offsets.update(dict(offsets.all()))
+    return seeded
+
+
+def top_routes(n=PREWARM_ROUTES):
+    return popular_routes.top(n)
+
+
+def prewarm(routes=PREWARM_ROUTES, dates=PREWARM_DATES):
+    """Load the most searched routes into the search and fare calendar caches:
+    results for the most searched departure dates, calendars for this month
+    and the next. Returns the number of routes warmed."""
+    today = datetime.utcnow().date()
+    next_month = today.replace(day=1) + timedelta(days=32)
+    with _buffer_lock:
+        offsets = [offset for offset, _ in _offsets.most_common(dates)] or [0]
+    warmed = 0
+    for (booking_type, origin_ids, destination_ids, travel_class, flexible_days, sort), _, _ in top_routes(routes):
+        for offset in offsets:
+            departure_date = today + timedelta(days=offset)
+            cached_search_availability(booking_type, origin_ids, destination_ids,
+                                       departure_date - timedelta(days=flexible_days),
+                                       departure_date + timedelta(days=flexible_days),
+                                       travel_class=travel_class, sort=sort)
+        for month in (today, next_month):
+            fare_calendar(booking_type, origin_ids, destination_ids, travel_class, month.year, month.month)
+        warmed += 1
+    return warmed
+
+
+def _decay(seconds):
+    factor = 0.5 ** (seconds / HALF_LIFE)
+    popular_routes.decay(factor)
+    with _buffer_lock:
+        for offset in _offsets:
+            _offsets[offset] *= factor
+
+
+def search_log_stats():
+    with _buffer_lock:
+        buffered, dropped = len(_buffer), _dropped
+    return {
+        'buffered': buffered,
+        'dropped': dropped,
+        'top_routes': [
+            {'booking_type': key[0], 'origin_ids': list(key[1]), 'destination_ids': list(key[2]),
+             'travel_class': key[3], 'flexible_days': key[4], 'sort': key[5],
+             'searches': round(count, 1), 'error': round(error, 1)}
+            for key, count, error in top_routes()
+        ],
+    }
+
+
+class SearchLogWorker(threading.Thread):
+    """Writes the search log in batches and keeps the popular routes warm"""
+
+    def __init__(self):
+        super().__init__(name='search-log', daemon=True)
+
+    def run(self):
+        with app.app_context():
+            try:
+                seed_popular_routes()
+            except Exception:
+                db.session.rollback()
+                logger.exception("Could not seed the popular-route sketch from the search log")
+            finally:
+                db.session.remove()
+        warmed_at = None
+        while True:
+            with app.app_context():
+                try:
+                    now = time.monotonic()
+                    if warmed_at is None or now - warmed_at >= PREWARM_INTERVAL:
+                        if warmed_at is not None:
+                            _decay(now - warmed_at)
+                        warmed_at = now
+                        prewarm()
+                    flush()
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("Search log worker failed; retrying in %ss", FLUSH_INTERVAL)
+                finally:
+                    db.session.remove()
+            _flush_due.wait(FLUSH_INTERVAL)
+            _flush_due.clear()
+
+
+def _flush_at_exit():
+    with app.app_context():
+        try:
+            flush()
+        except Exception:
+            logger.exception("Could not write the last searches")
+        finally:
+            db.session.remove()
+
+
+def start_search_log():
+    """Start the search log worker once per process"""
+    global _worker
+    if _worker is None:
+        _worker = SearchLogWorker()
+        _worker.start()
+        atexit.register(_flush_at_exit)
+    return _worker
+
+
+if __name__ == "__main__":
+    # Caches are per process, so only the ranking is of use from here
+    with app.app_context():
+        seed_popular_routes(int(sys.argv[1]) if len(sys.argv) > 1 else SEED_HOURS)
+        for (booking_type, origin_ids, destination_ids, travel_class, flexible_days, sort), count, _ in top_routes():
+            print(f"{count:>8.0f}  {booking_type:<7}{_ids(origin_ids):>15} -> {_ids(destination_ids):<15}"
+                  f"{travel_class:<10}+/-{flexible_days}d by {sort}")
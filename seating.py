@@ -0,0 +1,313 @@
+import re
+
+from sqlalchemy import or_
+
+from app import db
+from models import Booking, Passenger, SeatMap
+from inventory import InventoryError, SoldOutError, ensure_running, seat_column, reserve_seats, release_seats
+from stops import leg_count, journey_legs
+
+SEAT_LETTERS = 'ABCDEF'  # one row, as drawn by select_seat.html
+SEATS_PER_ROW = len(SEAT_LETTERS)
+ROW_MASK = (1 << SEATS_PER_ROW) - 1
+SEAT_RE = re.compile(r'^(\d+)([A-F])$')
+
+
+class SeatError(InventoryError):
+    """Raised when a requested seat does not exist or is already taken"""
+    pass
+
+
+def seat_label(index):
+    row, column = divmod(index, SEATS_PER_ROW)
+    return f'{row + 1}{SEAT_LETTERS[column]}'
+
+
+def seat_index(label):
+    """Bit position of a seat like '12C', or None if it is not a seat label"""
+    match = SEAT_RE.match((label or '').strip().upper())
+    if match is None or int(match.group(1)) < 1:
+        return None
+    return (int(match.group(1)) - 1) * SEATS_PER_ROW + SEAT_LETTERS.index(match.group(2))
+
+
+def _popcount(word):
+    return bin(word).count('1')
+
+
+def _run_starts(free, length):
+    """Bits of ``free`` that start ``length`` consecutive free seats"""
+    starts = free
+    for shift in range(1, length):
+        starts &= free >> shift
+    return starts
+
+
+class SeatBitmap:
+    """Occupied seats of one class as an int, seat n being bit n.
+
+    Each row is a 6-bit word, so a row's free seats and every run of k
+    adjacent free seats in it are found with a few shifts and ANDs rather
+    than by looking at seats one at a time.
+    """
+
+    def __init__(self, total_seats, occupied=0):
+        self.total_seats = total_seats
+        self.rows = -(-total_seats // SEATS_PER_ROW)
+        self.occupied = occupied
+
+    @classmethod
+    def from_bytes(cls, total_seats, data):
+        return cls(total_seats, int.from_bytes(data or b'', 'little'))
+
+    def to_bytes(self):
+        return self.occupied.to_bytes(-(-self.occupied.bit_length() // 8), 'little')
+
+    def free_in_row(self, row):
+        shift = row * SEATS_PER_ROW
+        existing = min(SEATS_PER_ROW, self.total_seats - shift)
+        return ~(self.occupied >> shift) & ROW_MASK & ((1 << existing) - 1)
+
+    def is_free(self, index):
+        return 0 <= index < self.total_seats and not self.occupied >> index & 1
+
+    def occupy(self, indexes):
+        for index in indexes:
+            self.occupied |= 1 << index
+
+    def release(self, indexes):
+        for index in indexes:
+            self.occupied &= ~(1 << index)
+
+    def allocate(self, count):
+        """Seat indexes for a party of ``count`` kept as close together as possible.
+
+        A single row wins if it has ``count`` adjacent free seats, preferring
+        the row that leaves the fewest free seats stranded; otherwise the
+        fewest consecutive rows holding enough free seats. Returns None if
+        fewer than ``count`` seats are free.
+        """
+        free = ~self.occupied & ((1 << self.total_seats) - 1)
+        if count < 1 or _popcount(free) < count:
+            return None
+
+        if count <= SEATS_PER_ROW:
+            # Every row at once: keep the run starts that fit inside their row
+            row_starts = (1 << (SEATS_PER_ROW - count + 1)) - 1
+            starts = _run_starts(free, count) & row_starts * (((1 << SEATS_PER_ROW * self.rows) - 1) // ROW_MASK)
+            best = None
+            while starts:
+                start = (starts & -starts).bit_length() - 1
+                row = start // SEATS_PER_ROW
+                stranded = _popcount(self.free_in_row(row)) - count
+                if best is None or stranded < best[0]:
+                    best = (stranded, start)
+                    if stranded == 0:
+                        break
+                starts &= ~(ROW_MASK << row * SEATS_PER_ROW)
+            if best is not None:
+                return list(range(best[1], best[1] + count))
+
+        free_rows = [self.free_in_row(row) for row in range(self.rows)]
+        counts = [_popcount(word) for word in free_rows]
+        for span in range(2, self.rows + 1):
+            window = sum(counts[:span])
+            for first in range(self.rows - span + 1):
+                if first:
+                    window += counts[first + span - 1] - counts[first - 1]
+                if window >= count:
+                    return self._take(free_rows, range(first, first + span), count)
+        return None
+
+    def _take(self, free_rows, rows, count):
+        seats = []
+        for row in rows:
+            free = free_rows[row]
+            while free and len(seats) < count:
+                low = free & -free
+                seats.append(row * SEATS_PER_ROW + low.bit_length() - 1)
+                free ^= low
+        return seats
+
+
+def total_seats(schedule, booking_type, travel_class):
+    seat_column(travel_class)  # validates the class
+    vehicle = schedule.train if booking_type == 'train' else schedule.flight
+    return getattr(vehicle, f'total_seats_{travel_class}')
+
+
+def _seated_passengers(booking_type, schedule_id, travel_class, total, leg):
+    """SeatBitmap of the seats held on ``leg`` by confirmed passengers"""
+    bitmap = SeatBitmap(total)
+    taken = db.session.query(Passenger.seat_number).join(Booking).filter(
+        Booking.booking_type == booking_type,
+        Booking.schedule_id == schedule_id,
+        Booking.travel_class == travel_class,
+        Booking.status == 'confirmed',
+        or_(Booking.board_stop.is_(None), Booking.board_stop <= leg),
+        or_(Booking.alight_stop.is_(None), Booking.alight_stop > leg),
+        Passenger.seat_number.isnot(None)
+    )
+    bitmap.occupy(index for index in (seat_index(row.seat_number) for row in taken)
+                  if index is not None and index < total)
+    return bitmap
+
+
+def load_seat_maps(schedule, booking_type, travel_class, legs=None):
+    """[(SeatMap row, SeatBitmap)] for ``legs`` of a schedule class, every leg by default.
+
+    Call with the schedule row locked (inventory.lock_schedule); a leg's
+    map is built from existing passengers the first time it is needed.
+    """
+    legs = legs if legs is not None else range(leg_count(schedule, booking_type))
+    total = total_seats(schedule, booking_type, travel_class)
+    existing = {seat_map.leg: seat_map for seat_map in SeatMap.query.filter(
+        SeatMap.booking_type == booking_type,
+        SeatMap.schedule_id == schedule.id,
+        SeatMap.travel_class == travel_class,
+        SeatMap.leg.in_(list(legs))
+    )}
+    maps = []
+    for leg in legs:
+        seat_map = existing.get(leg)
+        if seat_map is None:
+            bitmap = _seated_passengers(booking_type, schedule.id, travel_class, total, leg)
+            seat_map = SeatMap(booking_type=booking_type, schedule_id=schedule.id, travel_class=travel_class, leg=leg)
+            db.session.add(seat_map)
+        else:
+            bitmap = SeatBitmap.from_bytes(total, seat_map.occupied)
+        maps.append((seat_map, bitmap))
+    return maps
+
+
+def _combined(total, maps):
+    # A seat is taken for a journey if it is taken on any of its legs
+    occupied = 0
+    for _, bitmap in maps:
+        occupied |= bitmap.occupied
+    return SeatBitmap(total, occupied)
+
+
+def _assign(maps, total, travel_class, requested):
+    bitmap = _combined(total, maps)
+    seats = [None] * len(requested)
+    for i, label in enumerate(requested):
+        if not label:
+            continue
+        index = seat_index(label)
+        if index is None or index >= bitmap.total_seats:
+            raise SeatError(f'Seat {label} does not exist in {travel_class} class')
+        if not bitmap.is_free(index):
+            raise SeatError(f'Seat {label} is already taken')
+        bitmap.occupy([index])
+        seats[i] = index
+
+    unseated = [i for i, seat in enumerate(seats) if seat is None]
+    allocated = bitmap.allocate(len(unseated)) if unseated else None
+    if allocated:
+        for i, index in zip(unseated, allocated):
+            seats[i] = index
+
+    taken = [index for index in seats if index is not None]
+    for seat_map, leg_bitmap in maps:
+        leg_bitmap.occupy(taken)
+        seat_map.occupied = leg_bitmap.to_bytes()
+    return [seat_label(index) if index is not None else None for index in seats]
+
+
+def assign_seats(schedule, booking_type, travel_class, requested, legs=None, maps=None):
+    """Seat labels for a party, one per entry of ``requested``.
+
+    Entries naming a seat get that seat (SeatError if it is unknown or
+    taken on any of ``legs``); the blank ones are seated together by
+    SeatBitmap.allocate. If the map has no room left for them they stay None.
+    Seating many parties can pass the same ``maps`` from load_seat_maps.
+    """
+    maps = maps if maps is not None else load_seat_maps(schedule, booking_type, travel_class, legs)
+    return _assign(maps, total_seats(schedule, booking_type, travel_class), travel_class, requested)
+
+
+def _sync_route_seats(schedule, travel_class, total, maps):
+    # The schedule's counter stays "seats free from origin to terminus"
+    setattr(schedule, seat_column(travel_class), total - _popcount(_combined(total, maps).occupied))
+
+
+def reserve_journey(schedule, booking_type, travel_class, requested, board_stop=None, alight_stop=None):
+    """Take and assign seats for a party from ``board_stop`` to ``alight_stop``.
+
+    Whole-route bookings use the schedule's seat counter as before; a
+    sub-journey only needs its seats free on the legs it travels, and
+    only those legs' maps are marked. Call with the schedule locked.
+    """
+    legs = journey_legs(schedule, booking_type, board_stop, alight_stop)
+    route = range(leg_count(schedule, booking_type))
+    if legs == route:
+        reserve_seats(schedule, travel_class, len(requested))
+        return assign_seats(schedule, booking_type, travel_class, requested)
+    if not requested:
+        raise InventoryError('At least one seat must be reserved')
+    ensure_running(schedule)
+
+    total = total_seats(schedule, booking_type, travel_class)
+    maps = load_seat_maps(schedule, booking_type, travel_class, route)
+    journey_maps = maps[legs.start:legs.stop]
+    available = total - _popcount(_combined(total, journey_maps).occupied)
+    if available < len(requested):
+        raise SoldOutError(f'Not enough seats available. Only {available} seats left.')
+    seats = _assign(journey_maps, total, travel_class, requested)
+    _sync_route_seats(schedule, travel_class, total, maps)
+    return seats
+
+
+def release_journey(schedule, booking):
+    """Return a cancelled booking's seats on the legs it travelled"""
+    legs = journey_legs(schedule, booking.booking_type, booking.board_stop, booking.alight_stop)
+    route = range(leg_count(schedule, booking.booking_type))
+    total = total_seats(schedule, booking.booking_type, booking.travel_class)
+    maps = load_seat_maps(schedule, booking.booking_type, booking.travel_class, route)
+    indexes = [index for index in (seat_index(p.seat_number) for p in booking.passengers) if index is not None]
+    for seat_map, bitmap in maps[legs.start:legs.stop]:
+        bitmap.release(indexes)
+        seat_map.occupied = bitmap.to_bytes()
+    if legs == route:
+        release_seats(schedule, booking.travel_class, len(booking.passengers))
+    else:
+        _sync_route_seats(schedule, booking.travel_class, total, maps)
+
+
+def leg_occupancy(booking_type, schedule_ids):
+    """{(schedule_id, travel_class): {leg: occupied bits}} for many schedules in one query"""
+    occupancy = {}
+    for seat_map in SeatMap.query.filter(SeatMap.booking_type == booking_type, SeatMap.schedule_id.in_(schedule_ids)):
+        occupancy.setdefault((seat_map.schedule_id, seat_map.travel_class), {})[seat_map.leg] = \
+            int.from_bytes(seat_map.occupied or b'', 'little')
+    return occupancy
+
+
+def free_on_legs(total, occupancy, legs):
+    """Seats free on every leg in ``legs`` given one schedule class's leg_occupancy"""
+    occupied = 0
+    for leg in legs:
+        occupied |= occupancy.get(leg, 0)
+    return total - _popcount(occupied & ((1 << total) - 1))
+
+
+def booked_seats(schedule, booking_type, travel_class, board_stop=None, alight_stop=None):
+    """Labels of the seats taken on any leg of the journey, for drawing the seat map"""
+    legs = journey_legs(schedule, booking_type, board_stop, alight_stop)
+    total = total_seats(schedule, booking_type, travel_class)
+    existing = {seat_map.leg: seat_map for seat_map in SeatMap.query.filter_by(
+        booking_type=booking_type, schedule_id=schedule.id, travel_class=travel_class
+    )}
+    occupied = 0
+    for leg in legs:
+        if leg in existing:
+            occupied |= int.from_bytes(existing[leg].occupied or b'', 'little')
+        else:
+            occupied |= _seated_passengers(booking_type, schedule.id, travel_class, total, leg).occupied
+    labels = set()
+    while occupied:
+        low = occupied & -occupied
+        labels.add(seat_label(low.bit_length() - 1))
+        occupied ^= low
+    return labels
@@ -0,0 +1,148 @@
+from collections import namedtuple
+import csv
+from datetime import datetime
+import sys
+
+from app import app, db
+from models import Booking, SeatMap, Station, TrainSchedule, TrainStop
+from inventory import InventoryError, get_price
+from timeline import schedule_conflicts
+
+StopTime = namedtuple('StopTime', ['station_id', 'arrival_time', 'departure_time', 'fare_fraction'])
+
+
+class StopError(ValueError):
+    """Raised for a stop sequence that cannot be run"""
+    pass
+
+
+def leg_count(schedule, booking_type):
+    """Legs between consecutive stops; schedules without stops are a single leg"""
+    if booking_type == 'train' and schedule.stops:
+        return len(schedule.stops) - 1
+    return 1
+
+
+def journey_legs(schedule, booking_type, board_stop=None, alight_stop=None):
+    """The range of legs travelled from ``board_stop`` to ``alight_stop``.
+
+    Both None means the whole route; raises InventoryError for stops the
+    schedule does not have, including any stops on a service without them.
+    """
+    legs = leg_count(schedule, booking_type)
+    if board_stop is None and alight_stop is None:
+        return range(legs)
+    if booking_type != 'train' or not schedule.stops:
+        raise InventoryError('This service does not stop between its origin and destination')
+    if board_stop is None or alight_stop is None or not 0 <= board_stop < alight_stop <= legs:
+        raise InventoryError('This service does not run between the requested stops')
+    return range(board_stop, alight_stop)
+
+
+def journey_price(schedule, booking_type, travel_class, board_stop=None, alight_stop=None):
+    """Price of one seat, pro rata by fare_fraction for a sub-journey;
+    raises InventoryError for stops the schedule does not have"""
+    price = get_price(schedule, travel_class)
+    if board_stop is None and alight_stop is None:
+        return price
+    journey_legs(schedule, booking_type, board_stop, alight_stop)
+    stops = schedule.stops
+    return round(price * (stops[alight_stop].fare_fraction - stops[board_stop].fare_fraction), 2)
+
+
+def _check_stops(stops):
+    if len(stops) < 2:
+        raise StopError('A service needs at least two stops')
+    for previous, stop in zip(stops, stops[1:]):
+        if stop.station_id == previous.station_id:
+            raise StopError('Consecutive stops must be at different stations')
+        if previous.departure_time is None or stop.arrival_time is None:
+            raise StopError('Every stop except the terminus needs a departure time, '
+                            'every stop except the origin an arrival time')
+        if stop.arrival_time <= previous.departure_time:
+            raise StopError('Each stop must be reached after leaving the previous one')
+        if stop.departure_time is not None and stop.departure_time < stop.arrival_time:
+            raise StopError('A train cannot leave a stop before arriving there')
+
+
+def _fare_fractions(stops):
+    # Stops without a fraction share the fare evenly by leg
+    last = len(stops) - 1
+    fractions = [stop.fare_fraction if stop.fare_fraction is not None else sequence / last
+                 for sequence, stop in enumerate(stops)]
+    fractions[0], fractions[-1] = 0.0, 1.0
+    if any(b < a for a, b in zip(fractions, fractions[1:])):
+        raise StopError('Fare fractions must not decrease along the route')
+    return fractions
+
+
+def set_stops(schedule, stops):
+    """Replace a train schedule's stops with ``stops`` (StopTime tuples, origin first).
+
+    The schedule's endpoints and times follow the first and last stop and
+    are checked against the train's timeline. Leg numbering changes, so it
+    is refused while the schedule has confirmed bookings.
+    """
+    _check_stops(stops)
+    fractions = _fare_fractions(stops)
+    if Booking.query.filter_by(booking_type='train', schedule_id=schedule.id, status='confirmed').first():
+        raise StopError('Stops cannot change while the schedule has confirmed bookings')
+
+    problems = schedule_conflicts('train', schedule.train_id, stops[0].station_id, stops[-1].station_id,
+                                  stops[0].departure_time, stops[-1].arrival_time, schedule.id)
+    if problems:
+        raise StopError('; '.join(problems))
+
+    SeatMap.query.filter_by(booking_type='train', schedule_id=schedule.id).delete(synchronize_session=False)
+    # Old stops go first so the new ones can reuse their sequence numbers
+    schedule.stops.clear()
+    db.session.flush()
+    schedule.stops = [
+        TrainStop(
+            sequence=sequence,
+            station_id=stop.station_id,
+            arrival_time=stop.arrival_time if sequence > 0 else None,
+            departure_time=stop.departure_time if sequence < len(stops) - 1 else None,
+            fare_fraction=fraction
+        )
+        for sequence, (stop, fraction) in enumerate(zip(stops, fractions))
+    ]
+    schedule.departure_station_id = stops[0].station_id
+    schedule.arrival_station_id = stops[-1].station_id
+    schedule.departure_time = stops[0].departure_time
+    schedule.arrival_time = stops[-1].arrival_time
+
+
+def read_stop_csv(path):
+    """StopTimes from a CSV file with station_code, arrival_time, departure_time
+    and (optionally) fare_fraction columns; blank times for the route's ends"""
+    stations = {station.code: station.id for station in Station.query}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            if row['station_code'] not in stations:
+                raise StopError(f"Unknown station {row['station_code']}")
+            yield StopTime(
+                stations[row['station_code']],
+                datetime.fromisoformat(row['arrival_time']) if row.get('arrival_time') else None,
+                datetime.fromisoformat(row['departure_time']) if row.get('departure_time') else None,
+                float(row['fare_fraction']) if row.get('fare_fraction') else None
+            )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python stops.py SCHEDULE_ID stops.csv")
+        sys.exit(1)
+    with app.app_context():
+        schedule = db.session.get(TrainSchedule, int(sys.argv[1]))
+        if schedule is None:
+            print(f"Train schedule {sys.argv[1]} not found")
+            sys.exit(1)
+        try:
+            set_stops(schedule, list(read_stop_csv(sys.argv[2])))
+        except StopError as e:
+            db.session.rollback()
+            print(f"Stops not changed: {e}")
+            sys.exit(1)
+        db.session.commit()
+        print(f"Schedule {schedule.id} now calls at {len(schedule.stops)} stops")
@@ -0,0 +1,132 @@
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from jinja2 import FileSystemBytecodeCache, TemplateSyntaxError
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_ENDPOINTS = ('index', 'search', 'select_seat')
+
+
+def init_app(app):
+    """Cache compiled templates on disk, shared by every worker.
+
+    Outside development the app's own loader is used directly (Flask's
+    dispatching loader only matters for blueprints and explain mode) and
+    templates are never checked for changes.
+    """
+    cache_dir = app.config['TEMPLATE_CACHE_DIR']
+    os.makedirs(cache_dir, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    if app.config['APP_PROFILE'] != 'development':
+        app.config['TEMPLATES_AUTO_RELOAD'] = False
+        app.jinja_env.auto_reload = False
+        app.jinja_env.loader = app.jinja_loader
+
+
+def precompile_templates(app):
+    """Compile every template into the bytecode cache and this process's
+    template cache; returns the number compiled"""
+    compiled = 0
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        try:
+            app.jinja_env.get_template(name)
+        except TemplateSyntaxError:
+            logger.exception("Template %s does not compile", name)
+            continue
+        compiled += 1
+    return compiled
+
+
+def clear_template_cache(app):
+    app.jinja_env.bytecode_cache.clear()
+    app.jinja_env.cache.clear()
+
+
+def _first_requests(precompile):
+    # Runs in a fresh interpreter, like a newly started worker
+    from app import app, db
+    from models import TrainSchedule, User
+
+    started = time.perf_counter()
+    if precompile:
+        precompile_templates(app)
+    startup = time.perf_counter() - started
+
+    with app.app_context():
+        schedule = TrainSchedule.query.order_by(TrainSchedule.id).first()
+        user = User.query.order_by(User.id).first()
+        db.session.remove()
+    if schedule is None or user is None:
+        raise SystemExit("The benchmark needs at least one user and one train schedule")
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+    paths = {
+        'index': '/',
+        'search': '/search',
+        'select_seat': f'/select-seat?schedule_id={schedule.id}&booking_type=train&travel_class=economy&passengers=1',
+    }
+    timings = [('startup', startup)]
+    for endpoint in BENCHMARK_ENDPOINTS:
+        started = time.perf_counter()
+        status = client.get(paths[endpoint]).status_code
+        timings.append((endpoint, time.perf_counter() - started))
+        # An error page or redirect would time the wrong templates
+        if status != 200:
+            raise SystemExit(f"{paths[endpoint]} answered {status}, not the page to measure")
+    for name, seconds in timings:
+        print(f"{name} {seconds * 1000:.1f}")
+
+
+def benchmark(app, runs=5):
+    """Median first-request time per endpoint for a worker starting with an
+    empty template cache (cold) and one starting from a precompiled cache
+    (warm); raises RuntimeError if an endpoint does not render its page"""
+    results = {}
+    for mode in ('cold', 'warm'):
+        samples = {}
+        for _ in range(runs):
+            if mode == 'cold':
+                clear_template_cache(app)
+            else:
+                precompile_templates(app)
+            run = subprocess.run(
+                [sys.executable, __file__, '_first-requests', '1' if mode == 'warm' else '0'],
+                capture_output=True, text=True
+            )
+            if run.returncode != 0:
+                raise RuntimeError(f"Benchmark worker failed: {run.stderr.strip()}")
+            for line in run.stdout.splitlines():
+                name, _, milliseconds = line.rpartition(' ')
+                if name in ('startup',) + BENCHMARK_ENDPOINTS:
+                    samples.setdefault(name, []).append(float(milliseconds))
+        results[mode] = {name: sorted(values)[len(values) // 2] for name, values in samples.items()}
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == '_first-requests':
+        logging.disable(logging.CRITICAL)
+        _first_requests(sys.argv[2] == '1')
+        sys.exit(0)
+    if len(sys.argv) < 2 or sys.argv[1] not in ('precompile', 'benchmark'):
+        print("Usage: python templating.py precompile | benchmark [RUNS]")
+        sys.exit(1)
+
+    from app import app
+    if sys.argv[1] == 'precompile':
+        print(f"Compiled {precompile_templates(app)} templates into {app.config['TEMPLATE_CACHE_DIR']}")
+    else:
+        try:
+            results = benchmark(app, int(sys.argv[2]) if len(sys.argv) > 2 else 5)
+        except RuntimeError as e:
+            print(e)
+            sys.exit(1)
+        print(f"{'first request (ms)':<20}{'cold':>10}{'warm':>10}")
+        for name in ('startup',) + BENCHMARK_ENDPOINTS:
+            print(f"{name:<20}{results['cold'][name]:>10.1f}{results['warm'][name]:>10.1f}")
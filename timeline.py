@@ -0,0 +1,192 @@
+from bisect import bisect_left
+from collections import namedtuple
+import csv
+from datetime import datetime
+import sys
+
+from app import app, db
+from models import Train, Flight
+from inventory import get_schedule_model
+
+# Vehicle, origin and destination columns of each schedule table
+SCHEDULE_COLUMNS = {
+    'train': ('train_id', 'departure_station_id', 'arrival_station_id'),
+    'flight': ('flight_id', 'departure_airport_id', 'arrival_airport_id'),
+}
+VEHICLE_MODELS = {
+    'train': Train,
+    'flight': Flight,
+}
+PLACE_NAMES = {
+    'train': 'station',
+    'flight': 'airport',
+}
+
+Interval = namedtuple('Interval', ['departure_time', 'arrival_time', 'origin_id', 'destination_id', 'schedule_id'])
+
+
+class VehicleTimeline:
+    """One vehicle's schedules sorted by departure time.
+
+    Valid schedules never overlap, so only the two neighbours of a new
+    interval (found by bisect) can conflict with it, making each check
+    O(log n).
+    """
+
+    def __init__(self, booking_type, intervals=()):
+        self.booking_type = booking_type
+        self.intervals = sorted(intervals)
+        self.starts = [interval.departure_time for interval in self.intervals]
+
+    def _neighbours(self, departure_time, schedule_id=None):
+        index = bisect_left(self.starts, departure_time)
+        before, after = index - 1, index
+        # The schedule being edited is not its own neighbour
+        if schedule_id is not None:
+            while before >= 0 and self.intervals[before].schedule_id == schedule_id:
+                before -= 1
+            while after < len(self.intervals) and self.intervals[after].schedule_id == schedule_id:
+                after += 1
+        previous = self.intervals[before] if before >= 0 else None
+        following = self.intervals[after] if after < len(self.intervals) else None
+        return previous, following
+
+    def conflicts(self, interval):
+        """Problems with adding ``interval``; an empty list if it fits"""
+        place = PLACE_NAMES[self.booking_type]
+        if interval.arrival_time <= interval.departure_time:
+            return ['Arrival time must be after departure time']
+        if interval.origin_id == interval.destination_id:
+            return [f'Departure and arrival {place} must be different']
+
+        problems = []
+        previous, following = self._neighbours(interval.departure_time, interval.schedule_id)
+        if previous is not None:
+            if previous.arrival_time > interval.departure_time:
+                problems.append(f'Overlaps schedule #{previous.schedule_id} '
+                                f'({_format_interval(previous)}) of the same {self.booking_type}')
+            elif previous.destination_id != interval.origin_id:
+                problems.append(f'The {self.booking_type} arrives at a different {place} on its previous trip '
+                                f'(schedule #{previous.schedule_id}) than this one departs from')
+        if following is not None:
+            if following.departure_time < interval.arrival_time:
+                problems.append(f'Overlaps schedule #{following.schedule_id} '
+                                f'({_format_interval(following)}) of the same {self.booking_type}')
+            elif following.origin_id != interval.destination_id:
+                problems.append(f'The {self.booking_type} departs from a different {place} on its next trip '
+                                f'(schedule #{following.schedule_id}) than this one arrives at')
+        return problems
+
+    def add(self, interval):
+        self.remove(interval.schedule_id)
+        index = bisect_left(self.intervals, interval)
+        self.intervals.insert(index, interval)
+        self.starts.insert(index, interval.departure_time)
+
+    def remove(self, schedule_id):
+        if schedule_id is None:
+            return
+        for index, interval in enumerate(self.intervals):
+            if interval.schedule_id == schedule_id:
+                del self.intervals[index]
+                del self.starts[index]
+                return
+
+
+def _format_interval(interval):
+    return f"{interval.departure_time.strftime('%Y-%m-%d %H:%M')} to {interval.arrival_time.strftime('%Y-%m-%d %H:%M')}"
+
+
+def load_timeline(booking_type, vehicle_id, lock=False):
+    """Build a vehicle's timeline; with ``lock`` the vehicle row is locked
+    first so concurrent edits for the same vehicle are checked one at a time."""
+    model = get_schedule_model(booking_type)
+    vehicle_column, origin_column, destination_column = SCHEDULE_COLUMNS[booking_type]
+    if lock:
+        VEHICLE_MODELS[booking_type].query.filter_by(id=vehicle_id).with_for_update().first()
+    rows = db.session.query(
+        model.departure_time, model.arrival_time,
+        getattr(model, origin_column), getattr(model, destination_column), model.id
+    ).filter(getattr(model, vehicle_column) == vehicle_id).order_by(model.departure_time)
+    return VehicleTimeline(booking_type, (Interval(*row) for row in rows))
+
+
+def schedule_conflicts(booking_type, vehicle_id, origin_id, destination_id, departure_time, arrival_time,
+                       schedule_id=None):
+    """Overlap and continuity problems for one schedule being added or edited"""
+    timeline = load_timeline(booking_type, vehicle_id, lock=True)
+    return timeline.conflicts(Interval(departure_time, arrival_time, origin_id, destination_id, schedule_id))
+
+
+def load_schedules(booking_type, rows):
+    """Validate and insert many schedules, one timeline per vehicle.
+
+    ``rows`` are dicts of schedule column values. Returns the list of
+    (row number, problems) that were rejected; the rest are added to the
+    session for the caller to commit.
+    """
+    model = get_schedule_model(booking_type)
+    vehicle_column, origin_column, destination_column = SCHEDULE_COLUMNS[booking_type]
+    vehicle_model = VEHICLE_MODELS[booking_type]
+    timelines = {}
+    rejected = []
+    for number, values in enumerate(rows, start=1):
+        vehicle_id = values[vehicle_column]
+        vehicle = db.session.get(vehicle_model, vehicle_id)
+        if vehicle is None:
+            rejected.append((number, [f'Unknown {booking_type} {vehicle_id}']))
+            continue
+        if vehicle_id not in timelines:
+            timelines[vehicle_id] = load_timeline(booking_type, vehicle_id, lock=True)
+
+        interval = Interval(values['departure_time'], values['arrival_time'],
+                            values[origin_column], values[destination_column], None)
+        problems = timelines[vehicle_id].conflicts(interval)
+        if problems:
+            rejected.append((number, problems))
+            continue
+
+        schedule = model(
+            available_seats_economy=vehicle.total_seats_economy,
+            available_seats_business=vehicle.total_seats_business,
+            available_seats_first=vehicle.total_seats_first,
+            **values
+        )
+        db.session.add(schedule)
+        db.session.flush()
+        timelines[vehicle_id].add(interval._replace(schedule_id=schedule.id))
+    return rejected
+
+
+def read_schedule_csv(booking_type, path):
+    """Rows of a CSV file with the schedule table's column names as header"""
+    vehicle_column, origin_column, destination_column = SCHEDULE_COLUMNS[booking_type]
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            yield {
+                vehicle_column: int(row[vehicle_column]),
+                origin_column: int(row[origin_column]),
+                destination_column: int(row[destination_column]),
+                'departure_time': datetime.fromisoformat(row['departure_time']),
+                'arrival_time': datetime.fromisoformat(row['arrival_time']),
+                'economy_price': float(row['economy_price']),
+                'business_price': float(row['business_price']),
+                'first_price': float(row['first_price']),
+            }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] not in SCHEDULE_COLUMNS:
+        print("Usage: python timeline.py train|flight schedules.csv")
+        sys.exit(1)
+    with app.app_context():
+        rows = list(read_schedule_csv(sys.argv[1], sys.argv[2]))
+        rejected = load_schedules(sys.argv[1], rows)
+        for number, problems in rejected:
+            print(f"Row {number}: {'; '.join(problems)}")
+        if rejected:
+            db.session.rollback()
+            print(f"Nothing imported: {len(rejected)} of {len(rows)} rows were rejected")
+        else:
+            db.session.commit()
+            print(f"Imported {len(rows)} schedules")
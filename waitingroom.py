@@ -0,0 +1,195 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import wraps
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+from flask import redirect, request, session, url_for
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import update
+
+from app import app, db
+from models import WaitingRoom
+from inventory import InventoryError, get_schedule_model
+
+ROOM_CACHE_SECONDS = 5  # how stale a process's view of a room may be
+MAX_CACHED_ROOMS = 10000
+ADMISSION_MINUTES = 15  # how long an admitted visitor may use seat selection and checkout
+TOKEN_MAX_AGE = 6 * 3600
+DEFAULT_ADMITS_PER_MINUTE = 120
+
+Room = namedtuple('Room', ['booking_type', 'schedule_id', 'opened_at', 'admit_per_minute', 'initial_admits'])
+
+_rooms = {}
+_rooms_lock = threading.Lock()
+
+
+def _serializer():
+    return URLSafeTimedSerializer(app.secret_key, salt='waiting-room')
+
+
+def get_room(booking_type, schedule_id):
+    """The open room in front of a schedule, or None; cached for a few seconds"""
+    key = (booking_type, schedule_id)
+    now = time.monotonic()
+    with _rooms_lock:
+        cached = _rooms.get(key)
+    if cached is not None and now - cached[1] < ROOM_CACHE_SECONDS:
+        return cached[0]
+
+    record = WaitingRoom.query.filter_by(booking_type=booking_type, schedule_id=schedule_id, enabled=True).first()
+    room = None
+    if record is not None:
+        room = Room(record.booking_type, record.schedule_id, record.opened_at,
+                    record.admit_per_minute, record.initial_admits)
+    with _rooms_lock:
+        if len(_rooms) >= MAX_CACHED_ROOMS:
+            _rooms.clear()
+        _rooms[key] = (room, now)
+    return room
+
+
+def admitted_through(room, now):
+    """Highest queue position let in by ``now``"""
+    elapsed = max(0.0, (now - room.opened_at).total_seconds())
+    return room.initial_admits + int(elapsed * room.admit_per_minute / 60)
+
+
+def _admitted_at(room, position):
+    wait = max(0, position - room.initial_admits) * 60 / room.admit_per_minute
+    return room.opened_at + timedelta(seconds=wait)
+
+
+def issue_token(room):
+    """Hand out the next queue position as a signed token"""
+    position = db.session.execute(
+        update(WaitingRoom)
+        .where(WaitingRoom.booking_type == room.booking_type, WaitingRoom.schedule_id == room.schedule_id)
+        .values(next_position=WaitingRoom.next_position + 1)
+        .returning(WaitingRoom.next_position)
+    ).scalar_one()
+    db.session.commit()
+    return _serializer().dumps({
+        't': room.booking_type,
+        's': room.schedule_id,
+        'p': position,
+        'o': room.opened_at.isoformat(),
+        'i': datetime.utcnow().isoformat(),
+    })
+
+
+def queue_state(room, token, now=None):
+    """Where a token stands: (state, position, seconds).
+
+    state is 'waiting' (seconds until admission), 'admitted' (seconds of
+    access left), 'expired' or 'invalid' (forged, for another schedule or
+    from before the room was reopened).
+    """
+    try:
+        data = _serializer().loads(token or '', max_age=TOKEN_MAX_AGE)
+    except BadSignature:
+        return 'invalid', None, 0
+    if (data.get('t'), data.get('s'), data.get('o')) != (room.booking_type, room.schedule_id,
+                                                         room.opened_at.isoformat()):
+        return 'invalid', None, 0
+
+    now = now or datetime.utcnow()
+    position = data['p']
+    # Access lasts a while from admission, or from arrival for visitors who
+    # come after their turn has already passed
+    admitted_at = max(_admitted_at(room, position), datetime.fromisoformat(data['i']))
+    if now < admitted_at:
+        return 'waiting', position, (admitted_at - now).total_seconds()
+    remaining = (admitted_at + timedelta(minutes=ADMISSION_MINUTES) - now).total_seconds()
+    if remaining > 0:
+        return 'admitted', position, remaining
+    return 'expired', position, 0
+
+
+def session_token(booking_type, schedule_id):
+    return session.get('waiting_room', {}).get(f'{booking_type}:{schedule_id}')
+
+
+def waiting_room(view):
+    """Send visitors of a schedule with an open waiting room to the queue
+    until their token is admitted. Place it below ``@login_required``:
+    issuing a token writes to the room row, and anonymous visitors (bots
+    among them) could never book with the place they took."""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        booking_type = request.values.get('booking_type')
+        schedule_id = request.values.get('schedule_id', type=int)
+        room = get_room(booking_type, schedule_id) if booking_type and schedule_id else None
+        if room is None:
+            return view(*args, **kwargs)
+
+        token = session_token(booking_type, schedule_id)
+        state, _, _ = queue_state(room, token)
+        if state in ('invalid', 'expired'):
+            token = issue_token(room)
+            session['waiting_room'] = dict(session.get('waiting_room', {}), **{f'{booking_type}:{schedule_id}': token})
+            state, _, _ = queue_state(room, token)
+        if state == 'admitted':
+            return view(*args, **kwargs)
+        return redirect(url_for('waiting_room_page', booking_type=booking_type, schedule_id=schedule_id,
+                                next=_return_path()))
+    return wrapped
+
+
+def _return_path():
+    # A refused POST cannot be replayed, so send the visitor back to the page that made it
+    if request.method == 'GET':
+        return request.full_path
+    referrer = urlsplit(request.referrer or '')
+    if referrer.netloc != request.host:
+        return None
+    return f'{referrer.path}?{referrer.query}' if referrer.query else referrer.path
+
+
+def open_room(booking_type, schedule_id, admit_per_minute=DEFAULT_ADMITS_PER_MINUTE, initial_admits=0):
+    """Put a schedule behind a waiting room, restarting its queue"""
+    if admit_per_minute < 1 or initial_admits < 0:
+        raise ValueError('The admission rate must be positive')
+    if db.session.get(get_schedule_model(booking_type), schedule_id) is None:
+        raise InventoryError(f'{booking_type.capitalize()} schedule {schedule_id} not found')
+    room = WaitingRoom.query.filter_by(booking_type=booking_type, schedule_id=schedule_id).first()
+    if room is None:
+        room = WaitingRoom(booking_type=booking_type, schedule_id=schedule_id)
+        db.session.add(room)
+    room.enabled = True
+    room.opened_at = datetime.utcnow()
+    room.admit_per_minute = admit_per_minute
+    room.initial_admits = initial_admits
+    room.next_position = 0
+    _forget(booking_type, schedule_id)
+    return room
+
+
+def close_room(booking_type, schedule_id):
+    WaitingRoom.query.filter_by(booking_type=booking_type, schedule_id=schedule_id).update({'enabled': False})
+    _forget(booking_type, schedule_id)
+
+
+def _forget(booking_type, schedule_id):
+    # Other processes notice within ROOM_CACHE_SECONDS
+    with _rooms_lock:
+        _rooms.pop((booking_type, schedule_id), None)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or sys.argv[1] not in ('open', 'close'):
+        print("Usage: python waitingroom.py open|close train|flight SCHEDULE_ID [ADMITS_PER_MINUTE [INITIAL_ADMITS]]")
+        sys.exit(1)
+    with app.app_context():
+        action, booking_type, schedule_id = sys.argv[1], sys.argv[2], int(sys.argv[3])
+        if action == 'open':
+            rate = int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_ADMITS_PER_MINUTE
+            initial = int(sys.argv[5]) if len(sys.argv) > 5 else 0
+            open_room(booking_type, schedule_id, rate, initial)
+            print(f"Waiting room open for {booking_type} schedule {schedule_id}: {rate} admissions per minute")
+        else:
+            close_room(booking_type, schedule_id)
+            print(f"Waiting room closed for {booking_type} schedule {schedule_id}")
+        db.session.commit()
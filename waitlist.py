@@ -0,0 +1,173 @@
+from datetime import datetime
+import logging
+import threading
+import time
+
+from sqlalchemy import insert
+
+from app import app, db
+from models import WaitlistEntry, Booking, Passenger
+from inventory import lock_schedule, get_available_seats, get_price, reserve_seats
+from jobs import job, enqueue_job
+from notifications import enqueue_booking_notification
+from eticket import enqueue_eticket_render
+from seating import SeatError, assign_seats
+from changefeed import consumer, seat_increases
+
+logger = logging.getLogger(__name__)
+
+PROMOTION_BATCH_SIZE = 50
+SWEEP_INTERVAL = 60  # seconds between safety-net sweeps of every waiting group
+
+_worker = None
+
+
+def join_waitlist(user_id, booking_type, schedule_id, travel_class, passengers):
+    """Queue a booking request that could not be served; caller commits"""
+    entry = WaitlistEntry(
+        user_id=user_id,
+        booking_type=booking_type,
+        schedule_id=int(schedule_id),
+        travel_class=travel_class,
+        passengers=passengers,
+        status='waiting'
+    )
+    db.session.add(entry)
+    return entry
+
+
+def waitlist_position(entry):
+    """1-based FIFO position of a waiting entry"""
+    return WaitlistEntry.query.filter(
+        WaitlistEntry.booking_type == entry.booking_type,
+        WaitlistEntry.schedule_id == entry.schedule_id,
+        WaitlistEntry.travel_class == entry.travel_class,
+        WaitlistEntry.status == 'waiting',
+        WaitlistEntry.id <= entry.id
+    ).count()
+
+
+def enqueue_waitlist_promotion(booking_type, schedule_id, travel_class):
+    """Queue a promotion pass in the current transaction, e.g. with a cancellation"""
+    enqueue_job('promote_waitlist', {
+        'booking_type': booking_type,
+        'schedule_id': int(schedule_id),
+        'travel_class': travel_class,
+    })
+
+
+def promote_waitlist(booking_type, schedule_id, travel_class, batch_size=PROMOTION_BATCH_SIZE):
+    """Turn waiting entries into bookings while seats last.
+
+    Runs in its own transaction and takes the same schedule row lock as
+    book(), so promotions can never oversell. Entries are served strictly in
+    arrival order: if the head of the queue needs more seats than are free,
+    nobody behind it jumps ahead. Returns the number of promoted entries.
+    """
+    promoted = 0
+    try:
+        schedule = lock_schedule(booking_type, schedule_id)
+        available = get_available_seats(schedule, travel_class)
+        entries = WaitlistEntry.query.filter_by(
+            booking_type=booking_type,
+            schedule_id=schedule_id,
+            travel_class=travel_class,
+            status='waiting'
+        ).order_by(WaitlistEntry.id).limit(batch_size).with_for_update().all()
+
+        rows = []
+        for entry in entries:
+            if entry.passenger_count > available:
+                break
+            reserve_seats(schedule, travel_class, entry.passenger_count)
+            available -= entry.passenger_count
+
+            booking = Booking(
+                user_id=entry.user_id,
+                booking_type=booking_type,
+                schedule_id=schedule_id,
+                travel_class=travel_class,
+                total_amount=get_price(schedule, travel_class) * entry.passenger_count,
+                status='confirmed'
+            )
+            db.session.add(booking)
+            db.session.flush()  # Flush to get the booking ID
+
+            requested = [passenger.get('seat_number') for passenger in entry.passengers]
+            try:
+                seats = assign_seats(schedule, booking_type, travel_class, requested)
+            except SeatError:
+                # Seats picked while the service was full are usually sold by
+                # now; seat the party together rather than block the queue
+                seats = assign_seats(schedule, booking_type, travel_class, [None] * len(requested))
+            rows.extend(dict(passenger, booking_id=booking.id, seat_number=seat)
+                        for passenger, seat in zip(entry.passengers, seats))
+            entry.status = 'promoted'
+            entry.booking_id = booking.id
+            entry.promoted_at = datetime.utcnow()
+            enqueue_booking_notification(booking, 'waitlist_promoted')
+            enqueue_eticket_render(booking)
+            promoted += 1
+
+        if rows:
+            db.session.execute(insert(Passenger), rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return promoted
+
+
+@consumer('waitlist', durable=True)
+def _promote_on_freed_seats(events):
+    """Queue promotions wherever a cancellation or capacity change freed seats"""
+    freed = {(inventory_event.booking_type, inventory_event.schedule_id, travel_class)
+             for inventory_event in events for travel_class in seat_increases(inventory_event)}
+    for booking_type, schedule_id, travel_class in sorted(freed):
+        if WaitlistEntry.query.filter_by(booking_type=booking_type, schedule_id=schedule_id,
+                                         travel_class=travel_class, status='waiting').first():
+            enqueue_waitlist_promotion(booking_type, schedule_id, travel_class)
+
+
+def waiting_groups():
+    """Every schedule/class that currently has someone waiting"""
+    return db.session.query(
+        WaitlistEntry.booking_type, WaitlistEntry.schedule_id, WaitlistEntry.travel_class
+    ).filter_by(status='waiting').distinct().all()
+
+
+@job('promote_waitlist')
+def promote_all(booking_type, schedule_id, travel_class):
+    """Promote batch after batch until the seats or the queue run out"""
+    promoted = 0
+    while True:
+        batch = promote_waitlist(booking_type, schedule_id, travel_class)
+        promoted += batch
+        if batch < PROMOTION_BATCH_SIZE:
+            break
+    if promoted:
+        logger.info("Promoted %d waitlist entries on %s schedule %s (%s)",
+                    promoted, booking_type, schedule_id, travel_class)
+    return promoted
+
+
+def _run_worker():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        with app.app_context():
+            try:
+                for booking_type, schedule_id, travel_class in waiting_groups():
+                    promote_all(booking_type, schedule_id, travel_class)
+            except Exception:
+                logger.exception("Waitlist sweep failed")
+            finally:
+                db.session.remove()
+
+
+def start_waitlist_worker():
+    """Start the background sweep thread once per process"""
+    global _worker
+    if _worker is None:
+        _worker = threading.Thread(target=_run_worker, name='waitlist-worker', daemon=True)
+        _worker.start()
+    return _worker